@@ -0,0 +1,195 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+import numpy as np
+import os
+import pcm_buffer
+import subprocess
+import tempfile
+import wave
+
+# The IBM free plan only accepts 60 second requests, Whisper only accepts files under 25 MB
+IBM_MAX_SECS = 60
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+WAV_HEADER_BYTES = 44
+
+# File extension for each codec chunks can be exported with. None exports plain .wav
+EXPORT_EXTENSIONS = {None: "wav", "libmp3lame": "mp3", "libopus": "ogg", "flac": "flac"}
+
+# One entry of the chunk manifest. Times are in milliseconds on the source timeline.
+AudioChunk = namedtuple("AudioChunk", ["path", "start_ms", "end_ms", "size_bytes"])
+
+def find_quietest_frame(source, start_frame: int, end_frame: int, window_ms: int = 20):
+    """
+    Finds the quietest point between two frames.
+
+    Only the search range is read from the source. The range is cut into 'window_ms' windows
+    and the middle of the window with the lowest RMS energy is returned.
+
+    Args:
+        source (PCMBuffer): The audio to search.
+
+        start_frame (int): First frame of the search range.
+
+        end_frame (int): Frame just past the end of the search range.
+
+        window_ms (int): Length of the energy windows in milliseconds.
+
+    Returns:
+        int: The frame closest to silence within the range.
+    """
+    window = max(1, source.ms_to_frame(window_ms))
+    samples = source.read_mono(start_frame, end_frame - start_frame)
+    num_windows = len(samples) // window
+    if num_windows == 0:
+        return end_frame
+    energy = np.square(samples[:num_windows * window]).reshape(num_windows, window).mean(axis=1)
+    # Ties go to the latest window so chunks stay as long as possible
+    quietest = num_windows - 1 - int(np.argmin(energy[::-1]))
+    return start_frame + quietest * window + window // 2
+
+def plan_chunks(source, max_frames: int, tolerance_frames: int):
+    """
+    Plans the chunk boundaries for a source, in frames.
+
+    Each boundary is placed at the quietest point inside the 'tolerance_frames' before the hard
+    limit, so no chunk is ever longer than 'max_frames' and cuts land between words.
+
+    Returns:
+        list of (int, int): The (start_frame, end_frame) of every chunk, in order.
+    """
+    boundaries = []
+    start = 0
+    while start < source.num_frames:
+        limit = start + max_frames
+        if limit >= source.num_frames:
+            boundaries.append((start, source.num_frames))
+            break
+        search_start = max(start + 1, limit - tolerance_frames)
+        end = find_quietest_frame(source, search_start, limit)
+        boundaries.append((start, end))
+        start = end
+    return boundaries
+
+def _export_chunk(audio_path: str, chunk_path: str, start_frame: int, end_frame: int, export_codec: str = None):
+    # Runs in a worker process, so it maps the source itself. The pages are shared with every other mapping.
+    source = pcm_buffer.open_buffer(audio_path)
+    # Copy in bounded blocks rather than reading the whole chunk at once
+    block = source.sample_rate * 10
+    if export_codec is None:
+        with wave.open(chunk_path, "wb") as chunk_file:
+            chunk_file.setnchannels(source.channels)
+            chunk_file.setsampwidth(source.sample_width)
+            chunk_file.setframerate(source.sample_rate)
+            for position in range(start_frame, end_frame, block):
+                chunk_file.writeframes(source.read(position, min(block, end_frame - position)))
+    else:
+        pcm_format = {1: "u8", 2: "s16le", 4: "s32le"}[source.sample_width]
+        command = [
+            "ffmpeg", "-nostdin", "-v", "error", "-y",
+            "-f", pcm_format, "-ar", str(source.sample_rate), "-ac", str(source.channels), "-i", "pipe:0",
+            "-acodec", export_codec, chunk_path
+        ]
+        # stderr goes to a temp file, a pipe only read once stdin is done could fill up and stall FFmpeg
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr_file)
+            try:
+                for position in range(start_frame, end_frame, block):
+                    process.stdin.write(source.read(position, min(block, end_frame - position)))
+            except BrokenPipeError:
+                # FFmpeg exited early, its error is reported below
+                pass
+            finally:
+                process.stdin.close()
+            if process.wait() != 0:
+                stderr_file.seek(0)
+                error = stderr_file.read().decode("utf-8", errors="replace").strip()
+                raise RuntimeError(f"FFmpeg failed to export {chunk_path}: {error[-500:]}")
+    return os.path.getsize(chunk_path)
+
+@instrumentation.instrumented("chunk_audio")
+def chunk_audio(audio_path: str, api_name: str, max_secs: float = None, max_bytes: int = None,
+                tolerance_ms: int = 2000, overlap_ms: int = 0, export_codec: str = None,
+                out_dir: str = "./audio", max_workers: int = None):
+    """
+    Breaks an audio file into chunks that fit an API's limits, cutting near silence.
+
+    The source is never loaded as a whole: boundaries are found by reading only the tolerance
+    window before each hard limit, and the chunks are exported in parallel across cores, each
+    worker seeking to and copying its own range.
+
+    Args:
+        audio_path (str): The path to the .wav file to be chunked.
+
+        api_name (str): Name of the API the chunks are for, used in the chunk file names.
+
+        max_secs (float): Maximum length of a chunk in seconds (e.g. IBM_MAX_SECS).
+
+        max_bytes (int): Maximum size of a chunk file in bytes (e.g. WHISPER_MAX_BYTES). At least
+        one of 'max_secs' and 'max_bytes' must be given, the tighter limit wins.
+
+        tolerance_ms (int): How far before the hard limit a boundary may move to find silence.
+
+        overlap_ms (int): How much audio each chunk repeats from the end of the previous one. The
+        overlap counts towards the limits, and the manifest times include it.
+
+        export_codec (str): FFmpeg codec to export the chunks with (see EXPORT_EXTENSIONS). The
+        limits are applied to the PCM size, so compressed chunks always come out smaller.
+
+        out_dir (str): Directory the chunks are written to. It will be created if needed.
+
+        max_workers (int): Number of export processes. Defaults to the number of cores.
+
+    Returns:
+        list of AudioChunk: The manifest of (path, start_ms, end_ms, size_bytes), in timeline order.
+    """
+    if max_secs is None and max_bytes is None:
+        raise ValueError("chunk_audio needs max_secs, max_bytes or both")
+
+    source = pcm_buffer.open_buffer(audio_path)
+    limits = []
+    if max_secs is not None:
+        limits.append(int(max_secs * source.sample_rate))
+    if max_bytes is not None:
+        limits.append((max_bytes - WAV_HEADER_BYTES) // source.frame_size)
+    overlap_frames = source.ms_to_frame(overlap_ms)
+    max_frames = min(limits) - overlap_frames
+    if max_frames <= 0:
+        raise ValueError(f"Chunk limit too small for {audio_path}")
+    tolerance_frames = min(source.ms_to_frame(tolerance_ms), max_frames // 2)
+
+    boundaries = [
+        (max(0, start - overlap_frames), end)
+        for start, end in plan_chunks(source, max_frames, tolerance_frames)
+    ]
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(audio_path))[0]
+    extension = EXPORT_EXTENSIONS[export_codec]
+    chunk_paths = [os.path.join(out_dir, f"chunk{i}_{api_name}_{stem}.{extension}") for i in range(len(boundaries))]
+    print(f"chunk_audio[audio_path: {audio_path}, chunks: {len(boundaries)}]")
+
+    if len(boundaries) == 1:
+        sizes = [_export_chunk(audio_path, chunk_paths[0], *boundaries[0], export_codec)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            sizes = list(executor.map(
+                _export_chunk,
+                [audio_path] * len(boundaries),
+                chunk_paths,
+                [start for start, _ in boundaries],
+                [end for _, end in boundaries],
+                [export_codec] * len(boundaries)
+            ))
+
+    instrumentation.count("bytes_in", source.num_frames * source.frame_size)
+    instrumentation.count("bytes_out", sum(sizes))
+    return [
+        AudioChunk(path, source.frame_to_ms(start), source.frame_to_ms(end), size)
+        for path, (start, end), size in zip(chunk_paths, boundaries, sizes)
+    ]
+
+def chunk_for_ibm(audio_path: str, **kwargs):
+    return chunk_audio(audio_path, "ibm", max_secs=IBM_MAX_SECS, **kwargs)
+
+def chunk_for_whisper(audio_path: str, **kwargs):
+    return chunk_audio(audio_path, "whisper", max_bytes=WHISPER_MAX_BYTES, **kwargs)
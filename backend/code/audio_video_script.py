@@ -1,77 +1,184 @@
 import configparser
 from datetime import datetime 
-from moviepy.video.io.VideoFileClip import VideoFileClip
+import instrumentation
 import os
-from pydub import AudioSegment 
+import subprocess
+import tempfile
+import uuid
+import wave
 
 TODAYS_DATE = current_datetime = datetime.now().date()
 
-def video_to_audio(video_file: str): 
+# Maps an ffmpeg audio codec to the raw muxer we pipe it out through, along with 
+# the sample width in bytes for the PCM codecs (None for compressed codecs). 
+STREAM_FORMATS = {
+    "pcm_s16le": ("s16le", 2), 
+    "pcm_f32le": ("f32le", 4), 
+    "libmp3lame": ("mp3", None), 
+    "libopus": ("ogg", None), 
+    "flac": ("flac", None), 
+    "aac": ("adts", None), 
+}
+
+class AudioExtractionError(Exception): 
+    def __init__(self, message="FFmpeg failed to extract the audio track from the video."): 
+        self.message = message 
+        super().__init__(self.message) 
+
+def new_job_id(): 
+    return uuid.uuid4().hex 
+
+def stream_audio(video_file: str, sample_rate: int = 16000, channels: int = 1, codec: str = "pcm_s16le", 
+                 frames_per_chunk: int = 16000, audio_path: str = None): 
+    """
+    Streams the audio track of a video straight out of FFmpeg, without decoding the video. 
+
+    FFmpeg is run with '-vn' so only the audio stream is demuxed and decoded, and the result is 
+    piped back chunk by chunk so a consumer can start on the audio before the extraction has 
+    finished. Only the streaming mode (streaming_dub) consumes it this way, the batch stages 
+    still work from the whole file video_to_audio writes. 
+
+    Args:
+        video_file (str): The path to the video file. This path can be either absolute or relative.
+
+        sample_rate (int): Output sample rate in Hz. None keeps the source sample rate, for compressed 
+        codecs only. 
+
+        channels (int): Output channel count. None keeps the source channel count, for compressed 
+        codecs only. 
+
+        codec (str): One of the codecs in STREAM_FORMATS. PCM codecs yield whole frames, compressed 
+        codecs yield chunks of the encoded stream. 
+
+        frames_per_chunk (int): Number of PCM frames per yielded chunk. For compressed codecs this is 
+        only used to size the pipe reads. 
+
+        audio_path (str): Optional path to also write the stream to. PCM codecs are written as a .wav 
+        file, compressed codecs are written as-is. 
+
+    Yields:
+        bytes: Raw PCM frames (interleaved, little endian) or compressed chunks. 
+
+    Raises:
+        AudioExtractionError: If FFmpeg exits with a non-zero status. 
+
+        ValueError: If the codec isn't supported, or a PCM codec is asked for without a sample rate 
+        and channel count (the raw PCM muxers carry no header to find them in). 
+    """
+    if codec not in STREAM_FORMATS: 
+        raise ValueError(f"Unsupported codec '{codec}'. Expected one of {list(STREAM_FORMATS)}") 
+    muxer, sample_width = STREAM_FORMATS[codec]
+    if sample_width is not None and (sample_rate is None or channels is None): 
+        raise ValueError("sample_rate and channels are required when streaming PCM") 
+
+    command = ["ffmpeg", "-nostdin", "-v", "error", "-i", video_file, "-vn", "-acodec", codec] 
+    if sample_rate: 
+        command += ["-ar", str(sample_rate)]
+    if channels: 
+        command += ["-ac", str(channels)]
+    command += ["-f", muxer, "pipe:1"]
+
+    frame_size = sample_width * channels if sample_width else 1 
+    read_size = frames_per_chunk * frame_size if sample_width else 64 * 1024 
+
+    out_file = None 
+    if audio_path is not None: 
+        os.makedirs(os.path.dirname(audio_path) or ".", exist_ok=True) 
+        if sample_width is not None: 
+            out_file = wave.open(audio_path, "wb") 
+            out_file.setnchannels(channels) 
+            out_file.setsampwidth(sample_width) 
+            out_file.setframerate(sample_rate) 
+        else: 
+            out_file = open(audio_path, "wb") 
+
+    # stderr goes to a temp file so a chatty FFmpeg can never fill the pipe and stall us 
+    with tempfile.TemporaryFile() as stderr_file: 
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file) 
+        try: 
+            pending = b"" 
+            while True: 
+                data = process.stdout.read(read_size) 
+                if not data: 
+                    break 
+                if sample_width is not None: 
+                    # Only hand out whole frames, carry any partial frame over to the next read 
+                    data = pending + data 
+                    cut = len(data) - (len(data) % frame_size) 
+                    data, pending = data[:cut], data[cut:] 
+                    if not data: 
+                        continue 
+                if out_file is not None: 
+                    if sample_width is not None: 
+                        out_file.writeframesraw(data) 
+                    else: 
+                        out_file.write(data) 
+                yield data 
+        finally: 
+            process.stdout.close() 
+            return_code = process.wait() 
+            if out_file is not None: 
+                out_file.close() 
+
+        if return_code != 0: 
+            stderr_file.seek(0) 
+            error = stderr_file.read().decode("utf-8", errors="replace").strip() 
+            raise AudioExtractionError(f"FFmpeg exited with {return_code} for {video_file}: {error[-500:]}") 
+
+@instrumentation.instrumented("video_to_audio")
+def video_to_audio(video_file: str, job_id: str = None, sample_rate: int = None, channels: int = None, 
+                   codec: str = "pcm_s16le", out_dir: str = "audio"): 
     """
     Converts a given video file to audio, specifically to .wav format.
     
     The function will extract the audio from a given video file and save it
     to a .wav file in a directory named "audio". If the directory does not exist, 
-    it will be created.
+    it will be created. Only the audio stream is decoded, the video is never touched. 
+    The whole track is written before this returns, so the batch stages (chunking, speech 
+    detection, Whisper, IBM) start once extraction is done. Use stream_audio to consume the 
+    audio as it's decoded. 
 
     Args:
         video_file (str): The path to the video file to be converted. This path 
         can be either absolute or relative.
 
-    Returns:
-        None. The function saves the output audio file in the "audio" directory.
-    """
-    print(f"video_to_audio(videio_file: {video_file})")
-    os.makedirs("audio", exist_ok=True)
-    audio_path = f"./audio/output_audio_{TODAYS_DATE}.wav" 
-
-    video = VideoFileClip(video_file) 
-    audio = video.audio 
-    audio.write_audiofile(audio_path, codec="pcm_s16le") # Needed to convert to .wav fil
-    print(f"video_to_audio[audio_path: {audio_path}])")
-    return audio_path 
+        job_id (str): Identifies the job the audio belongs to, so concurrent jobs never write 
+        to the same file. A new id is generated when none is given. 
 
-def break_audio_into_chunks(audio_path: str, max_secs: int, api_name: str): 
-    """
-    Breaks an audio file into chunks of 'max_secs' seconds each and exports them as .wav files.
+        sample_rate (int): Output sample rate in Hz. None keeps the source sample rate. 
 
-    This function loads an audio file, segments it into 'max_secs' second intervals, and
-    saves each segment as a .wav file in an "audio" directory. If the "audio" 
-    directory does not exist, it will be created.
+        channels (int): Output channel count. None keeps the source channel count. 
 
-    Args:
-        audio_path (str): The path to the audio file to be segmented. This path 
-        can be either absolute or relative.
+        codec (str): FFmpeg audio codec, defaults to 16-bit PCM. 
 
-        max_secs (int): Represents the maximum amount of time the audio would have to broken down 
-        in order to fit the restrictions of the API being called. 
+        out_dir (str): Directory to write the audio to, "audio" unless a job has its own. 
 
     Returns:
-        list of str: A list containing the file paths of the saved output audio chunks. Each element
-        in the list corresponds to 'max_secs'-second chunk of the original audio file.
+        str: The path of the output audio file.
+
+    Raises:
+        AudioExtractionError: If FFmpeg exits with a non-zero status. 
     """
-    audio = AudioSegment.from_file(audio_path) 
-    length_audio = len(audio)
-    audio_chunks = []
-
-    # Time in milliseconds 
-    start_time = 0 
-    end_time = max_secs * 1000
-
-    i = 0 
-
-    # Creating 60 sec chunks 
-    while start_time < length_audio: 
-        chunk = audio[start_time:end_time] 
-        chunk_name = f"chunck{i}_{TODAYS_DATE}_{api_name}.wav"
-        # Exporting chunk 
-        chunk.export(f"./audio/{chunk_name}", format="wav") 
-        audio_chunks.append(f"./audio/{chunk_name}")
-        print(f"Processing chunk{i}. Start Time: {start_time/1000} secs.")
-        start_time += (max_secs * 1000)
-        end_time += (max_secs * 1000)
-        i += 1
-    return audio_chunks
+    print(f"video_to_audio(videio_file: {video_file})")
+    job_id = job_id or new_job_id() 
+    os.makedirs(out_dir, exist_ok=True)
+    audio_path = os.path.join(out_dir, f"output_audio_{job_id}.wav")
+
+    command = ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", video_file, "-vn", "-acodec", codec] 
+    if sample_rate: 
+        command += ["-ar", str(sample_rate)]
+    if channels: 
+        command += ["-ac", str(channels)]
+    command.append(audio_path) 
+
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) 
+    if result.returncode != 0: 
+        error = result.stderr.decode("utf-8", errors="replace").strip() 
+        raise AudioExtractionError(f"FFmpeg exited with {result.returncode} for {video_file}: {error[-500:]}") 
+    print(f"video_to_audio[audio_path: {audio_path}])")
+    instrumentation.count("bytes_in", instrumentation.file_size(video_file))
+    instrumentation.count("bytes_out", instrumentation.file_size(audio_path))
+    return audio_path 
 
 def get_api_credentials(credential_path: str): 
     config = configparser.ConfigParser() 
@@ -1,66 +1,21 @@
+import argparse
+import audio_chunker
 import audio_video_script as avs
 import configparser
-from datetime import datetime, timedelta
+import ibm_transcriber
+from datetime import datetime
 from ibm_watson import SpeechToTextV1 
 from ibm_watson.websocket import RecognizeCallback, AudioSource 
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from moviepy.video.io.VideoFileClip import VideoFileClip
 import os 
-from pydub import AudioSegment 
-import time 
-import threading 
-from tqdm import tqdm 
+import quota_ledger
+import speech_regions
+import transcript_cache
 # import whisper 
 # from whisper.utils import get_writer
 
 TODAYS_DATE = current_datetime = datetime.now().date()
-MAX_TIME = timedelta(hours=7, minutes=55, seconds=0)
-
-def read_total_duration(): 
-    """
-    Reads the total duration from a text file and returns it as a timedelta object. 
-
-    Returns:
-        timedelta: A timedelta object representing the total duration read from the file,
-        or a default duration of '00:00:00' if the file is missing or invalid.
-    """
-    try: 
-        with open("total_duration_ibm.txt", "r") as file: 
-            duration_str = file.read() 
-            hours, minutes, seconds = map(int, duration_str.split(":"))
-            print(f"duration_str: {duration_str}")
-            return timedelta(hours=hours, minutes=minutes, seconds=seconds)
-    except FileNotFoundError: 
-        return timedelta(hours=0, minutes=0, seconds=0)
-    
-def update_total_duration(duration: timedelta): 
-    """
-    Updates the total duration in a text file with the provided duration.
-
-    This function takes a timedelta object representing a duration and writes it to
-    a file named 'total_duration.txt' in the format 'HH:MM:SS' (hours, minutes, seconds).
-
-    Args:
-        duration (timedelta): The duration to be written to the file.
-
-    Returns:
-        None
-    """
-    hours, remainder = divmod(duration.seconds, 3600) 
-    minutes, seconds = divmod(remainder , 60)
-
-    with open("total_duration_ibm.txt", "w") as file: 
-        file.write(f"{hours:02}:{minutes:02}:{seconds:02}")
-
-class TotalDurationExceeded(Exception): 
-    """
-    Exception raised when the total duration exceeds a specified limit.
-
-    This exception is raised when the total duration of some process exceeds a predefined
-    threshold. It provides a clear indication that the process has exceeded its allowable
-    duration.
-    """
-    pass 
+IBM_MODEL = ibm_transcriber.IBM_MODEL
 
 def write_transcription_from_ibm(response, video_name): 
     """
@@ -102,18 +57,63 @@ def write_transcription_from_ibm(response, video_name):
 
     print(f"Trancriptions with metadata written to: transcriptions/{file_name}")
 
-def get_transcription_from_ibm(service, audio_chunks): 
-    # Getting Transcriptions w/ IBM Watson-Pretty Bad  
-    with open(audio_chunks[0], "rb") as audio_file: 
-        response = service.recognize(
-            audio=audio_file,
-            content_type="audio/wav", 
-            model="en-US_BroadbandModel"
-        ).get_result() 
+def transcribe_with_ibm(speech_to_text, audio_path: str, transcript_store=None, ledger=None, speech_timeline=None): 
+    """
+    Transcribes a whole audio file with IBM Watson, keeping within the free plan's limits.
+
+    The audio is broken into 60 second chunks (IBM's free plan limit) and every chunk is sent, 
+    several at a time. Chunks with a stored result are reused, and only the seconds of the 
+    chunks that are actually sent are reserved against the ledger's monthly budget, before 
+    anything is sent. 
+
+    Args:
+        speech_to_text (SpeechToTextV1): An authenticated IBM Speech to Text client.
+
+        audio_path (str): The path to the extracted .wav file.
 
-    return response 
+        transcript_store (TranscriptStore): Optional store of per chunk results.
 
-def main(): 
+        ledger (QuotaLedger): Optional shared quota ledger.
+
+        speech_timeline (SpeechTimeline): Optional speech regions of the audio. Only the speech is
+        sent then, and the word timestamps are mapped back onto the original timeline.
+
+    Returns:
+        dict: The merged IBM response covering the whole file.
+
+    Raises:
+        QuotaExceeded: If the chunks would go over the monthly budget. Nothing is sent then.
+    """
+    if speech_timeline is not None: 
+        if not speech_timeline.regions: 
+            return {"result_index": 0, "results": []}
+        audio_path = speech_timeline.condense(audio_path)
+
+    audio_chunks = audio_chunker.chunk_for_ibm(audio_path)
+    print(f"audio_chunks: {[chunk.path for chunk in audio_chunks]}")
+
+    response = ibm_transcriber.transcribe_chunks(
+        speech_to_text, 
+        audio_chunks, 
+        model=IBM_MODEL, 
+        store=transcript_store, 
+        audio_path=audio_path, 
+        ledger=ledger
+    )
+    if speech_timeline is not None: 
+        response = speech_timeline.map_ibm_response(response)
+    return response
+
+def main(video_path: str = "./video/JeffTeague.mp4", speech_only: bool = False): 
+    """
+    Transcribes a video with IBM Watson and writes the transcription to the repo.
+
+    Args:
+        video_path (str): The video to transcribe.
+
+        speech_only (bool): Only send the speech to IBM, skipping music and crowd noise. Needs 
+        tensorflow and tensorflow_hub for the audio classifier. 
+    """
     try: 
         # Getting Credentials 
         config = configparser.ConfigParser() 
@@ -133,52 +133,24 @@ def main():
     speech_to_text.set_service_url(api_url)
 
     # Stripping audio from video file:
-    video_path = "./video/JeffTeague.mp4"
-    avs.video_to_audio(video_path)
-
-    # Breaking audio into 60 second chunks to fit IBM's free plan usage. 
-    audio_chunks = avs.break_audio_into_chunks(f"./audio/output_audio_{TODAYS_DATE}.wav", 60)
-    print(f"audio_chunks: {audio_chunks}")
-
-    # Before calling API, making sure we haven't transcribed more than 475 minutes 
-    # worth of data so that we can still use the free tier
-    total_duration = read_total_duration() 
-    print(f"total_duration: {total_duration}")
-    print(f"MAX_TIME: {MAX_TIME}")
-
-    # Check if the total duration exceeds the threshold 
-    if (total_duration >= MAX_TIME): 
-        raise TotalDurationExceeded("Total duration exceeded 7 hours and 55 minutes. Stopping further processing.")
-
-    # Processing audio chunks 
-    for chunk_path in audio_chunks: 
-        chunk_duration = len(AudioSegment.from_file(chunk_path)) / 1000 # in seconds 
-        total_duration += timedelta(seconds=chunk_duration)
-
-    update_total_duration(total_duration) 
-
-    # Create a progress bar with unknown number of iterations 
-    progress_bar = tqdm(desc="Transcribing audio", unit=" ms", dynamic_ncols=True)
-
-    # Results to store transcription results 
-    response = [] 
-
-    # Start transcription thread  
-    transcription_thread = threading.Thread(target=lambda: response.append(get_transcription_from_ibm(speech_to_text, audio_chunks)))
-
-    # Starting threads 
-    transcription_thread.start() 
-
-    # Updating progress bar while bar is being fetched. 
-    while transcription_thread.is_alive(): 
-        time.sleep(0.1) 
-        progress_bar.update(1)
-
-    # Waiting for thread to close
-    transcription_thread.join()
-    progress_bar.close() 
+    audio_path = avs.video_to_audio(video_path)
+
+    # Re-runs on the same audio reuse the stored result and don't count against the quota 
+    transcript_store = transcript_cache.TranscriptStore() 
+    fingerprint = transcript_cache.fingerprint_audio(audio_path) 
+    response = transcript_store.get(fingerprint, IBM_MODEL, kind="json") 
+    if response is None: 
+        # With speech_only, music beds and crowd noise aren't sent, only the speech counts against 
+        # the monthly budget 
+        speech_timeline = None 
+        if speech_only: 
+            speech_timeline = speech_regions.detect_speech(audio_path) 
+            print(f"speech_regions savings: {speech_timeline.savings(ibm_transcriber.IBM_PROVIDER)}")
+        response = transcribe_with_ibm(
+            speech_to_text, audio_path, transcript_store, quota_ledger.get_default_ledger(), speech_timeline
+        ) 
+        transcript_store.put(fingerprint, IBM_MODEL, response, kind="json") 
 
-    response = response[0]
     # Print the transcription 
     for result in response["results"]: 
         print(result["alternatives"][0]["transcript"])
@@ -186,5 +158,9 @@ def main():
     write_transcription_from_ibm(response, "bench_pr_gone_horribly_wrong")
 
 if __name__ == "__main__": 
-    main()
+    parser = argparse.ArgumentParser(description="Transcribe a video with IBM Watson.")
+    parser.add_argument("video", nargs="?", default="./video/JeffTeague.mp4", help="Video file to transcribe")
+    parser.add_argument("--speech-only", action="store_true", help="Skip non-speech audio when transcribing")
+    args = parser.parse_args()
+    main(args.video, args.speech_only)
 
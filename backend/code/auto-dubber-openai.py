@@ -1,46 +1,31 @@
+import argparse
 import audio_video_script as avs 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime 
 # import google.cloud.translate 
-import elevenlabs 
-from google.cloud import translate 
-import html
+import dubbing_tts
+import google_translator
+import instrumentation
+import local_whisper
 import openai 
 import os
-import subprocess
+import pcm_buffer
+import quota_ledger
+import speech_regions
+import stage_manifest
+import subtitles
+import transcript_cache
+import translation_cache
+import video_renderer
+import whisper_transcriber
 
 TODAYS_DATE = datetime.now().date() 
-GOOGLES_MAX_TOKENS = 500000
 
 def get_video_name(video_file: str): 
     video_name = video_file.split("/")[-1].split(".")[0]
     print(f"get_video_name[video_name: {video_name}]")
     return video_name 
 
-def update_request_limit():
-    request_limit_tracker = "./code/rate_limits_openai.txt"
-    requests_made_str = ""
-    requests_made = 0 
-    try: 
-        with open(request_limit_tracker, "r") as file: 
-            requests_made_str = file.read().strip()
-    except FileNotFoundError: 
-        print("File Not Found. Cannot update request limit") 
-
-    requests_made = int(requests_made_str) + 1 
-    
-    with open(request_limit_tracker, "w") as file: 
-        file.write(str(requests_made))
-
-    return requests_made
-
-def check_request_limit(requests_made: int): 
-    return True if requests_made < 200 else False 
-
-class AudioFileTooLong(Exception): 
-    def __init__(self, message="File too large to transcribe. File size must be less than 25 MB"): 
-        self.message = message 
-        super().__init__(self.message) 
-
 def transcribe_audio_whisperai(audio_file_path: str): 
     with open(audio_file_path, "rb") as audio_file: 
         transcription = openai.Audio.transcribe(model="whisper-1", file=audio_file, response_format="srt") 
@@ -55,182 +40,252 @@ def write_transcription_to_file(srt_transcription: str, video_name: str):
 
 def turn_srt_file_to_paragraph(srt_file): 
     try: 
-        with open(srt_file, "r", encoding="utf-8") as file: 
-            lines = file.readlines() 
-            
-        paragraph = "" 
-        is_subtitle_block = False 
-
-        for line in lines: 
-            line = line.strip() # Check for blank line 
-            if not line:  
-                continue 
-            elif line.isdigit(): # Check if line number 
-                continue 
-            elif "-->" in line: # Check if time sequence 
-                continue 
-            else: # Subtitle line 
-                paragraph += f"{line} | "
-            
-        return paragraph.strip()
+        cues = subtitles.read_cues(srt_file) 
     except FileNotFoundError: 
         return "SRT file not found."
+    # One part per cue, a cue's lines are joined into one 
+    return subtitles.cues_to_paragraph(cues)
     
-def update_token_tracker(transcribed_paragraph: str):
-    tokens_transcribed =  len(transcribed_paragraph)
-    google_translate_api_tracker = "./token_tracker/google_translation_api.txt" 
-    with open(google_translate_api_tracker, "r") as file: 
-        tokens_transcribed_so_far = file.read().strip() 
-
-    total_tokens_transcribed = int(tokens_transcribed_so_far) + tokens_transcribed 
-
-    with open(google_translate_api_tracker, "w") as file: 
-        file.write(str(total_tokens_transcribed)) 
-
-    return total_tokens_transcribed
-
-class GoogleTokenLimitReached(Exception): 
-    def __init__(self, message="Google's Translate API has reached maxed token. Please try again later."): 
-        self.message = message 
-        super().__init__(self.message) 
-
-def write_translation_to_file(translated_text: str, video_name: str): 
-    file_path = f"./translated_text/{video_name}_translation.txt" 
+def write_translation_to_file(translated_text: str, video_name: str, language: str = None): 
+    # Each language gets its own file so a fan-out run never overwrites one language with another 
+    suffix = f".{language}" if language else ""
+    file_path = f"./translated_text/{video_name}_translation{suffix}.txt" 
     with open(file_path, 'w', encoding="utf-8") as file: 
         file.write(translated_text)
 
     return file_path 
 
-def google_translate_basic(text: str, target_language_code: str): 
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "./credentials/autodubber-f5336cc011ff.json"
-    from google.cloud import translate_v2 as translate 
-    translate_client = translate.Client() 
+def google_translate_basic(text: str, target_language_code: str, ledger=None): 
     if isinstance(text, bytes): 
         text = text.decode("utf-8")
     split_text = text.split("|")
-    translated_segments = [] 
-    for line in split_text: 
-        translation = translate_client.translate(line, target_language=target_language_code)
-        translated_segments.append(translation["translatedText"].strip())
-    # result = translate_client.translate(text, target_language=target_language_code)
-    # translation = result["translatedText"]
-    translated_text = " | ".join(translated_segments)
-    # Doing this so thing like &quot;No voy a cruzar el Pacífico&quot; won't be in the translation
-    decoded_text = html.unescape(translated_text) 
-    return decoded_text 
-
-def get_dubbed_audio(translated_text: str, video_name: str): 
-    filename = f"./translated_audio/{video_name}.wav"
+    # Each line is translated as its own segment and put back in its own slot, so Google 
+    # never gets the chance to move the pipes around. Lines already in the translation 
+    # memory are never sent at all, so they don't count against the ledger either. 
+    translations = google_translator.translate_segments(
+        split_text, 
+        target_language_code, 
+        cache=translation_cache.get_default_cache(), 
+        ledger=ledger
+    ) 
+    translated_segments = [translations[i] for i in range(len(split_text))]
+    return " | ".join(translated_segments)
+
+def get_dubbed_audio(translated_srt_file: str, video_name: str, total_ms: int = 0, ledger=None, language: str = None): 
+    suffix = f".{language}" if language else ""
+    filename = f"./translated_audio/{video_name}{suffix}.wav"
     elevenlabs_api_key = avs.get_api_credentials("./credentials/elevenlabs_creds.txt")
-    elevenlabs.set_api_key(elevenlabs_api_key)
-    audio = elevenlabs.generate(
-        text=translated_text,
+    cues = subtitles.read_cues(translated_srt_file) 
+    # Each subtitle is dubbed on its own and placed at its own time, so the dub lines up with the video 
+    return dubbing_tts.dub_cues(
+        cues, 
+        filename, 
+        dubbing_tts.ElevenLabsBackend(elevenlabs_api_key), 
         voice="Ryan", # Need to changle later to allow user to pick voice
-        model="eleven_multilingual_v2"
+        total_ms=total_ms, 
+        ledger=ledger
     )
-    elevenlabs.save(audio=audio, filename=filename)
     
-def make_srt_translation(srt_file: str, translated_text: str): 
-    srt_file_list = srt_file.split("/")
-    filename_split = srt_file.split("_") 
-    filename_split[-1] = "translation.srt"
-    out_file = "_".join(filename_split)
+def make_srt_translation(srt_file: str, translations, language: str = None): 
+    """
+    Writes the translated .srt next to the transcription, e.g. X_transcription.srt -> X_translation.srt, 
+    or X_translation.es-419.srt with a language. 
+
+    Every cue keeps its number and timing and gets the translation with its cue id, so nothing 
+    depends on how the lines of the file look. 
+
+    Args:
+        srt_file (str): The transcription .srt file.
+        translations (dict or str): {cue id: translated text}, or a translated paragraph from 
+        turn_srt_file_to_paragraph with one " | " separated part per cue.
+        language (str): Language code the file is named with.
+
+    Returns:
+        str: The path of the translated .srt file.
+    """
+    name = os.path.splitext(srt_file)[0]
+    if name.endswith("_transcription"): 
+        name = name[:-len("_transcription")]
+    suffix = f".{language}" if language else ""
+    out_file = f"{name}_translation{suffix}.srt"
     print(f"out_file: {out_file}")
 
     try: 
-        with open(srt_file, "r", encoding="utf-8") as file: 
-            lines = file.readlines() 
-
-        translated_text_split = translated_text.split("|")
-        translated_text_split = [line.strip() for line in translated_text_split]
-        print(f"translated_text_split: {translated_text_split}")
-
-        with open(out_file, "w", encoding="utf-8") as file: 
-            index = 0 
-            for line in lines: 
-                line = line.strip()
-                if not line: 
-                    continue
-                elif line.isdigit():
-                    file.write(f"{line}\n")
-                elif  "-->" in line: 
-                    file.write(f"{line}\n")
-                else: 
-                    file.write(f"{translated_text_split[index]}\n\n")
-                    index += 1 
-                    # if index < len(translated_text_split):
-                    #     file.write(f"{translated_text_split[index]}\n\n")
-                    #     index += 1 
-                    # else:
-                    #     print(f"Warning: No corresponding translation found for subtitle line {index + 1}") 
-        return out_file 
+        cues = subtitles.read_cues(srt_file) 
     except FileNotFoundError: 
         return "SRT file not found."
 
-def add_subtitles_to_video(video_file, translated_srt_file, output_file): 
-    command = [
-        "ffmpeg", # Runs FFmpeg software
-        "-i", video_file, # Input file
-        "-vf", f"subtitles={translated_srt_file}", # Apply video filter w/ specified SRT file
-        output_file
-    ]
-    subprocess.run(command) 
+    if isinstance(translations, str): 
+        translations = {cue.id: part.strip() for cue, part in zip(cues, translations.split("|"))}
+    return subtitles.save_cues(out_file, subtitles.apply_translations(cues, translations))
+
+def print_render_progress(progress): 
+    if progress.percent is not None: 
+        print(f"add_subtitles_to_video[{progress.percent:.1f}% speed: {progress.speed}]")
+
+def add_subtitles_to_video(video_file, translated_srt_file, output_file, dub_file=None, subtitle_mode="burn", speed="fast"): 
+    # Subtitles and dub go on in one FFmpeg pass. "soft" subtitles skip re-encoding the video entirely. 
+    return video_renderer.render_video(
+        video_file, 
+        output_file, 
+        subtitles_path=translated_srt_file, 
+        subtitle_mode=subtitle_mode, 
+        dub_path=dub_file, 
+        speed=speed, 
+        on_progress=print_render_progress
+    )
 
-def main(): 
+STAGES = ("extract_audio", "transcribe", "translate", "synthesize", "render")
+
+def main(video_file: str = "./video/BadFriendsPod.mp4", target_languages=("es-419",), rerun=None, dub: bool = False, 
+         local_whisper_model: str = None, speech_only: bool = False): 
+    """
+    Dubs one video into any number of languages, checkpointing every stage so a re-run only redoes what changed.
+
+    The video's audio is extracted and transcribed once, then every language is translated from that 
+    one transcript concurrently, dubbed, and all of them are rendered in one FFmpeg pass that decodes 
+    the video a single time. Outputs are named by language code. 
+
+    Each stage is recorded in a manifest with the content hashes of its input files and its settings. 
+    A re-run skips every stage whose inputs are unchanged and picks up at the first one that isn't 
+    (e.g. the render, if FFmpeg failed last time), so nothing is extracted or sent to an API twice. 
+
+    Args:
+        video_file (str): The video to dub.
+
+        target_languages (list of str): Languages to translate into. es-419 is Latin American Spanish (Not Spain). 
+
+        rerun (list of str): Stages from STAGES to run again even if their inputs are unchanged. 
+
+        dub (bool): Also synthesize a dub per language and put it on the videos. 
+
+        local_whisper_model (str): Transcribe with this Whisper model on the local CPUs (e.g. "base") 
+        instead of the OpenAI API, so backlog videos don't use up the API quota. 
+
+        speech_only (bool): Only send the speech to Whisper, skipping music and crowd noise. Needs 
+        tensorflow and tensorflow_hub for the audio classifier. 
+
+    Returns:
+        dict: {language: path of the rendered video}.
+    """
+    target_languages = list(target_languages)
     API_KEY_OPENAI = avs.get_api_credentials("./credentials/openai_credentials.txt")
     print(f"API_KEY: {API_KEY_OPENAI}")
     openai.api_key = API_KEY_OPENAI 
-    MAX_MB_FOR_VIDEO = 25 
-    video_file = "./video/BadFriendsPod.mp4"
     video_name = get_video_name(video_file)
-    print(f"main[video_name: {video_name}]")
-    todays_date = avs.TODAYS_DATE
+    print(f"main[video_name: {video_name}, target_languages: {target_languages}]")
+
+    # Usage of every API is tracked in one ledger shared by all jobs. Work is only started once 
+    # its quota has been reserved, so a job never runs out halfway through. 
+    ledger = quota_ledger.get_default_ledger() 
+    manifest = stage_manifest.StageManifest(video_name, rerun=rerun) 
+    whisper_backend = local_whisper.get_default_pool(local_whisper_model) if local_whisper_model else None 
+    whisper_model = whisper_backend.model if whisper_backend is not None else "whisper-1" 
+
+    def extract_audio(): 
+        # The audio is named by the video's content hash, so a forced re-run overwrites the same file 
+        # instead of leaving one more .wav behind each time, and different videos never share a file. 
+        return {"audio": avs.video_to_audio(video_file, job_id=manifest.file_hash(video_file))}
+
+    audio_file = manifest.run("extract_audio", extract_audio, inputs={"video": video_file})["audio"]
+
+    def transcribe(): 
+        # With speech_only, only the speech is sent to Whisper, music beds and crowd noise are skipped 
+        # and the cues are mapped back onto the video's timeline. Long audio is compressed and split 
+        # into overlapping chunks so it fits under Whisper's 25 MB cap. 
+        speech_timeline = None 
+        if speech_only: 
+            speech_timeline = speech_regions.detect_speech(audio_file) 
+            print(f"speech_regions savings: {speech_timeline.savings('openai_whisper')}")
+        transcription = whisper_transcriber.transcribe_long_audio(
+            audio_file, 
+            backend=whisper_backend, 
+            store=transcript_cache.TranscriptStore(), 
+            ledger=ledger, 
+            speech_timeline=speech_timeline
+        )
+        return {"srt": write_transcription_to_file(transcription, video_name)}
+
+    srt_file = manifest.run(
+        "transcribe", transcribe, inputs={"audio": audio_file}, params={"model": whisper_model, "speech_only": speech_only}
+    )["srt"]
+    cues = subtitles.read_cues(srt_file) 
+
+    def translate(language): 
+        def run(): 
+            # Every cue is translated as one segment and comes back keyed by its cue id, so the 
+            # translation can't drift out of line. 
+            translations = google_translator.translate_segments(
+                subtitles.cue_texts(cues), 
+                language, 
+                cache=translation_cache.get_default_cache(), 
+                ledger=ledger
+            ) 
+            translation = " | ".join(translations[cue.id] for cue in cues) 
+            return {
+                "translated_text": write_translation_to_file(translation, video_name, language), 
+                "translated_srt": make_srt_translation(srt_file, translations, language), 
+            }
+
+        return manifest.run(
+            f"translate.{language}", 
+            run, 
+            inputs={"srt": srt_file}, 
+            params={"language": language, "engine": google_translator.ENGINE_NAME}
+        )["translated_srt"]
+
+    with ThreadPoolExecutor(max_workers=len(target_languages)) as executor: 
+        translated_srt_files = dict(zip(target_languages, executor.map(translate, target_languages)))
+    print(f"translation_cache: {translation_cache.get_default_cache().stats()}")
+    print(f"quota usage: {ledger.usage('openai_whisper')} {ledger.usage('google_translate')}")
+
+    def synthesize(language): 
+        total_ms = pcm_buffer.open_buffer(audio_file).duration_ms 
+
+        def run(): 
+            return {"dub": get_dubbed_audio(translated_srt_files[language], video_name, total_ms, ledger, language)}
+
+        return manifest.run(
+            f"synthesize.{language}", 
+            run, 
+            inputs={"translated_srt": translated_srt_files[language]}, 
+            params={"voice": "Ryan", "model": dubbing_tts.TTS_MODEL}
+        )["dub"]
+
+    dub_files = {}
+    if dub: 
+        # One language at a time, each dub already uses all of ElevenLabs' concurrent requests 
+        dub_files = {language: synthesize(language) for language in target_languages}
+
+    def render(): 
+        targets = [
+            video_renderer.RenderTarget(
+                f"./video/{video_name}_{language}_translated_subtitles.mp4", 
+                translated_srt_files[language], 
+                dub_files.get(language)
+            )
+            for language in target_languages
+        ]
+        # Subtitles and dubs go on in one FFmpeg pass for every language. 
+        output_files = video_renderer.render_videos(video_file, targets, on_progress=print_render_progress) 
+        return dict(zip(target_languages, output_files))
+
+    render_inputs = {"video": video_file}
+    render_inputs.update({f"translated_srt.{language}": path for language, path in translated_srt_files.items()})
+    render_inputs.update({f"dub.{language}": path for language, path in dub_files.items()})
+    return manifest.run("render", render, inputs=render_inputs, params={"subtitle_mode": "burn", "speed": "fast"})
 
-    requests_made_so_far = update_request_limit() 
-    is_within_limits = check_request_limit(requests_made_so_far)
-    
-    if is_within_limits: 
-        audio_file = avs.video_to_audio(video_file) 
-        # audio_file = F"./audio/output_audio_{TODAYS_DATE}.wav"
-        # print(f"main[audio_file: {audio_file}]")
-        file_size = os.path.getsize(audio_file) / (1024 * 1024) 
-        print(f"audio_file size: {file_size} MB\n\n")
-
-        if file_size > MAX_MB_FOR_VIDEO: 
-            raise AudioFileTooLong 
-        
-        transcription = transcribe_audio_whisperai(audio_file) # UNCOMMENT LATER
-        srt_file = write_transcription_to_file(transcription, video_name) 
-        srt_paragraph = turn_srt_file_to_paragraph(srt_file)
-        print(f"srt_paragraph: {srt_paragraph}\n\n") 
-
-        total_tokens_transcribed = update_token_tracker(srt_paragraph)
-        print(f"total_tokens_transcribed: {total_tokens_transcribed}\n\n")
-
-        if total_tokens_transcribed >= GOOGLES_MAX_TOKENS: 
-            raise GoogleTokenLimitReached  
-        
-        translation = google_translate_basic(srt_paragraph, "es-419") # es-419 translates to Latin American Spanish (Not Spain) 
-        print(f"translation: {translation}") 
-        translated_file = write_translation_to_file(translation, video_name) 
-
-        # get_dubbed_audio(translation, video_name)
-
-        # srt_file_path = "./transcriptions/2023-09-25_CoachPrime_transcription.srt"
-        with open(translated_file, "r", encoding="utf-8") as file: 
-            translated_text = file.read() 
-
-        # print(f"translated_text: {translated_text}")
-        
-        translated_srt_file = make_srt_translation(srt_file, translated_text)
-        subtitled_video = f"./video/{video_name}_translated_subtitles.mp4"
-
-        add_subtitles_to_video(video_file, translated_srt_file, subtitled_video)
-
-        
 if __name__ == "__main__": 
-    main() 
-
-# Issue: Google translate is moving the pipe around, which then throws off the translation and the 
-#        subtitles. Thinking about using open AI to get the translation. Might be the easiest move. 
-
+    parser = argparse.ArgumentParser(description="Transcribe, translate and subtitle a video.")
+    parser.add_argument("video", nargs="?", default="./video/BadFriendsPod.mp4", help="Video file to dub")
+    parser.add_argument("--language", nargs="+", default=["es-419"], help="Target language codes")
+    parser.add_argument("--dub", action="store_true", help="Also synthesize a dubbed audio track per language")
+    parser.add_argument("--local-whisper", metavar="MODEL", help="Transcribe with this Whisper model locally, not the API")
+    parser.add_argument("--speech-only", action="store_true", help="Skip non-speech audio when transcribing")
+    parser.add_argument("--rerun", nargs="+", choices=STAGES, default=[], help="Stages to run again regardless")
+    parser.add_argument("--metrics-jsonl", help="Append a json line per stage span to this file")
+    parser.add_argument("--metrics-prometheus-dir", help="Keep Prometheus text files of the spans in this directory")
+    parser.add_argument("--profile", help="Comma separated span names to run under cProfile, or 'all'")
+    args = parser.parse_args()
+    instrumentation.configure(args.metrics_jsonl, args.metrics_prometheus_dir, args.profile)
+    main(args.video, args.language, args.rerun, args.dub, args.local_whisper, args.speech_only) 
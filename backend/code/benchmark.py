@@ -0,0 +1,307 @@
+import argparse
+import audio_chunker
+from concurrent.futures import ProcessPoolExecutor
+import fake_providers
+import ibm_transcriber
+import instrumentation
+import job_scheduler
+import json
+import multiprocessing
+import os
+import pcm_buffer
+import quota_ledger
+import shutil
+import subprocess
+import sys
+import time
+
+# Run from the backend directory, like the dubbing scripts: python code/benchmark.py
+BENCHMARK_DIR = "./cache/benchmark"
+BASELINE_PATH = "./benchmarks/baseline.json"
+SAMPLE_VIDEOS = {
+    "CoachPrime": "./video/CoachPrime.mp4",
+    "JeffTeague": "./video/JeffTeague.mp4",
+}
+SYNTHETIC_MINUTES = {
+    "synthetic-10m": 10,
+    "synthetic-60m": 60,
+    "synthetic-180m": 180,
+}
+INPUTS = list(SAMPLE_VIDEOS) + list(SYNTHETIC_MINUTES)
+# A stage regresses when its throughput drops, or its peak memory grows, by more than this fraction
+TOLERANCE = 0.1
+# Stages quicker than this are all overhead and noise, their throughput isn't compared
+MIN_COMPARABLE_SECS = 0.5
+
+def make_synthetic_video(minutes: int, out_dir: str = os.path.join(BENCHMARK_DIR, "inputs")):
+    """
+    Generates a test pattern video with a tone for audio, 'minutes' long, or reuses the one made before.
+
+    Returns:
+        str: The path of the .mp4 file.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    video_path = os.path.join(out_dir, f"synthetic_{minutes}m.mp4")
+    if os.path.exists(video_path):
+        return video_path
+    print(f"make_synthetic_video[minutes: {minutes}]: Generating {video_path}")
+    temp_path = f"{video_path}.tmp"
+    command = [
+        "ffmpeg", "-nostdin", "-v", "error", "-y",
+        "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25",
+        "-f", "lavfi", "-i", "sine=frequency=220:beep_factor=4:sample_rate=44100",
+        "-t", str(minutes * 60),
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-c:a", "aac",
+        "-f", "mp4", temp_path
+    ]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"FFmpeg could not generate {video_path}: {error[-500:]}")
+    os.replace(temp_path, video_path)
+    return video_path
+
+def input_path(name: str):
+    if name in SAMPLE_VIDEOS:
+        return SAMPLE_VIDEOS[name]
+    return make_synthetic_video(SYNTHETIC_MINUTES[name])
+
+def transcribe_ibm(job: dict):
+    """Benchmark only stage: the chunked IBM transcription of auto-dubber-ibm.py, against the IBM stand-in."""
+    from ibm_cloud_sdk_core.authenticators import NoAuthAuthenticator
+    from ibm_watson import SpeechToTextV1
+    service = SpeechToTextV1(authenticator=NoAuthAuthenticator())
+    service.set_service_url(job["options"]["ibm_service_url"])
+    chunks = audio_chunker.chunk_for_ibm(
+        job["artifacts"]["audio_path"],
+        out_dir=os.path.join(job["work_dir"], "ibm_chunks")
+    )
+    response = ibm_transcriber.transcribe_chunks(service, chunks, ledger=quota_ledger.get_default_ledger())
+    response_path = os.path.join(job["work_dir"], "transcription_ibm.json")
+    with open(response_path, "w", encoding="utf-8") as file:
+        json.dump(response, file)
+    return {"ibm_response_path": response_path}
+
+def run_input(name: str, video_file: str, languages, options: dict, run_dir: str, metrics_path: str):
+    """
+    Runs every pipeline stage on one input, in order, inside 'run_dir'.
+
+    Meant to run in a process of its own, so the peak memory recorded is this input's alone and the
+    caches under ./cache start out cold.
+
+    Returns:
+        float: Seconds of audio in the input.
+    """
+    os.chdir(run_dir)
+    instrumentation.configure(jsonl_path=metrics_path)
+    # The stand-ins do the rate limiting. The free tier ledger would pace, or refuse, a 3 hour input.
+    quota_ledger.set_default_ledger(
+        quota_ledger.QuotaLedger(limits={provider: [] for provider in quota_ledger.PROVIDER_LIMITS})
+    )
+    stages = list(job_scheduler.DEFAULT_STAGES)
+    if options.get("ibm_service_url"):
+        position = [stage.name for stage in stages].index("transcribe") + 1
+        stages.insert(
+            position,
+            job_scheduler.Stage("transcribe_ibm", transcribe_ibm, job_scheduler.NETWORK, ibm_transcriber.IBM_PROVIDER)
+        )
+
+    job = job_scheduler.Job(video_file, languages, job_id=name, options=options)
+    for stage in stages:
+        outputs = job_scheduler.run_stage(stage.name, stage.func, job.as_dict())
+        job.record(stage.name, "done", outputs)
+    return pcm_buffer.open_buffer(job.artifacts["audio_path"]).duration_ms / 1000
+
+def summarize_stages(metrics_path: str, name: str, audio_secs: float):
+    """Reads the stage spans of one input back from the metrics file."""
+    stages = {}
+    with open(metrics_path, "r", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            if record["parent"] is not None or not record["span"].startswith("stage."):
+                continue
+            if record["labels"].get("job") != name:
+                continue
+            stages[record["span"][len("stage."):]] = {
+                "wall_s": record["wall_s"],
+                "cpu_s": record["cpu_s"],
+                # Audio seconds processed per wall second
+                "throughput": round(audio_secs / record["wall_s"], 3) if record["wall_s"] else None,
+                # ffmpeg and the chunk exporters are children, their peak counts as much as ours
+                "peak_rss_bytes": max(record["peak_rss_bytes"] or 0, record["children_peak_rss_bytes"] or 0),
+                "api_calls": record["api_calls"],
+                "retries": record["retries"],
+                "bytes_in": record["bytes_in"],
+                "bytes_out": record["bytes_out"],
+            }
+    return stages
+
+def run_benchmark(inputs=INPUTS, languages=("es-419",), dub: bool = False, with_ibm: bool = False,
+                  profiles: dict = None):
+    """
+    Runs the full pipeline on every input against local stand-ins for all the providers.
+
+    Args:
+        inputs (list of str): Names from INPUTS.
+
+        languages (list of str): Target languages every input is translated (and dubbed) into.
+
+        dub (bool): Also run the synthesize stage.
+
+        with_ibm (bool): Also transcribe with IBM, as an extra transcribe_ibm stage.
+
+        profiles (dict): {provider: ProviderProfile} for the stand-ins, see fake_providers.
+
+    Returns:
+        dict: The results, {"created", "settings", "inputs": {name: {...}}}, ready to save or compare.
+    """
+    results = {
+        "created": time.time(),
+        "settings": {
+            "languages": list(languages),
+            "dub": dub,
+            "ibm": with_ibm,
+            "profiles": {provider: profile._asdict() for provider, profile in (profiles or {}).items()},
+        },
+        "inputs": {},
+    }
+    with fake_providers.FakeProviders(profiles) as providers:
+        for name in inputs:
+            video_file = os.path.abspath(input_path(name))
+            run_dir = os.path.abspath(os.path.join(BENCHMARK_DIR, "runs", name))
+            shutil.rmtree(run_dir, ignore_errors=True)
+            os.makedirs(run_dir)
+            metrics_path = os.path.join(run_dir, "metrics.jsonl")
+            options = {**providers.job_options(), "dub": dub}
+            if with_ibm:
+                options["ibm_service_url"] = providers.ibm_service_url
+
+            providers.reset_stats()
+            started = time.perf_counter()
+            # A fresh process per input, spawned rather than forked from a process running server threads
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                audio_secs = executor.submit(
+                    run_input, name, video_file, list(languages), options, run_dir, metrics_path
+                ).result()
+            wall_s = time.perf_counter() - started
+
+            results["inputs"][name] = {
+                "audio_secs": audio_secs,
+                "wall_s": round(wall_s, 3),
+                "throughput": round(audio_secs / wall_s, 3),
+                "stages": summarize_stages(metrics_path, name, audio_secs),
+                "provider_requests": providers.stats(),
+            }
+            print(f"run_benchmark[input: {name}, audio_secs: {audio_secs:.1f}, wall_s: {wall_s:.1f}]")
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE):
+    """
+    Compares results with a baseline, stage by stage.
+
+    A stage regresses when its throughput falls, or its peak memory rises, by more than 'tolerance',
+    or when it makes more API calls than it did. Inputs and stages missing from either side are skipped.
+
+    Returns:
+        list of str: One line per regression, empty when there are none.
+    """
+    regressions = []
+    for name, current in results["inputs"].items():
+        previous = baseline.get("inputs", {}).get(name)
+        if previous is None:
+            continue
+        for stage, now in current["stages"].items():
+            before = previous["stages"].get(stage)
+            if before is None:
+                continue
+            if (before["wall_s"] >= MIN_COMPARABLE_SECS and now["throughput"] is not None
+                    and now["throughput"] < before["throughput"] * (1 - tolerance)):
+                regressions.append(
+                    f"{name} {stage}: throughput {before['throughput']:.2f} -> {now['throughput']:.2f} audio s/s"
+                )
+            if before["peak_rss_bytes"] and now["peak_rss_bytes"] > before["peak_rss_bytes"] * (1 + tolerance):
+                regressions.append(
+                    f"{name} {stage}: peak memory {before['peak_rss_bytes'] / 2**20:.0f} -> "
+                    f"{now['peak_rss_bytes'] / 2**20:.0f} MB"
+                )
+            if now["api_calls"] > before["api_calls"]:
+                regressions.append(f"{name} {stage}: API calls {before['api_calls']} -> {now['api_calls']}")
+    return regressions
+
+def print_report(results: dict, baseline: dict = None):
+    baseline = baseline or {}
+    for name, current in results["inputs"].items():
+        previous = baseline.get("inputs", {}).get(name, {}).get("stages", {})
+        print(f"\n{name}: {current['audio_secs']:.0f} s of audio in {current['wall_s']:.1f} s "
+              f"({current['throughput']:.2f} audio s/s)")
+        print(f"  {'stage':<16}{'wall s':>10}{'audio s/s':>12}{'peak MB':>10}{'API calls':>11}{'retries':>9}{'vs baseline':>13}")
+        for stage, now in current["stages"].items():
+            change = ""
+            before = previous.get(stage)
+            if before is not None and before["throughput"] and now["throughput"] is not None:
+                change = f"{100 * (now['throughput'] / before['throughput'] - 1):+.1f}%"
+            throughput = f"{now['throughput']:.2f}" if now["throughput"] is not None else "-"
+            print(f"  {stage:<16}{now['wall_s']:>10.2f}{throughput:>12}{now['peak_rss_bytes'] / 2**20:>10.0f}"
+                  f"{now['api_calls']:>11}{now['retries']:>9}{change:>13}")
+
+def save_results(results: dict, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    os.replace(temp_path, path)
+    return path
+
+def _provider_settings(parser, settings, field: str, cast):
+    """Parses repeated PROVIDER=VALUE options into {provider: value}."""
+    values = {}
+    for setting in settings or []:
+        provider, _, value = setting.partition("=")
+        if provider not in fake_providers.DEFAULT_PROFILES or not value:
+            parser.error(f"--{field} expects PROVIDER=VALUE with PROVIDER one of {list(fake_providers.DEFAULT_PROFILES)}")
+        values[provider] = cast(value)
+    return values
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dubbing pipeline against local stand-in providers.")
+    parser.add_argument("--inputs", nargs="+", choices=INPUTS, default=INPUTS, help="Inputs to run")
+    parser.add_argument("--language", nargs="+", default=["es-419"], help="Target language codes")
+    parser.add_argument("--dub", action="store_true", help="Also benchmark the synthesize stage")
+    parser.add_argument("--ibm", action="store_true", help="Also benchmark IBM transcription")
+    parser.add_argument("--latency", action="append", help="PROVIDER=SECS fixed latency per request, repeatable")
+    parser.add_argument("--rpm", action="append", help="PROVIDER=N requests per minute before 429s, repeatable")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed fractional slowdown")
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "results.json"), help="Where to save the results")
+    args = parser.parse_args()
+
+    profiles = dict(fake_providers.DEFAULT_PROFILES)
+    for provider, latency in _provider_settings(parser, args.latency, "latency", float).items():
+        profiles[provider] = profiles[provider]._replace(latency_secs=latency)
+    for provider, rpm in _provider_settings(parser, args.rpm, "rpm", int).items():
+        profiles[provider] = profiles[provider]._replace(requests_per_minute=rpm)
+
+    results = run_benchmark(args.inputs, args.language, dub=args.dub, with_ibm=args.ibm, profiles=profiles)
+    save_results(results, args.output)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+    print_report(results, baseline)
+    if args.save_baseline:
+        print(f"\nBaseline saved to {save_results(results, args.baseline)}")
+        return
+    if baseline is None:
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to store one")
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("\nNo regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,226 @@
-import librosa 
-import numpy as np 
-import soundfile as sf 
-import tensorflow as tf 
-import tensorflow_hub as hub 
-
-model = hub.load('https://tfhub.dev/google/yamnet/1')
-
-def load_and_convert2mono(audio_file: str): 
-    yamnet_sample_rate = 16000
-    # Loads the audio_file at its native sample rate, in stereo 
-    audio, sr = librosa.load(audio_file, sr=None, mono=False) 
-    # Convert audio from stereo to mono 
-    mono_audio = librosa.to_mono(audio) 
-    # Resample the audio to 16000 Hz for YAMNet's preferred input reqs
-    resampled_audio = librosa.resample(y=mono_audio, orig_sr=sr, target_sr=yamnet_sample_rate)
-    return resampled_audio, yamnet_sample_rate
-
-def get_audio_event_data(audio_file, window_size=1): 
-    filepath = "./code/output.txt"
-    resampled_audio, sample_rate = load_and_convert2mono(audio_file)
-
-    # Making sure audio input is infact mono with a sample_rate of 16000 Hz 
-    assert len(resampled_audio.shape) == 1, "Only mono audio is supported." 
-    assert sample_rate == 16000, "Only 16,000 Hz sample rate is supported." 
-
-    # Reshape audio data to expected input shape of YAMNNet 
-    # input_batch = np.reshape(resampled_audio, (1, -1))
-    
-    # Run inference 
-    scores, embeddings, spectrogram = model(resampled_audio) 
-    scores = scores.numpy() 
-    with open(filepath, "w") as file: 
-        file.write(f"scores.shape: {scores.shape}\n\n")
-    spectrogram = spectrogram.numpy() 
-
-    with open("./code/yamnet_class_map.csv", 'r') as file: 
-        next(file) 
-        class_names = file.readlines() 
-
-    # Internally, the model extracts "frames" from the audio signal and processes batches of these frames. 
-    # This version of the model uses frames that are 0.96 second long and extracts one frame every 0.48 seconds 
-    # Source: https://www.tensorflow.org/tutorials/audio/transfer_learning_audio
-    frame_rate = 2.08 # (! Frame / .48 Secs)
-    frames_per_window = int(frame_rate * window_size )
-
-    with open(filepath, "a") as file: 
-        for start in range(0, scores.shape[0], frames_per_window): 
-            # Average score in selected window 
-            end = min(start + frames_per_window, scores.shape[1])
-            file.write(f"Start: {start} | End: {end}\n")
-            avg_score = np.mean(scores[start:end, :], axis=0)
-            # file.write(f"scores[start:end, :] - {scores[start:end, :]}\n")
-            # file.write(f"avg_score: {avg_score}\n")
-
-            # Find class with highest average score in selected window 
-            class_id = np.argmax(avg_score) 
-            file.write(f"class_id: {class_id}\n")
-            class_name = class_names[class_id]
-            file.write(f"class_name: {class_name}\n")
-            class_score = avg_score[class_id]
-
-            # Convert frame number to time 
-            start_time = start * 0.48 
-            end_time = start_time + window_size
-            # start_time = start / frame_rate 
-            # end_time = end / frame_rate 
-
-            # Prints the dominant sound event for that window. 
-            file.write(f"Time {start_time:.2f} to {end_time:.2f}: {class_name.strip()}\n\n")
-
-        print("Audio event data captured")
-
-get_audio_event_data("./audio/output_audio_2023-09-26.wav", window_size=1)
+import csv
+import functools
+import numpy as np
+import os
+import pcm_buffer
+import shutil
+import threading
+
+# TensorFlow and TensorFlow Hub take seconds to import, so they're only imported once the model is
+# actually needed, which keeps importing this module cheap.
+YAMNET_HANDLE = "https://tfhub.dev/google/yamnet/1"
+# A SavedModel copy of YAMNet. Once it's there the model loads without any network access.
+YAMNET_MODEL_DIR = os.environ.get("YAMNET_MODEL_DIR", "./models/yamnet")
+
+YAMNET_SAMPLE_RATE = 16000
+# Internally, the model extracts "frames" from the audio signal and processes batches of these frames.
+# This version of the model uses frames that are 0.96 second long and extracts one frame every 0.48 seconds
+# Source: https://www.tensorflow.org/tutorials/audio/transfer_learning_audio
+FRAME_HOP_SECS = 0.48
+FRAME_LENGTH_SECS = 0.96
+FRAME_HOP_SAMPLES = int(FRAME_HOP_SECS * YAMNET_SAMPLE_RATE)
+CLASS_MAP_PATH = "./code/yamnet_class_map.csv"
+# Longest stretch of audio sent through the model in one call when classifying many files
+MAX_BATCH_SECS = 3600
+
+# One row per window: when it starts and ends, its dominant class and that class' average score
+EVENT_DTYPE = np.dtype([("start_s", "<f4"), ("end_s", "<f4"), ("class_id", "<i2"), ("score", "<f4")])
+
+_model = None
+_model_lock = threading.Lock()
+
+def load_model(model_dir: str = YAMNET_MODEL_DIR):
+    """
+    Loads YAMNet from the local SavedModel directory, fetching it from TensorFlow Hub only the first time.
+
+    The hub download is saved to 'model_dir', so later loads, in any process, are offline.
+    """
+    import tensorflow as tf
+    if os.path.exists(os.path.join(model_dir, "saved_model.pb")):
+        return tf.saved_model.load(model_dir)
+    import tensorflow_hub as hub
+    print(f"load_model[model_dir: {model_dir}]: Not cached, downloading {YAMNET_HANDLE}")
+    model = hub.load(YAMNET_HANDLE)
+    os.makedirs(os.path.dirname(os.path.abspath(model_dir)), exist_ok=True)
+    temp_dir = f"{model_dir}.{os.getpid()}.tmp"
+    tf.saved_model.save(model, temp_dir)
+    try:
+        os.replace(temp_dir, model_dir)
+    except OSError:
+        # Another process cached it first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return model
+
+def get_model():
+    """Returns this process' YAMNet model, loading and warming it up on first use."""
+    global _model
+    with _model_lock:
+        if _model is None:
+            model = load_model()
+            # The first call traces the graph, so it's paid here once instead of on the first real batch
+            model(np.zeros(YAMNET_SAMPLE_RATE, dtype=np.float32))
+            _model = model
+        return _model
+
+def init_worker():
+    """Process pool initializer, so each worker loads the model once before taking any jobs."""
+    get_model()
+
+@functools.lru_cache(maxsize=None)
+def load_class_names(class_map_path: str = CLASS_MAP_PATH):
+    """Returns YAMNet's display names, indexed by class id. The class map is only read once."""
+    with open(class_map_path, "r", newline="", encoding="utf-8") as file:
+        return tuple(row["display_name"] for row in csv.DictReader(file))
+
+def load_and_convert2mono(audio_file: str):
+    # The shared mono 16 kHz buffer (YAMNet's preferred input), the same one Whisper's chunks are cut from
+    buffer = pcm_buffer.derive(audio_file, YAMNET_SAMPLE_RATE, 1)
+    return buffer.read_mono(), YAMNET_SAMPLE_RATE
+
+def summarize_scores(scores, window_size: float = 1, duration_s: float = None):
+    """
+    Finds the dominant sound event in every window of YAMNet's frame scores.
+
+    All the window averages come out of a single cumulative sum over the frames, rather than a
+    Python loop per window. The last window is averaged over however many frames it has.
+
+    Args:
+        scores (numpy.ndarray): YAMNet's (frames, classes) scores for one file.
+
+        window_size (float): Window length in seconds, rounded to a whole number of frames.
+
+        duration_s (float): Length of the audio, so the last window doesn't end past it.
+
+    Returns:
+        numpy.ndarray: An EVENT_DTYPE structured array, one row per window.
+    """
+    num_frames = scores.shape[0]
+    frames_per_window = max(1, int(round(window_size / FRAME_HOP_SECS)))
+    starts = np.arange(0, num_frames, frames_per_window)
+    ends = np.minimum(starts + frames_per_window, num_frames)
+
+    cumulative = np.zeros((num_frames + 1, scores.shape[1]), dtype=np.float64)
+    np.cumsum(scores, axis=0, out=cumulative[1:])
+    averages = (cumulative[ends] - cumulative[starts]) / (ends - starts)[:, None]
+    class_ids = np.argmax(averages, axis=1)
+
+    events = np.empty(len(starts), dtype=EVENT_DTYPE)
+    events["start_s"] = starts * FRAME_HOP_SECS
+    events["end_s"] = (ends - 1) * FRAME_HOP_SECS + FRAME_LENGTH_SECS
+    if duration_s is not None:
+        events["end_s"] = np.minimum(events["end_s"], duration_s)
+    events["class_id"] = class_ids
+    events["score"] = averages[np.arange(len(starts)), class_ids]
+    return events
+
+def score_waveforms(waveforms):
+    """
+    Runs YAMNet over many 16 kHz mono waveforms with as few model calls as possible.
+
+    YAMNet only takes one waveform per call, so the waveforms are laid end to end, each one padded
+    to a whole number of frame hops and followed by a frame's worth of silence. That way every frame
+    starts inside exactly one waveform and never reaches into the next, and the scores can be split
+    back up by frame offset. Batches are capped at MAX_BATCH_SECS of audio.
+
+    Args:
+        waveforms (list of numpy.ndarray): Mono float32 audio at YAMNET_SAMPLE_RATE.
+
+    Returns:
+        list of numpy.ndarray: The (frames, classes) scores of each waveform, in the same order.
+    """
+    gap = int(np.ceil(FRAME_LENGTH_SECS / FRAME_HOP_SECS)) * FRAME_HOP_SAMPLES
+    max_batch_samples = MAX_BATCH_SECS * YAMNET_SAMPLE_RATE
+    results = [None] * len(waveforms)
+
+    batch = []
+    batch_samples = 0
+    for i, waveform in enumerate(waveforms):
+        padded = -(-len(waveform) // FRAME_HOP_SAMPLES) * FRAME_HOP_SAMPLES + gap
+        if batch and batch_samples + padded > max_batch_samples:
+            _score_batch(waveforms, batch, gap, results)
+            batch, batch_samples = [], 0
+        batch.append(i)
+        batch_samples += padded
+    if batch:
+        _score_batch(waveforms, batch, gap, results)
+    return results
+
+def _score_batch(waveforms, batch, gap, results):
+    frame_counts = [max(1, -(-len(waveforms[i]) // FRAME_HOP_SAMPLES)) for i in batch]
+    audio = np.zeros(sum(count * FRAME_HOP_SAMPLES + gap for count in frame_counts), dtype=np.float32)
+    frame_offsets = []
+    offset = 0
+    for i, count in zip(batch, frame_counts):
+        audio[offset:offset + len(waveforms[i])] = waveforms[i]
+        frame_offsets.append(offset // FRAME_HOP_SAMPLES)
+        offset += count * FRAME_HOP_SAMPLES + gap
+
+    # Run inference
+    scores, embeddings, spectrogram = get_model()(audio)
+    scores = scores.numpy()
+
+    for i, first_frame, count in zip(batch, frame_offsets, frame_counts):
+        results[i] = scores[first_frame:first_frame + count]
+
+def classify_waveforms(waveforms, window_size: float = 1):
+    """
+    Finds the dominant sound event in every window of many 16 kHz mono waveforms (see score_waveforms).
+
+    Returns:
+        list of numpy.ndarray: An EVENT_DTYPE array per waveform, in the same order.
+    """
+    return [
+        summarize_scores(scores, window_size, len(waveform) / YAMNET_SAMPLE_RATE)
+        for waveform, scores in zip(waveforms, score_waveforms(waveforms))
+    ]
+
+def classify_files(audio_files, window_size: float = 1):
+    """
+    Tags the sound events (speech, music, crowd noise, ...) of many audio files at once.
+
+    Returns:
+        dict: {audio_file: EVENT_DTYPE array of its windows}.
+    """
+    waveforms = [load_and_convert2mono(audio_file)[0] for audio_file in audio_files]
+    return dict(zip(audio_files, classify_waveforms(waveforms, window_size)))
+
+def format_events(events, class_names=None):
+    class_names = class_names or load_class_names()
+    return "".join(
+        f"Time {event['start_s']:.2f} to {event['end_s']:.2f}: {class_names[event['class_id']]} "
+        f"({event['score']:.3f})\n"
+        for event in events
+    )
+
+def get_audio_event_data(audio_file, window_size=1, output_path=None):
+    """
+    Finds the dominant sound event in every window of an audio file.
+
+    Args:
+        audio_file (str): The audio to classify.
+
+        window_size (float): Window length in seconds.
+
+        output_path (str): If given, a readable report of the events is written there.
+
+    Returns:
+        numpy.ndarray: An EVENT_DTYPE structured array of (start_s, end_s, class_id, score).
+    """
+    events = classify_files([audio_file], window_size)[audio_file]
+    if output_path is not None:
+        with open(output_path, "w", encoding="utf-8") as file:
+            file.write(format_events(events))
+    print(f"get_audio_event_data[audio_file: {audio_file}, windows: {len(events)}]")
+    return events
+
+if __name__ == "__main__":
+    get_audio_event_data("./audio/output_audio_2023-09-26.wav", window_size=1, output_path="./code/output.txt")
 
 # mono_audio, sr = load_and_convert2mono("./audio/ManWhistleSoundEffect.wav")
 # output_filepath = "./audio/audio_mono.wav"
-# sf.write(output_filepath, mono_audio, 16000) 
+# sf.write(output_filepath, mono_audio, 16000)
 
-# Issues: It can detect the when the crowd goes off, but it begins detecting speech a few seconds 
-#         early. I guess that isn't terrible, just won't get the precise chops with the subtitles. 
+# Issues: It can detect the when the crowd goes off, but it begins detecting speech a few seconds
+#         early. I guess that isn't terrible, just won't get the precise chops with the subtitles.
 #         HOWEVER, if you wanted to put the dub over this, then it would be an issue because it would
-#         throw off the timing of when what was said.    
\ No newline at end of file
+#         throw off the timing of when what was said.
\ No newline at end of file
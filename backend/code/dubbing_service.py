@@ -0,0 +1,741 @@
+import argparse
+import asyncio
+import fake_providers
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import instrumentation
+import job_scheduler
+import json
+import mimetypes
+import os
+import quota_ledger
+import re
+import shutil
+import threading
+import time
+import urllib.parse
+import uuid
+
+FRONTEND_DIR = "../frontend"
+# Uploads are copied to disk in blocks of this size, so a video of any size streams in flat memory
+UPLOAD_BLOCK_BYTES = 1024 * 1024
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024 * 1024
+# Form fields are small, anything bigger than this isn't one
+MAX_FIELD_BYTES = 64 * 1024
+# How often an idle event stream sends a comment, so proxies don't close it
+KEEPALIVE_SECS = 15
+# How long a finished job and its events stay in memory. After that it's read back from its state.json
+JOB_RETENTION_SECS = 60 * 60
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+LANGUAGE_PATTERN = re.compile(r"^[A-Za-z]{2,3}(-[A-Za-z0-9]{2,8})*$")
+
+# What the page shows for each stage of job_scheduler.DEFAULT_STAGES
+STAGE_LABELS = {
+    "extract_audio": "extracting",
+    "detect_speech": "detecting speech",
+    "chunk_audio": "chunking",
+    "transcribe": "transcribing",
+    "translate": "translating",
+    "synthesize": "dubbing",
+    "render": "rendering",
+}
+# Download route: the job artifact holding {language: path}
+ARTIFACT_ROUTES = {
+    "video": "output_paths",
+    "subtitles": "translated_srt_paths",
+    "dub": "dub_paths",
+}
+CONTENT_TYPES = {".srt": "application/x-subrip", ".vtt": "text/vtt"}
+
+class BadUpload(Exception):
+    def __init__(self, message="The upload could not be read."):
+        self.message = message
+        super().__init__(self.message)
+
+class UploadTooLarge(Exception):
+    def __init__(self, message=f"Uploads are limited to {MAX_UPLOAD_BYTES} bytes."):
+        self.message = message
+        super().__init__(self.message)
+
+def read_body(rfile, headers, block_bytes: int = UPLOAD_BLOCK_BYTES):
+    """
+    Yields a request body in blocks, whether it's sent with a Content-Length or chunked.
+
+    Raises:
+        BadUpload: If the body has neither, the Content-Length isn't a length, or a chunk is malformed.
+    """
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            size_line = rfile.readline(1024)
+            try:
+                size = int(size_line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise BadUpload(f"Malformed chunk size: {size_line[:32]!r}")
+            if size == 0:
+                # Skips any trailers up to the blank line that ends the body
+                while rfile.readline(1024).strip():
+                    pass
+                return
+            while size > 0:
+                block = rfile.read(min(size, block_bytes))
+                if not block:
+                    raise BadUpload("The upload ended in the middle of a chunk")
+                size -= len(block)
+                yield block
+            rfile.readline(8)
+        return
+    if headers.get("Content-Length") is None:
+        raise BadUpload("Uploads need a Content-Length or chunked Transfer-Encoding")
+    try:
+        remaining = int(headers["Content-Length"])
+    except ValueError:
+        raise BadUpload(f"Malformed Content-Length: {headers['Content-Length'][:32]!r}")
+    if remaining < 0:
+        raise BadUpload(f"Malformed Content-Length: {remaining}")
+    while remaining > 0:
+        block = rfile.read(min(remaining, block_bytes))
+        if not block:
+            raise BadUpload("The upload ended before its Content-Length")
+        remaining -= len(block)
+        yield block
+
+class MultipartStream:
+    """
+    Reads a multipart/form-data body part by part, without ever holding a whole part in memory.
+
+    next_part() returns the headers of the next part and read_part() yields its content in blocks, so
+    a file part can be written to disk as it arrives. A part that isn't read is skipped.
+
+    Args:
+        blocks (iterable of bytes): The body, e.g. from read_body.
+
+        boundary (bytes): The boundary from the Content-Type header.
+    """
+    def __init__(self, blocks, boundary: bytes):
+        self._blocks = iter(blocks)
+        # The first boundary has no line break in front of it, adding one lets every boundary match the same way
+        self._buffer = b"\r\n"
+        self._delimiter = b"\r\n--" + boundary
+
+    def _fill(self):
+        block = next(self._blocks, None)
+        if block is None:
+            raise BadUpload("The multipart body ended before its closing boundary")
+        self._buffer += block
+
+    def _read_until(self, marker: bytes):
+        # Returns what comes before the marker and drops both from the buffer
+        while marker not in self._buffer:
+            self._fill()
+        before, _, self._buffer = self._buffer.partition(marker)
+        return before
+
+    def next_part(self):
+        """Returns the next part's headers as {lowercase name: value}, or None after the last part."""
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                self._buffer = self._buffer[index + len(self._delimiter):]
+                break
+            # Whatever is left of a skipped part, keeping enough to match a boundary split across blocks
+            self._buffer = self._buffer[-len(self._delimiter):]
+            self._fill()
+        while len(self._buffer) < 2:
+            self._fill()
+        if self._buffer.startswith(b"--"):
+            return None
+        headers = {}
+        for line in self._read_until(b"\r\n\r\n").split(b"\r\n"):
+            name, _, value = line.decode("utf-8", errors="replace").partition(":")
+            if value:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def read_part(self):
+        """Yields the content of the current part in blocks, stopping at the next boundary."""
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                if index:
+                    yield self._buffer[:index]
+                # Leaves the boundary for next_part
+                self._buffer = self._buffer[index:]
+                return
+            keep = len(self._delimiter) - 1
+            if len(self._buffer) > keep:
+                yield self._buffer[:-keep]
+                self._buffer = self._buffer[-keep:]
+            self._fill()
+
+def _disposition(headers: dict, param: str):
+    match = re.search(rf'\b{param}="([^"]*)"', headers.get("content-disposition", ""))
+    return match.group(1) if match else None
+
+def safe_file_name(file_name: str):
+    name = re.sub(r"[^\w.-]+", "_", os.path.basename(file_name or "")).strip("._")
+    return name or "video.mp4"
+
+def write_upload(blocks, path: str, max_bytes: int = MAX_UPLOAD_BYTES):
+    """
+    Writes an upload to disk block by block, under a temporary name until it's complete.
+
+    Returns:
+        int: The number of bytes written.
+
+    Raises:
+        UploadTooLarge: If the upload goes over 'max_bytes'. Nothing is left on disk then.
+    """
+    temp_path = f"{path}.part"
+    written = 0
+    try:
+        with open(temp_path, "wb") as file:
+            for block in blocks:
+                written += len(block)
+                if written > max_bytes:
+                    raise UploadTooLarge()
+                file.write(block)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    instrumentation.count("bytes_in", written)
+    return written
+
+def job_settings(fields: dict):
+    """
+    Turns the submitted form fields ({name: [value, ...]}) into target languages and job options.
+
+    Raises:
+        BadUpload: If a language code or the Whisper backend isn't valid.
+    """
+    languages = [
+        language
+        for value in fields.get("language", [])
+        for language in re.split(r"[,\s]+", value)
+        if language
+    ] or ["es-419"]
+    for language in languages:
+        if not LANGUAGE_PATTERN.match(language):
+            raise BadUpload(f"Not a language code: {language}")
+    whisper = (fields.get("whisper") or ["api"])[-1]
+    if whisper not in ("api", "local"):
+        raise BadUpload(f"Unknown Whisper backend: {whisper}")
+    options = {"whisper_backend": whisper}
+    for flag in ("dub", "speech_only"):
+        options[flag] = (fields.get(flag) or [""])[-1].lower() in ("1", "true", "on", "yes")
+    return list(dict.fromkeys(languages)), options
+
+def parse_range(range_header: str, size: int):
+    """
+    Reads a single byte range of a Range header.
+
+    Returns:
+        (int, int): The first and last byte, inclusive. None if the range can't be satisfied, and
+        (0, size - 1) for a header that isn't a single byte range, which is answered with the whole file.
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if match is None or match.group(1) == match.group(2) == "":
+        return 0, size - 1
+    first, last = match.groups()
+    if first == "":
+        # bytes=-500 is the last 500 bytes
+        length = int(last)
+        if length == 0:
+            return None
+        return max(0, size - length), size - 1
+    first = int(first)
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    if first >= size or first > last:
+        return None
+    return first, last
+
+class _Handler(BaseHTTPRequestHandler):
+    def _send_json(self, status: int, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_error_json(self, status: int, message: str):
+        self._send_json(status, {"error": message})
+
+    def _send_file(self, path: str, head: bool = False):
+        # Answers Range requests, so the page's video player can seek and downloads can resume
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        status = 200
+        if self.headers.get("Range") and size:
+            byte_range = parse_range(self.headers["Range"], size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range != (0, size - 1):
+                first, last = byte_range
+                status = 206
+        extension = os.path.splitext(path)[1].lower()
+        content_type = CONTENT_TYPES.get(extension) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(last - first + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.end_headers()
+        if head:
+            return
+        remaining = last - first + 1
+        with open(path, "rb") as file:
+            file.seek(first)
+            while remaining > 0:
+                block = file.read(min(remaining, UPLOAD_BLOCK_BYTES))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def _send_events(self, job_id: str, last_event_id: int):
+        service = self.server.service
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            self.wfile.write(b"retry: 2000\n\n")
+            while True:
+                events, finished = service.events_since(job_id, last_event_id, KEEPALIVE_SECS)
+                if not events:
+                    self.wfile.write(b": keepalive\n\n")
+                for event in events:
+                    kind = "stage" if event["stage"] else "job"
+                    self.wfile.write(f"id: {event['id']}\nevent: {kind}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+                    last_event_id = event["id"]
+                self.wfile.flush()
+                if finished:
+                    # Tells the page to close the stream rather than reconnect
+                    self.wfile.write(b"event: end\ndata: {}\n\n")
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def _route(self, head: bool = False):
+        service = self.server.service
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split("/") if part]
+        if parts == ["jobs"]:
+            self._send_json(200, {"jobs": service.job_summaries()})
+            return
+        if len(parts) >= 2 and parts[0] == "jobs":
+            job = service.get_job(parts[1])
+            if job is None:
+                self._send_error_json(404, f"No job {parts[1]}")
+            elif len(parts) == 2:
+                self._send_json(200, service.job_summary(job))
+            elif parts[2:] == ["events"]:
+                query = urllib.parse.parse_qs(url.query)
+                last_event_id = self.headers.get("Last-Event-ID") or (query.get("last_event_id") or ["0"])[-1]
+                self._send_events(job.job_id, int(last_event_id) if last_event_id.isdigit() else 0)
+            elif len(parts) == 4 and parts[2] in ARTIFACT_ROUTES:
+                path = job.artifacts.get(ARTIFACT_ROUTES[parts[2]], {}).get(parts[3])
+                if path is None or not os.path.exists(path):
+                    self._send_error_json(404, f"Job {job.job_id} has no {parts[2]} for {parts[3]} yet")
+                else:
+                    self._send_file(path, head)
+            else:
+                self._send_error_json(404, f"Not found: {url.path}")
+            return
+        path = service.frontend_file(url.path)
+        if path is None:
+            self._send_error_json(404, f"Not found: {url.path}")
+        else:
+            self._send_file(path, head)
+
+    def do_GET(self):
+        self._route()
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            self._send_error_json(404, f"Not found: {url.path}")
+            return
+        fields = urllib.parse.parse_qs(url.query)
+        try:
+            jobs = self.server.service.accept_upload(self.rfile, self.headers, fields)
+        except BadUpload as e:
+            self._send_error_json(400, e.message)
+            return
+        except UploadTooLarge as e:
+            self._send_error_json(413, e.message)
+            return
+        except Exception as e:
+            # e.g. a full disk or a scheduler that failed to queue the job. The rest of the body may not
+            # have been read, so the connection can't be reused
+            print(f"_Handler.do_POST[path: {url.path}, error: {e!r}]")
+            self.close_connection = True
+            self._send_error_json(500, f"Could not accept the upload: {e}")
+            return
+        self._send_json(201, {"jobs": [self.server.service.job_summary(job) for job in jobs]})
+
+class DubbingService:
+    """
+    An HTTP service in front of the job scheduler: upload videos, follow them stage by stage, and
+    download what they produced. It also serves the frontend, so frontend/dubber.html works as is.
+
+    POST /jobs                               Upload one video as the raw body (with ?filename=), or any
+                                             number as multipart/form-data. Settings come as query or
+                                             form fields: language (repeatable or comma separated), dub,
+                                             speech_only and whisper ("api" or "local"). One job per video.
+    GET  /jobs, /jobs/<id>                   Job status and the urls of its finished outputs. Jobs that
+                                             finished over job_retention_secs ago are no longer listed,
+                                             but /jobs/<id> still reads them back from their state.json.
+    GET  /jobs/<id>/events                   Server-Sent Events, one per stage start, finish, failure or
+                                             quota wait, then one when the job ends. Reconnects resume
+                                             from Last-Event-ID.
+    GET  /jobs/<id>/<video|subtitles|dub>/<language>   A finished output, with Range support.
+
+    Uploads are streamed to disk in blocks as they arrive, plain or chunked, and never held in memory.
+    Jobs run concurrently on one JobScheduler, on an event loop of their own, so a slow upload or an
+    open event stream never holds up the pipeline.
+
+    Args:
+        scheduler (JobScheduler): Runs the jobs. Defaults to a JobScheduler with its default stages.
+
+        job_options (dict): Options added to every job, e.g. FakeProviders.job_options().
+
+        jobs_dir (str): Directory the jobs, and their uploads, are kept in.
+
+        frontend_dir (str): Directory of the static pages.
+
+        host (str): Interface to listen on.
+
+        port (int): Port to listen on, 0 picks a free one.
+
+        job_retention_secs (float): How long a finished job's events are kept in memory.
+    """
+    def __init__(self, scheduler=None, job_options: dict = None, jobs_dir: str = job_scheduler.JOBS_DIR,
+                 frontend_dir: str = FRONTEND_DIR, host: str = "127.0.0.1", port: int = 8080,
+                 job_retention_secs: float = JOB_RETENTION_SECS):
+        self.scheduler = scheduler or job_scheduler.JobScheduler()
+        self.scheduler.on_event = self._on_event
+        self.job_options = job_options or {}
+        self.jobs_dir = jobs_dir
+        self.frontend_dir = frontend_dir
+        self.job_retention_secs = job_retention_secs
+        self._jobs = {}
+        self._events = {}
+        # {job_id: when it finished}
+        self._finished = {}
+        self._changed = threading.Condition()
+        self._loop = None
+        self._loop_thread = None
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        self._server_thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(self._loop)
+            self.scheduler.open()
+            ready.set()
+            self._loop.run_forever()
+
+        self._loop_thread = threading.Thread(target=run_loop, daemon=True)
+        self._loop_thread.start()
+        ready.wait()
+        self._server_thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._server_thread.start()
+        print(f"DubbingService.start[base_url: {self.base_url}]")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        # Jobs still running are cancelled, their finished stages are saved (see job_scheduler.Job)
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            # An empty gather() would belong to this thread's loop rather than the service's
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+        self.scheduler.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stop()
+
+    def accept_upload(self, rfile, headers, fields: dict):
+        """
+        Streams the uploaded videos of one request to disk and submits a job for each.
+
+        Args:
+            rfile: The request body stream.
+
+            headers: The request headers.
+
+            fields (dict): {name: [value, ...]} from the query string. Multipart form fields are added.
+
+        Returns:
+            list of Job: The submitted jobs.
+
+        Raises:
+            BadUpload: If the body or the settings can't be read. Nothing is submitted then.
+
+            UploadTooLarge: If a video goes over MAX_UPLOAD_BYTES.
+        """
+        uploads = []
+        try:
+            blocks = read_body(rfile, headers)
+            content_type = headers.get("Content-Type", "")
+            if content_type.startswith("multipart/form-data"):
+                boundary = re.search(r'boundary="?([^";]+)"?', content_type)
+                if boundary is None:
+                    raise BadUpload("The multipart body has no boundary")
+                stream = MultipartStream(blocks, boundary.group(1).encode())
+                while True:
+                    part = stream.next_part()
+                    if part is None:
+                        break
+                    name = _disposition(part, "name")
+                    file_name = _disposition(part, "filename")
+                    if file_name is None:
+                        value = b""
+                        for block in stream.read_part():
+                            value += block
+                            if len(value) > MAX_FIELD_BYTES:
+                                raise BadUpload(f"Form field {name} is too long")
+                        fields.setdefault(name, []).append(value.decode("utf-8", errors="replace"))
+                    elif file_name:
+                        uploads.append(self._save_upload(stream.read_part(), file_name))
+            else:
+                uploads.append(self._save_upload(blocks, (fields.get("filename") or [""])[-1]))
+            if not uploads:
+                raise BadUpload("No video was uploaded")
+            target_languages, options = job_settings(fields)
+        except Exception:
+            for job_id, _ in uploads:
+                shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+            raise
+        return [self.submit(video_file, target_languages, options, job_id) for job_id, video_file in uploads]
+
+    def _save_upload(self, blocks, file_name: str):
+        job_id = uuid.uuid4().hex
+        work_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(work_dir, exist_ok=True)
+        video_file = os.path.join(work_dir, safe_file_name(file_name))
+        try:
+            with instrumentation.span("upload", job=job_id):
+                size = write_upload(blocks, video_file)
+        except Exception:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        print(f"DubbingService._save_upload[job: {job_id}, video_file: {video_file}, bytes: {size}]")
+        return job_id, video_file
+
+    def submit(self, video_file: str, target_languages, options: dict = None, job_id: str = None):
+        """Queues a job for a video already on disk and returns it."""
+        job = job_scheduler.Job(
+            video_file,
+            target_languages,
+            job_id=job_id,
+            options={**self.job_options, **(options or {})},
+            jobs_dir=self.jobs_dir
+        )
+        with self._changed:
+            self._forget_finished_jobs()
+            self._jobs[job.job_id] = job
+            self._events[job.job_id] = []
+        self._record(job, None, "queued")
+        future = asyncio.run_coroutine_threadsafe(self.scheduler.run_job(job), self._loop)
+        future.add_done_callback(lambda done: self._job_finished(job, done))
+        return job
+
+    def _on_event(self, job, stage_name: str, status: str):
+        # Called by the scheduler on its event loop
+        self._record(job, stage_name, status)
+
+    def _job_finished(self, job, future):
+        if future.cancelled():
+            job.status = "cancelled"
+        elif future.exception() is not None:
+            job.status = "failed"
+            job.error = str(future.exception())
+        self._record(job, None, job.status, finished=True)
+
+    def _record(self, job, stage_name: str, status: str, finished: bool = False):
+        with self._changed:
+            events = self._events[job.job_id]
+            events.append({
+                "id": len(events) + 1,
+                "job_id": job.job_id,
+                "stage": stage_name,
+                "label": STAGE_LABELS.get(stage_name, stage_name),
+                "status": status,
+                "job_status": job.status,
+                "error": job.error,
+                "time": time.time(),
+            })
+            if finished:
+                self._finished[job.job_id] = time.time()
+            self._changed.notify_all()
+
+    def _forget_finished_jobs(self):
+        # Called with self._changed held. Only jobs that finished long ago go, a page following one has
+        # long since been sent its last event
+        expired = time.time() - self.job_retention_secs
+        for job_id, finished in list(self._finished.items()):
+            if finished < expired:
+                del self._finished[job_id]
+                del self._jobs[job_id]
+                del self._events[job_id]
+
+    def events_since(self, job_id: str, last_event_id: int, timeout: float):
+        """
+        Waits up to 'timeout' seconds for events after 'last_event_id'.
+
+        Returns:
+            (list of dict, bool): The new events, and whether the job has finished and they're the last.
+        """
+        with self._changed:
+            events = self._events.get(job_id)
+            if events is None:
+                # Forgotten, or read back from disk: it finished long ago
+                return [], True
+            self._changed.wait_for(lambda: len(events) > last_event_id or job_id in self._finished, timeout)
+            return events[last_event_id:], job_id in self._finished
+
+    def get_job(self, job_id: str):
+        """Returns the job with this id, read back from its state.json if it's no longer in memory, or None."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+        if job is not None or not JOB_ID_PATTERN.match(job_id):
+            return job
+        return self._load_job(job_id)
+
+    def _load_job(self, job_id: str):
+        # Not kept in memory again, so reading old jobs never grows the service
+        state_path = os.path.join(self.jobs_dir, job_id, "state.json")
+        try:
+            with open(state_path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        job = job_scheduler.Job(state["video_file"], state["target_languages"], job_id=job_id, jobs_dir=self.jobs_dir)
+        failed = [(name, stage) for name, stage in job.stages.items() if stage["status"] == "failed"]
+        if failed:
+            job.status = "failed"
+            job.error = f"{failed[0][0]}: {failed[0][1]['error']}"
+        elif all(job.is_done(stage.name) for stage in self.scheduler.stages):
+            job.status = "done"
+        else:
+            # Stopped before it got through, e.g. by a restart
+            job.status = "cancelled"
+        return job
+
+    def job_summary(self, job):
+        artifacts = job.artifacts
+        downloads = {
+            route: {language: f"/jobs/{job.job_id}/{route}/{language}" for language in artifacts.get(artifact, {})}
+            for route, artifact in ARTIFACT_ROUTES.items()
+        }
+        with self._changed:
+            events = self._events.get(job.job_id)
+            if events is None:
+                stages = {name: stage["status"] for name, stage in job.stages.items()}
+            else:
+                stages = {}
+                for event in events:
+                    if event["stage"]:
+                        stages[event["stage"]] = event["status"]
+        return {
+            "job_id": job.job_id,
+            "video": os.path.basename(job.video_file),
+            "target_languages": job.target_languages,
+            "status": job.status,
+            "error": job.error,
+            "stages": stages,
+            "downloads": downloads,
+        }
+
+    def job_summaries(self):
+        with self._changed:
+            jobs = list(self._jobs.values())
+        return [self.job_summary(job) for job in jobs]
+
+    def frontend_file(self, url_path: str):
+        """Returns the file under frontend_dir a url points at, or None. Nothing outside it is served."""
+        relative = urllib.parse.unquote(url_path).lstrip("/") or "dubber.html"
+        root = os.path.realpath(self.frontend_dir)
+        path = os.path.realpath(os.path.join(root, relative))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the dubbing pipeline over HTTP, with the dubber page.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--max-jobs", type=int, default=4, help="Jobs in progress at once")
+    parser.add_argument("--jobs-dir", default=job_scheduler.JOBS_DIR, help="Where jobs and uploads are kept")
+    parser.add_argument("--frontend-dir", default=FRONTEND_DIR, help="Directory of the static pages")
+    parser.add_argument("--fake-providers", action="store_true",
+                        help="Point every job at local stand-ins for the APIs (see fake_providers)")
+    parser.add_argument("--metrics-jsonl", help="Append a json line per stage span to this file")
+    parser.add_argument("--metrics-prometheus-dir", help="Keep Prometheus text files of the spans in this directory")
+    parser.add_argument("--profile", help="Comma separated span names to run under cProfile, or 'all'")
+    args = parser.parse_args()
+    # Set before the process pool starts so the workers record to the same places
+    instrumentation.configure(args.metrics_jsonl, args.metrics_prometheus_dir, args.profile)
+
+    job_options = {}
+    providers = None
+    if args.fake_providers:
+        providers = fake_providers.FakeProviders().start()
+        job_options = providers.job_options()
+        # The stand-ins do the rate limiting, the free tier ledger would only slow an end to end run down.
+        # Kept apart from QUOTA_LEDGER_PATH, calls that never reached a real API mustn't use up its budget.
+        quota_ledger.set_default_ledger(quota_ledger.QuotaLedger(
+            os.path.join(args.jobs_dir, "fake_providers_ledger.sqlite3"),
+            limits={provider: [] for provider in quota_ledger.PROVIDER_LIMITS}
+        ))
+
+    service = DubbingService(
+        job_scheduler.JobScheduler(max_jobs=args.max_jobs),
+        job_options=job_options,
+        jobs_dir=args.jobs_dir,
+        frontend_dir=args.frontend_dir,
+        host=args.host,
+        port=args.port
+    )
+    with service:
+        print(f"Open {service.base_url}/dubber.html")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    if providers is not None:
+        providers.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import audio_chunker
+from concurrent.futures import ThreadPoolExecutor
+import audio_video_script as avs
+import dubbing_tts
+import google_translator
+import local_whisper
+import os
+import pcm_buffer
+import quota_ledger
+import speech_regions
+import subtitles
+import transcript_cache
+import translation_cache
+import video_renderer
+import whisper_transcriber
+
+# Every stage takes the job as a plain dict and returns a dict of the artifacts it produced, which are
+# merged into job["artifacts"] for the stages after it. Keeping to plain dicts lets the CPU bound stages
+# run in a process pool and lets the scheduler save each stage's outputs as json.
+#
+# job = {
+#     "job_id": str, "video_file": str, "work_dir": str, "target_languages": [str, ...],
+#     "options": dict, "artifacts": dict
+# }
+
+def _path(job: dict, file_name: str):
+    return os.path.join(job["work_dir"], file_name)
+
+def _video_name(job: dict):
+    return os.path.splitext(os.path.basename(job["video_file"]))[0]
+
+def whisper_backend(options: dict):
+    """
+    Builds the Whisper backend a job asked for: the OpenAI API, unless a base url is given or the job
+    runs Whisper locally ('whisper_backend': "local"), which leaves the API quota to other jobs.
+    """
+    if options.get("whisper_backend") == "local":
+        return local_whisper.get_default_pool(
+            options.get("whisper_model", local_whisper.DEFAULT_MODEL),
+            engine=options.get("whisper_engine"),
+            workers=options.get("whisper_workers"),
+            threads_per_worker=options.get("whisper_threads", 1),
+            language=options.get("whisper_language")
+        )
+    if options.get("whisper_base_url"):
+        return whisper_transcriber.HTTPWhisperBackend(options["whisper_base_url"], options.get("whisper_api_key", ""))
+    import openai
+    if not openai.api_key:
+        openai.api_key = avs.get_api_credentials("./credentials/openai_credentials.txt")
+    return whisper_transcriber.OpenAIWhisperBackend()
+
+def translate_pool(options: dict):
+    if options.get("translate_endpoint"):
+        return google_translator.TranslateClientPool(api_endpoint=options["translate_endpoint"])
+    return google_translator.get_client_pool()
+
+def tts_backend(options: dict):
+    if options.get("elevenlabs_base_url"):
+        return dubbing_tts.HTTPTTSBackend(options["elevenlabs_base_url"], options.get("elevenlabs_api_key", ""))
+    return dubbing_tts.ElevenLabsBackend(avs.get_api_credentials("./credentials/elevenlabs_creds.txt"))
+
+def extract_audio(job: dict):
+    audio_path = avs.video_to_audio(job["video_file"], job_id=job["job_id"], out_dir=job["work_dir"])
+    return {"audio_path": audio_path}
+
+def detect_speech(job: dict):
+    # Opt-in per job, it needs TensorFlow and YAMNet (see classify_audio_test)
+    if not job["options"].get("speech_only"):
+        return {}
+    audio_path = job["artifacts"]["audio_path"]
+    timeline = speech_regions.detect_speech(audio_path)
+    return {
+        "speech_map_path": timeline.save(_path(job, "speech_map.json")),
+        "speech_audio_path": timeline.condense(audio_path, _path(job, "speech_audio.wav")),
+        "speech_savings": timeline.savings(whisper_transcriber.WHISPER_PROVIDER),
+    }
+
+def _transcribed_audio_path(job: dict):
+    # The speech-only audio when non-speech is skipped, the whole audio otherwise
+    return job["artifacts"].get("speech_audio_path") or job["artifacts"]["audio_path"]
+
+def chunk_audio(job: dict):
+    chunk_options = {}
+    if job["options"].get("whisper_backend") == "local":
+        # Shorter lossless chunks, so every local worker gets one and nothing is encoded for upload
+        chunk_options = {"max_chunk_secs": local_whisper.MAX_CHUNK_SECS, "export_codec": local_whisper.EXPORT_CODEC}
+    chunks = whisper_transcriber.prepare_whisper_chunks(
+        _transcribed_audio_path(job),
+        out_dir=_path(job, "chunks"),
+        **chunk_options
+    )
+    return {"chunks": [list(chunk) for chunk in chunks]}
+
+def transcribe(job: dict):
+    chunks = [audio_chunker.AudioChunk(*chunk) for chunk in job["artifacts"]["chunks"]]
+    srt_text = whisper_transcriber.transcribe_chunks(
+        chunks,
+        backend=whisper_backend(job["options"]),
+        store=transcript_cache.TranscriptStore(),
+        audio_path=_transcribed_audio_path(job),
+        ledger=quota_ledger.get_default_ledger()
+    )
+    if job["artifacts"].get("speech_map_path"):
+        timeline = speech_regions.SpeechTimeline.load(job["artifacts"]["speech_map_path"])
+        srt_text = subtitles.format_cues(timeline.map_cues(subtitles.parse_cues(srt_text)))
+    srt_path = _path(job, "transcription.srt")
+    with open(srt_path, "w", encoding="utf-8") as file:
+        file.write(srt_text)
+    return {"srt_path": srt_path}
+
+def translate(job: dict):
+    # Every language is translated from the one transcript, all of them at once through a shared client pool
+    cues = subtitles.read_cues(job["artifacts"]["srt_path"])
+    pool = translate_pool(job["options"])
+
+    def translate_one(language):
+        translated_cues = google_translator.translate_cues(
+            cues,
+            language,
+            pool=pool,
+            cache=translation_cache.get_default_cache(),
+            ledger=quota_ledger.get_default_ledger()
+        )
+        return subtitles.save_cues(_path(job, f"translation.{language}.srt"), translated_cues)
+
+    languages = job["target_languages"]
+    with ThreadPoolExecutor(max_workers=len(languages)) as executor:
+        paths = list(executor.map(translate_one, languages))
+    return {"translated_srt_paths": dict(zip(languages, paths))}
+
+def synthesize(job: dict):
+    # Dubbing is opt-in per job, the same way get_dubbed_audio is left out of main for now
+    if not job["options"].get("dub"):
+        return {}
+    source = pcm_buffer.open_buffer(job["artifacts"]["audio_path"])
+    backend = tts_backend(job["options"])
+    dub_paths = {}
+    # One language at a time, each dub already uses all of ElevenLabs' concurrent requests
+    for language, translated_srt_path in job["artifacts"]["translated_srt_paths"].items():
+        dub_paths[language] = dubbing_tts.dub_cues(
+            subtitles.read_cues(translated_srt_path),
+            _path(job, f"dub.{language}.wav"),
+            backend,
+            voice=job["options"].get("voice", "Ryan"),
+            total_ms=source.frame_to_ms(source.num_frames),
+            ledger=quota_ledger.get_default_ledger()
+        )
+    return {"dub_paths": dub_paths}
+
+def render(job: dict, on_progress=None):
+    # Every language is rendered in one ffmpeg pass, so the source video is only decoded once
+    options = job["options"]
+    dub_paths = job["artifacts"].get("dub_paths", {})
+    targets = [
+        video_renderer.RenderTarget(
+            _path(job, f"{_video_name(job)}_{language}.mp4"),
+            translated_srt_path,
+            dub_paths.get(language)
+        )
+        for language, translated_srt_path in job["artifacts"]["translated_srt_paths"].items()
+    ]
+    output_paths = video_renderer.render_videos(
+        job["video_file"],
+        targets,
+        subtitle_mode=options.get("subtitle_mode", "burn"),
+        audio_mode=options.get("audio_mode", "replace"),
+        speed=options.get("speed", "fast"),
+        threads=options.get("threads"),
+        on_progress=on_progress
+    )
+    return {"output_paths": dict(zip(job["artifacts"]["translated_srt_paths"], output_paths))}
@@ -0,0 +1,333 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import instrumentation
+import json
+import numpy as np
+import os
+import subprocess
+import time
+import urllib.error
+import urllib.request
+import uuid
+import wave
+
+TTS_CACHE_DIR = "./cache/tts"
+TTS_PROVIDER = "elevenlabs"
+TTS_MODEL = "eleven_multilingual_v2"
+DUB_SAMPLE_RATE = 44100
+# ElevenLabs' free tier only runs a couple of requests at a time
+MAX_CONCURRENT_REQUESTS = 2
+# A clip is sped up at most this much to fit its cue, past that it's cut off at the next cue instead
+MAX_TEMPO = 1.5
+FADE_MS = 30
+# The dub is mixed and written this many seconds at a time
+MIX_WINDOW_SECS = 10
+# Clips are decoded this many cues ahead of the window being mixed, and no further
+DECODE_AHEAD = 8
+MAX_RETRIES = 3
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class SynthesisFailed(Exception):
+    def __init__(self, message="ElevenLabs failed to synthesize the dub."):
+        self.message = message
+        super().__init__(self.message)
+
+class ElevenLabsBackend:
+    """Synthesizes speech through the elevenlabs package, the way get_dubbed_audio always has."""
+    def __init__(self, api_key: str, model: str = TTS_MODEL):
+        self.api_key = api_key
+        self.model = model
+
+    def synthesize(self, text: str, voice: str):
+        import elevenlabs
+        elevenlabs.set_api_key(self.api_key)
+        return elevenlabs.generate(text=text, voice=voice, model=self.model)
+
+class HTTPTTSBackend:
+    """
+    Posts to an ElevenLabs compatible /v1/text-to-speech/<voice> endpoint and returns the mp3 bytes.
+
+    The real API expects a voice id rather than a voice name. Pointing 'base_url' at a local fake
+    server makes the TTS stage testable offline.
+    """
+    def __init__(self, base_url: str, api_key: str = "", model: str = TTS_MODEL, timeout: float = 120):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+
+    def synthesize(self, text: str, voice: str):
+        request = urllib.request.Request(
+            f"{self.base_url}/v1/text-to-speech/{voice}",
+            data=json.dumps({"text": text, "model_id": self.model}).encode("utf-8"),
+            headers={"xi-api-key": self.api_key, "Content-Type": "application/json", "Accept": "audio/mpeg"},
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+def _clip_key(text: str, voice: str, model: str):
+    return hashlib.sha256("\0".join([text, voice, model]).encode("utf-8")).hexdigest()
+
+def _clip_path(text: str, voice: str, model: str, cache_dir: str):
+    return os.path.join(cache_dir, f"{_clip_key(text, voice, model)}.mp3")
+
+def _is_retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (ConnectionError, TimeoutError, urllib.error.URLError)):
+        return True
+    # The elevenlabs package's errors carry the response's status code
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+def synthesize_clip(backend, text: str, voice: str, cache_dir: str = TTS_CACHE_DIR, max_retries: int = MAX_RETRIES):
+    """
+    Returns the encoded audio for one cue, from the cache when this text and voice were synthesized before.
+
+    A request that fails with a connection error, a 429 or a 5xx is retried with exponential backoff.
+
+    Returns:
+        (bytes, bool): The audio, and whether it came from the cache.
+
+    Raises:
+        SynthesisFailed: If the request still fails after 'max_retries' retries, or fails for good.
+    """
+    cache_path = _clip_path(text, voice, getattr(backend, "model", TTS_MODEL), cache_dir)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as file:
+            return file.read(), True
+    for attempt in range(max_retries + 1):
+        instrumentation.count("api_calls")
+        instrumentation.count("bytes_out", len(text.encode("utf-8")))
+        try:
+            audio = backend.synthesize(text, voice)
+            break
+        except Exception as e:
+            if attempt == max_retries or not _is_retryable(e):
+                raise SynthesisFailed(f"Could not synthesize {text[:40]!r}: {e}") from e
+            print(f"synthesize_clip[attempt: {attempt + 1}, error: {e}]")
+            instrumentation.count("retries")
+            time.sleep(2 ** attempt)
+    instrumentation.count("bytes_in", len(audio))
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(audio)
+    os.replace(temp_path, cache_path)
+    return audio, False
+
+def _atempo_chain(tempo: float):
+    # atempo only accepts 0.5 to 2.0 per filter, so bigger changes are chained
+    filters = []
+    while tempo > 2.0:
+        filters.append("atempo=2.0")
+        tempo /= 2.0
+    filters.append(f"atempo={tempo:.4f}")
+    return ",".join(filters)
+
+def decode_clip(audio: bytes, sample_rate: int = DUB_SAMPLE_RATE, tempo: float = 1.0):
+    """Decodes an encoded clip to mono float32 samples, optionally sped up by 'tempo'."""
+    command = ["ffmpeg", "-nostdin", "-v", "error", "-i", "pipe:0", "-ac", "1", "-ar", str(sample_rate)]
+    if abs(tempo - 1.0) > 0.01:
+        command += ["-filter:a", _atempo_chain(tempo)]
+    command += ["-f", "f32le", "pipe:1"]
+    result = subprocess.run(command, input=audio, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode("utf-8", errors="replace").strip()
+        raise SynthesisFailed(f"Could not decode a synthesized clip: {error[-500:]}")
+    return np.frombuffer(result.stdout, dtype="<f4")
+
+def fit_clip(audio: bytes, window_ms: int, sample_rate: int = DUB_SAMPLE_RATE):
+    """
+    Decodes a clip and time-stretches it to fit its cue window.
+
+    Clips that are too long are sped up, by at most MAX_TEMPO. Clips that are short are left as they
+    are, the silence after them is the padding.
+
+    Returns:
+        numpy.ndarray: Mono float32 samples.
+    """
+    samples = decode_clip(audio, sample_rate)
+    window_samples = int(window_ms * sample_rate / 1000)
+    if window_samples > 0 and len(samples) > window_samples:
+        tempo = min(len(samples) / window_samples, MAX_TEMPO)
+        samples = decode_clip(audio, sample_rate, tempo)
+    return samples
+
+def mix_clips(clips, total_ms: int, sample_rate: int = DUB_SAMPLE_RATE, window_secs: float = MIX_WINDOW_SECS):
+    """
+    Mixes clips into one track at their offsets, one window at a time.
+
+    Only a 'window_secs' window of the track is ever in memory, so an hour long dub costs no more to
+    mix than a minute long one. Clips are only loaded once the window they start in is reached, and
+    let go once it's past them, so a clip given as a loader (e.g. a decode) is only in memory while
+    its window is open. A clip that would run into the next cue is cut off there with a short fade.
+
+    Args:
+        clips (iterable of (int, int, numpy.ndarray or callable)): (start_ms, next_start_ms, samples)
+        per cue, in start order. next_start_ms is where the clip has to stop by, or None for no limit.
+        'samples' may be a callable returning the samples, which is called when the clip is reached.
+
+        total_ms (int): Length of the track, normally the length of the original audio.
+
+        window_secs (float): Length of the windows the track is mixed in.
+
+    Yields:
+        numpy.ndarray: The mixed mono track as consecutive 16-bit windows.
+    """
+    fade = int(FADE_MS * sample_rate / 1000)
+    ramp = np.linspace(1.0, 0.0, fade, dtype=np.float32)
+    window = max(1, int(window_secs * sample_rate))
+    total = int(total_ms * sample_rate / 1000)
+    clips = iter(clips)
+    pending = next(clips, None)
+    active = []
+    window_start = 0
+    while window_start < total or pending is not None:
+        # Opens every clip that starts in this window, a clip running past the end makes the track longer
+        while pending is not None and int(pending[0] * sample_rate / 1000) < window_start + window:
+            start_ms, stop_ms, samples = pending
+            pending = next(clips, None)
+            start = int(start_ms * sample_rate / 1000)
+            if stop_ms is not None and int(stop_ms * sample_rate / 1000) <= start:
+                continue
+            if callable(samples):
+                samples = samples()
+            length = len(samples)
+            if stop_ms is not None:
+                length = min(length, int(stop_ms * sample_rate / 1000) - start)
+            if length <= 0:
+                continue
+            active.append((start, length, samples, length < len(samples) and length > fade))
+            total = max(total, start + length)
+        # A clip still to come starts after this window, so the track runs at least to its end
+        window_end = window_start + window if pending is not None else min(total, window_start + window)
+        if window_end <= window_start:
+            break
+        mixed = np.zeros(window_end - window_start, dtype=np.float32)
+        for start, length, samples, faded in active:
+            lo = max(start, window_start)
+            hi = min(start + length, window_end)
+            if hi <= lo:
+                continue
+            part = samples[lo - start:hi - start]
+            if faded and hi > start + length - fade:
+                # The end of a cut off clip fades out, only the samples of it inside this window are copied
+                fade_lo = max(lo, start + length - fade)
+                part = part.copy()
+                part[fade_lo - lo:] *= ramp[fade_lo - (start + length - fade):hi - (start + length - fade)]
+            mixed[lo - window_start:hi - window_start] += part
+        yield (np.clip(mixed, -1.0, 1.0) * 32767).astype("<i2")
+        window_start = window_end
+        # Clips that ended in this window are never looked at again
+        active = [clip for clip in active if clip[0] + clip[1] > window_start]
+
+def write_track(blocks, output_path: str, sample_rate: int = DUB_SAMPLE_RATE):
+    """Writes 16-bit mono blocks (e.g. from mix_clips) to a .wav file as they come."""
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with wave.open(output_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        for block in blocks:
+            wav_file.writeframes(block.tobytes())
+    return output_path
+
+def _fit_cached_clip(cache_path: str, window_ms: int, sample_rate: int = DUB_SAMPLE_RATE):
+    with open(cache_path, "rb") as file:
+        return fit_clip(file.read(), window_ms, sample_rate)
+
+def _decode_ahead(clips, executor, ahead: int = DECODE_AHEAD):
+    """
+    Yields (start_ms, next_start_ms, loader) clips for mix_clips, decoding each one in 'executor' up
+    to 'ahead' clips before the mixer reaches it, so decoding runs in parallel but only a handful of
+    decoded clips are ever held.
+    """
+    queued = deque()
+    for start_ms, next_start_ms, load in clips:
+        queued.append((start_ms, next_start_ms, executor.submit(load)))
+        if len(queued) > ahead:
+            start_ms, next_start_ms, future = queued.popleft()
+            yield start_ms, next_start_ms, future.result
+    while queued:
+        start_ms, next_start_ms, future = queued.popleft()
+        yield start_ms, next_start_ms, future.result
+
+@instrumentation.instrumented("synthesize")
+def dub_cues(cues, output_path: str, backend, voice: str = "Ryan", total_ms: int = 0,
+             max_workers: int = MAX_CONCURRENT_REQUESTS, ledger=None, cache_dir: str = TTS_CACHE_DIR):
+    """
+    Synthesizes every translated cue and assembles them into one dub track aligned to the cue timings.
+
+    Every distinct line is synthesized once, concurrently, and cached by text, voice and model so
+    re-runs only synthesize new lines. The track is then mixed a window at a time: each clip is read
+    back from the cache, fitted to its cue window and decoded only shortly before its window is mixed,
+    so the track lines up with the video, can be muxed onto it directly, and is never held whole.
+
+    Args:
+        cues (list of (int, int, str)): Translated (start_ms, end_ms, text) cues.
+
+        output_path (str): Where to write the dub, as a .wav file.
+
+        backend: Anything with a synthesize(text, voice) -> bytes method, e.g. ElevenLabsBackend.
+
+        voice (str): Voice to synthesize with.
+
+        total_ms (int): Length of the original audio, so the dub lasts as long as the video.
+
+        max_workers (int): Number of lines synthesized at once.
+
+        ledger (QuotaLedger): Optional shared quota ledger. The characters of the distinct lines that
+        aren't cached are reserved before anything is sent.
+
+        cache_dir (str): Directory the synthesized clips are cached in.
+
+    Returns:
+        str: The path of the dub track.
+
+    Raises:
+        SynthesisFailed: If a line still can't be synthesized after retrying.
+
+        QuotaExceeded: If the ledger can't cover the uncached characters. Nothing is sent then.
+    """
+    model = getattr(backend, "model", TTS_MODEL)
+    cues = sorted(
+        [(start_ms, end_ms, text.strip()) for start_ms, end_ms, text in cues if text.strip()],
+        key=lambda cue: cue[0]
+    )
+    # Recurring lines ("Yeah.", "What?") are only sent, and charged, once
+    uncached = {}
+    for _, _, text in cues:
+        cache_path = _clip_path(text, voice, model, cache_dir)
+        if cache_path not in uncached and not os.path.exists(cache_path):
+            uncached[cache_path] = text
+    reservation = None
+    if ledger is not None and uncached:
+        reservation = ledger.reserve(TTS_PROVIDER, {"characters": sum(len(text) for text in uncached.values())})
+
+    def synthesize_line(text):
+        _, cached = synthesize_clip(backend, text, voice, cache_dir)
+        if not cached and reservation is not None:
+            reservation.consume({"characters": len(text)})
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(instrumentation.propagate(synthesize_line), uncached.values()))
+    finally:
+        if reservation is not None:
+            reservation.release()
+    print(f"dub_cues[cues: {len(cues)}, synthesized: {len(uncached)}, output_path: {output_path}]")
+
+    decode = instrumentation.propagate(_fit_cached_clip)
+    clips = (
+        (
+            start_ms,
+            cues[i + 1][0] if i + 1 < len(cues) else None,
+            functools.partial(decode, _clip_path(text, voice, model, cache_dir), end_ms - start_ms)
+        )
+        for i, (start_ms, end_ms, text) in enumerate(cues)
+    )
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        return write_track(mix_clips(_decode_ahead(clips, executor), total_ms), output_path)
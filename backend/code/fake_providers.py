@@ -0,0 +1,391 @@
+import base64
+from collections import namedtuple
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import math
+import queue
+import rate_limiter
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import wave
+
+# Same provider names as quota_ledger, so settings and stats line up with the real ones
+WHISPER = "openai_whisper"
+TRANSLATE = "google_translate"
+TTS = "elevenlabs"
+IBM = "ibm_speech_to_text"
+
+# How a stand-in behaves. Every response waits latency_secs plus secs_per_unit for every unit of work
+# in the request (audio seconds for speech to text, characters for translation and speech synthesis).
+# requests_per_minute is None for no limit, past it requests are refused with a 429 like the real APIs.
+ProviderProfile = namedtuple("ProviderProfile", ["latency_secs", "secs_per_unit", "requests_per_minute"])
+
+DEFAULT_PROFILES = {
+    WHISPER: ProviderProfile(0.5, 0.01, None),
+    TRANSLATE: ProviderProfile(0.2, 0.00005, None),
+    TTS: ProviderProfile(0.3, 0.005, None),
+    IBM: ProviderProfile(0.5, 0.02, None),
+}
+
+# One made up cue every CUE_SECS of audio
+CUE_SECS = 3
+# Whisper chunks are mp3 at ffmpeg's default libmp3lame bitrate, which is how long a chunk is estimated to be
+MP3_BITRATE = 128000
+TTS_SAMPLE_RATE = 22050
+# Roughly how long a synthesized character takes to say
+TTS_MS_PER_CHAR = 60
+
+# RFC 6455 constants for the websocket recognizer stand-in
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+def _audio_secs(audio: bytes):
+    if audio[:4] == b"RIFF":
+        with wave.open(io.BytesIO(audio), "rb") as wav_file:
+            return wav_file.getnframes() / wav_file.getframerate()
+    return len(audio) * 8 / MP3_BITRATE
+
+def _multipart_file(body: bytes, content_type: str):
+    """Returns the content of the file field of a multipart/form-data body."""
+    boundary = content_type.partition("boundary=")[2].strip('"').encode()
+    for part in body.split(b"--" + boundary):
+        head, _, data = part.partition(b"\r\n\r\n")
+        if b'filename="' in head:
+            return data[:-2] if data.endswith(b"\r\n") else data
+    return b""
+
+def _cue_text(number: int):
+    return f"This is line {number} of the benchmark transcript."
+
+def _srt_time(ms: int):
+    return f"{ms // 3600000:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02},{ms % 1000:03}"
+
+def fake_srt(audio_secs: float):
+    # Formatted here rather than with subtitles, so the stand-in can't share a bug with the client it tests
+    blocks = []
+    for i in range(max(1, math.ceil(audio_secs / CUE_SECS))):
+        start_ms = i * CUE_SECS * 1000
+        end_ms = max(start_ms + 1, min(int(audio_secs * 1000), start_ms + CUE_SECS * 1000 - 200))
+        blocks.append(f"{i + 1}\n{_srt_time(start_ms)} --> {_srt_time(end_ms)}\n{_cue_text(i + 1)}\n")
+    return "\n".join(blocks)
+
+def _ibm_result(number: int, start: float, end: float):
+    words = _cue_text(number).rstrip(".").split()
+    step = (end - start) / len(words)
+    timestamps = [[word, round(start + j * step, 2), round(start + (j + 1) * step, 2)] for j, word in enumerate(words)]
+    return {
+        "final": True,
+        "alternatives": [{"transcript": " ".join(words) + " ", "confidence": 0.9, "timestamps": timestamps}],
+    }
+
+def fake_ibm_response(audio_secs: float):
+    results = []
+    for i in range(max(1, math.ceil(audio_secs / CUE_SECS))):
+        results.append(_ibm_result(i + 1, i * CUE_SECS, min(audio_secs, (i + 1) * CUE_SECS)))
+    return {"result_index": 0, "results": results}
+
+def fake_speech(text: str):
+    """A .wav of silence as long as 'text' would take to say. FFmpeg reads it whatever it's named."""
+    frames = int(len(text) * TTS_MS_PER_CHAR * TTS_SAMPLE_RATE / 1000)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(TTS_SAMPLE_RATE)
+        wav_file.writeframes(b"\0\0" * frames)
+    return buffer.getvalue()
+
+def _read_frame(stream):
+    """Reads one websocket frame. Returns (opcode, payload), or (None, b"") once the connection is gone."""
+    header = stream.read(2)
+    if len(header) < 2:
+        return None, b""
+    opcode = header[0] & 0x0F
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", stream.read(2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", stream.read(8))[0]
+    mask = stream.read(4) if header[1] & 0x80 else None
+    payload = stream.read(length)
+    if mask and payload:
+        # Client frames are masked, XORed here as one big integer rather than byte by byte
+        mask = (mask * (length // 4 + 1))[:length]
+        payload = (int.from_bytes(payload, "big") ^ int.from_bytes(mask, "big")).to_bytes(length, "big")
+    return opcode, payload
+
+def _frame(opcode: int, payload: bytes):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack(">BB", 0x80 | opcode, length)
+    elif length < 2 ** 16:
+        header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, content_type, payload, headers = self.server.providers.handle(
+            urllib.parse.urlsplit(self.path).path, self.headers, body
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path != "/v1/recognize" or self.headers.get("Upgrade", "").lower() != "websocket":
+            self.send_error(404)
+            return
+        self.server.providers.handle_recognize_websocket(self)
+
+class FakeProviders:
+    """
+    Local stand-ins for Whisper, Google Translate, ElevenLabs and IBM Speech to Text, on one HTTP server.
+
+    Each stand-in answers the same endpoint the real client calls (HTTPWhisperBackend, translate_v2
+    with an api_endpoint, HTTPTTSBackend and SpeechToTextV1 with a service url) with made up but well
+    formed output sized to the request: a cue every CUE_SECS of audio, tagged translations, and silent
+    clips as long as the text. Latency and rate limits come from each provider's ProviderProfile, and
+    every request is counted, so a run can be checked against what the pipeline thinks it sent.
+
+    Args:
+        profiles (dict): {provider: ProviderProfile}. Providers left out use DEFAULT_PROFILES.
+
+        host (str): Interface to listen on.
+
+        port (int): Port to listen on, 0 picks a free one.
+    """
+    def __init__(self, profiles: dict = None, host: str = "127.0.0.1", port: int = 0):
+        self.profiles = {**DEFAULT_PROFILES, **(profiles or {})}
+        self._limiters = {
+            provider: rate_limiter.per_minute(profile.requests_per_minute)
+            for provider, profile in self.profiles.items() if profile.requests_per_minute
+        }
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.providers = self
+        self._thread = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def job_options(self):
+        """Job options (see dubbing_stages) that point a job's providers at the stand-ins."""
+        return {
+            "whisper_base_url": f"{self.base_url}/v1",
+            "translate_endpoint": self.base_url,
+            "elevenlabs_base_url": self.base_url,
+        }
+
+    @property
+    def ibm_service_url(self):
+        return self.base_url
+
+    @property
+    def ibm_websocket_url(self):
+        """Service url for IBM's websocket recognizer, e.g. for streaming_dub.ibm_service()."""
+        return self.base_url.replace("http://", "ws://", 1)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        print(f"FakeProviders.start[base_url: {self.base_url}]")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {provider: {"requests": 0, "rejected": 0, "units": 0} for provider in self.profiles}
+
+    def stats(self):
+        with self._lock:
+            return {provider: dict(stats) for provider, stats in self._stats.items()}
+
+    def _route(self, path: str):
+        if path.endswith("/audio/transcriptions"):
+            return WHISPER
+        if path.startswith("/language/translate/v2"):
+            return TRANSLATE
+        if path.startswith("/v1/text-to-speech/"):
+            return TTS
+        if path == "/v1/recognize":
+            return IBM
+        return None
+
+    def handle(self, path: str, headers, body: bytes):
+        """Answers one request. Returns (status, content type, payload, extra headers)."""
+        provider = self._route(path)
+        if provider is None:
+            return 404, "application/json", b'{"error": "not found"}', {}
+
+        with self._lock:
+            self._stats[provider]["requests"] += 1
+        limiter = self._limiters.get(provider)
+        wait = limiter.try_acquire() if limiter is not None else 0
+        if wait > 0:
+            with self._lock:
+                self._stats[provider]["rejected"] += 1
+            error = json.dumps({"error": {"code": 429, "message": "Rate limit reached"}}).encode("utf-8")
+            return 429, "application/json", error, {"Retry-After": str(math.ceil(wait))}
+
+        if provider == WHISPER:
+            units = _audio_secs(_multipart_file(body, headers.get("Content-Type", "")))
+            content_type, payload = "text/plain", fake_srt(units).encode("utf-8")
+        elif provider == TRANSLATE:
+            request = json.loads(body or b"{}")
+            texts = request.get("q", [])
+            texts = [texts] if isinstance(texts, str) else texts
+            target = request.get("target", "")
+            units = sum(len(text) for text in texts)
+            translations = [{"translatedText": f"[{target}] {text}", "detectedSourceLanguage": "en"} for text in texts]
+            content_type, payload = "application/json", json.dumps({"data": {"translations": translations}}).encode("utf-8")
+        elif provider == TTS:
+            text = json.loads(body or b"{}").get("text", "")
+            units = len(text)
+            content_type, payload = "audio/mpeg", fake_speech(text)
+        else:
+            units = _audio_secs(body)
+            content_type, payload = "application/json", json.dumps(fake_ibm_response(units)).encode("utf-8")
+
+        with self._lock:
+            self._stats[provider]["units"] += units
+        profile = self.profiles[provider]
+        time.sleep(profile.latency_secs + profile.secs_per_unit * units)
+        return 200, content_type, payload, {}
+
+    def handle_recognize_websocket(self, handler):
+        """
+        IBM's websocket recognizer: a final result for every CUE_SECS of audio streamed in.
+
+        Follows IBM's protocol: a "start" message is answered with {"state": "listening"}, binary
+        messages carry the audio, and "stop" is answered with the results for any audio left over and
+        another {"state": "listening"}. Each result goes out latency_secs (plus secs_per_unit for its
+        audio) after the audio it covers has arrived, so a client sees a live recognizer's delay.
+        """
+        key = handler.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        handler.send_response(101, "Switching Protocols")
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        send_lock = threading.Lock()
+
+        def send(opcode: int, payload: bytes):
+            with send_lock:
+                handler.wfile.write(_frame(opcode, payload))
+                handler.wfile.flush()
+
+        with self._lock:
+            self._stats[IBM]["requests"] += 1
+        limiter = self._limiters.get(IBM)
+        if limiter is not None and limiter.try_acquire() > 0:
+            with self._lock:
+                self._stats[IBM]["rejected"] += 1
+            send(OPCODE_TEXT, json.dumps({"error": "Rate limit reached", "code": 429}).encode("utf-8"))
+            send(OPCODE_CLOSE, struct.pack(">H", 1008))
+            return
+
+        # Results are sent from their own thread at their due time, in order, so reading never stalls
+        profile = self.profiles[IBM]
+        delay = profile.latency_secs + profile.secs_per_unit * CUE_SECS
+        outbox = queue.Queue()
+
+        def send_loop():
+            while True:
+                item = outbox.get()
+                if item is None:
+                    return
+                due, message = item
+                time.sleep(max(0.0, due - time.monotonic()))
+                try:
+                    send(OPCODE_TEXT, json.dumps(message).encode("utf-8"))
+                except OSError:
+                    return
+
+        sender = threading.Thread(target=send_loop, daemon=True)
+        sender.start()
+        bytes_per_sec = 16000 * 2
+        received = 0
+        sent_secs = 0.0
+        result_index = 0
+        try:
+            while True:
+                opcode, payload = _read_frame(handler.rfile)
+                if opcode is None:
+                    break
+                if opcode == OPCODE_CLOSE:
+                    send(OPCODE_CLOSE, payload[:2])
+                    break
+                if opcode == OPCODE_PING:
+                    send(OPCODE_PONG, payload)
+                elif opcode == OPCODE_TEXT:
+                    message = json.loads(payload or b"{}")
+                    if message.get("action") == "start":
+                        content_type = message.get("content-type", "")
+                        # audio/l16 is 16-bit PCM
+                        rate = re.search(r"rate=(\d+)", content_type)
+                        channels = re.search(r"channels=(\d+)", content_type)
+                        bytes_per_sec = 2 * int(rate.group(1) if rate else 16000) * int(channels.group(1) if channels else 1)
+                        outbox.put((time.monotonic(), {"state": "listening"}))
+                    elif message.get("action") == "stop":
+                        audio_secs = received / bytes_per_sec
+                        if audio_secs > sent_secs:
+                            outbox.put((time.monotonic() + delay, {
+                                "result_index": result_index,
+                                "results": [_ibm_result(result_index + 1, sent_secs, audio_secs)],
+                            }))
+                            result_index += 1
+                            sent_secs = audio_secs
+                        outbox.put((time.monotonic() + delay, {"state": "listening"}))
+                elif opcode == OPCODE_BINARY:
+                    received += len(payload)
+                    while sent_secs + CUE_SECS <= received / bytes_per_sec:
+                        outbox.put((time.monotonic() + delay, {
+                            "result_index": result_index,
+                            "results": [_ibm_result(result_index + 1, sent_secs, sent_secs + CUE_SECS)],
+                        }))
+                        result_index += 1
+                        sent_secs += CUE_SECS
+        finally:
+            outbox.put(None)
+            sender.join()
+            with self._lock:
+                self._stats[IBM]["units"] += received / bytes_per_sec
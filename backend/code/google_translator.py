@@ -0,0 +1,252 @@
+from concurrent.futures import ThreadPoolExecutor
+import html
+import instrumentation
+import os
+import queue
+import subtitles
+import threading
+import time
+import translation_cache
+
+# Transport level failures of the client's HTTP stack, on top of the builtin ones. Each package is
+# optional here, the client only needs whichever of them it was installed with.
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError)
+try:
+    import requests
+    RETRYABLE_ERRORS += (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+except ImportError:
+    pass
+try:
+    from google.api_core import exceptions as api_exceptions
+    RETRYABLE_ERRORS += (
+        api_exceptions.TooManyRequests, api_exceptions.InternalServerError, api_exceptions.BadGateway,
+        api_exceptions.ServiceUnavailable, api_exceptions.GatewayTimeout
+    )
+except ImportError:
+    pass
+try:
+    from google.auth.exceptions import TransportError
+    RETRYABLE_ERRORS += (TransportError,)
+except ImportError:
+    pass
+
+GOOGLE_CREDENTIALS_PATH = "./credentials/autodubber-f5336cc011ff.json"
+
+# Translation API v2 request limits: at most 128 strings per request, and Google recommends
+# keeping a request under 30K code points
+MAX_SEGMENTS_PER_REQUEST = 128
+MAX_CHARS_PER_REQUEST = 30000
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Name translations are cached under, so a different engine never serves another's output
+ENGINE_NAME = "google-translate-v2"
+# Segments are plain subtitle text, so nothing in them is read as markup
+TEXT_FORMAT = "text"
+HTML_FORMAT = "html"
+GOOGLE_PROVIDER = "google_translate"
+
+class TranslationFailed(Exception):
+    def __init__(self, message="Google Translate failed to translate the text after retrying."):
+        self.message = message
+        super().__init__(self.message)
+
+class TranslateClientPool:
+    """
+    A small pool of reusable translate_v2 clients.
+
+    Building a client loads the credentials and sets up an HTTP session, so clients are created once
+    and then checked out and back in by the worker threads instead of being rebuilt on every call.
+
+    Args:
+        size (int): Maximum number of clients the pool will create.
+
+        credentials_path (str): Service account json used by the clients.
+
+        api_endpoint (str): Optional endpoint override, e.g. a local fake translate server.
+    """
+    def __init__(self, size: int = 4, credentials_path: str = GOOGLE_CREDENTIALS_PATH, api_endpoint: str = None):
+        self.size = size
+        self.credentials_path = credentials_path
+        self.api_endpoint = api_endpoint
+        self._clients = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_client(self):
+        from google.cloud import translate_v2 as translate
+        if self.api_endpoint:
+            from google.auth.credentials import AnonymousCredentials
+            return translate.Client(credentials=AnonymousCredentials(), client_options={"api_endpoint": self.api_endpoint})
+        os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", self.credentials_path)
+        return translate.Client()
+
+    def checkout(self):
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._new_client()
+        return self._clients.get()
+
+    def checkin(self, client):
+        self._clients.put(client)
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_client_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = TranslateClientPool()
+        return _default_pool
+
+def make_batches(segments, max_segments: int = MAX_SEGMENTS_PER_REQUEST, max_chars: int = MAX_CHARS_PER_REQUEST):
+    """
+    Packs (segment_id, text) pairs into batches that fit a single translate request.
+
+    Returns:
+        list of list of (segment_id, text): The batches, in the original segment order.
+    """
+    batches = []
+    batch = []
+    batch_chars = 0
+    for segment_id, text in segments:
+        if batch and (len(batch) >= max_segments or batch_chars + len(text) > max_chars):
+            batches.append(batch)
+            batch = []
+            batch_chars = 0
+        batch.append((segment_id, text))
+        batch_chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS) or getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+@instrumentation.instrumented("translate")
+def translate_segments(segments, target_language_code: str, pool=None, max_workers: int = 4, max_retries: int = 3,
+                       cache=None, ledger=None, format_: str = TEXT_FORMAT):
+    """
+    Translates many segments with as few requests as possible, keeping every result tied to its segment.
+
+    Segments are packed into batches up to the API's size limits and the batches are sent concurrently
+    through a pool of reused clients. Failed batches are retried with exponential backoff. Because each
+    translation comes back keyed by its segment id, nothing depends on separators like the pipe
+    surviving translation. When a cache is given it is consulted first and only the misses are sent,
+    each distinct text once.
+
+    Args:
+        segments (dict or list): {segment_id: text}, or a list of texts keyed by their index.
+
+        target_language_code (str): e.g. "es-419" for Latin American Spanish.
+
+        pool (TranslateClientPool): Clients to send the requests with. Defaults to a shared pool.
+
+        max_workers (int): Number of batches in flight at once.
+
+        max_retries (int): Attempts per batch after the first failure.
+
+        cache (TranslationCache): Optional translation memory to read from and write to.
+
+        ledger (QuotaLedger): Optional shared quota ledger. The characters that will actually be sent
+        (the cache misses, each distinct text once) are reserved before any request goes out, and
+        each batch is recorded against the ledger once it has been translated. Failed attempts
+        aren't charged.
+
+        format_ (str): TEXT_FORMAT or HTML_FORMAT, how the API reads the segments. HTML entities in
+        the results are only unescaped for HTML_FORMAT, in text mode they come back as they were sent.
+
+    Returns:
+        dict: {segment_id: translated text}.
+
+    Raises:
+        TranslationFailed: If a batch still fails after all retries.
+
+        QuotaExceeded: If the ledger can't cover the uncached characters. Nothing is sent then.
+    """
+    if not isinstance(segments, dict):
+        segments = dict(enumerate(segments))
+    pool = pool or get_client_pool()
+
+    translations = {segment_id: "" for segment_id, text in segments.items() if not text.strip()}
+    to_translate = {segment_id: text.strip() for segment_id, text in segments.items() if text.strip()}
+    if cache is not None:
+        hits, to_translate = cache.get_many(to_translate, target_language_code, ENGINE_NAME)
+        translations.update(hits)
+
+    # Recurring lines ("Yeah.", "What?") only need to be sent once
+    unique_texts = {}
+    for segment_id, text in to_translate.items():
+        unique_texts.setdefault(translation_cache.normalize_segment(text), text)
+    batches = make_batches(list(unique_texts.items()))
+
+    reservation = None
+    if ledger is not None and unique_texts:
+        characters = sum(len(text) for text in unique_texts.values())
+        reservation = ledger.reserve(GOOGLE_PROVIDER, {"characters": characters})
+
+    def translate_batch(batch):
+        for attempt in range(max_retries + 1):
+            client = pool.checkout()
+            instrumentation.count("api_calls")
+            instrumentation.count("bytes_out", sum(len(text.encode("utf-8")) for _, text in batch))
+            try:
+                results = client.translate(
+                    [text for _, text in batch], target_language=target_language_code, format_=format_
+                )
+                translated = [result["translatedText"] for result in results]
+                if format_ == HTML_FORMAT:
+                    translated = [html.unescape(text) for text in translated]
+                translated = [text.strip() for text in translated]
+                instrumentation.count("bytes_in", sum(len(text.encode("utf-8")) for text in translated))
+                break
+            except Exception as e:
+                if attempt == max_retries or not _is_retryable(e):
+                    raise TranslationFailed(f"Translation of {len(batch)} segments failed: {e}") from e
+                print(f"translate_segments[attempt: {attempt + 1}, error: {e}]")
+                instrumentation.count("retries")
+                time.sleep(2 ** attempt)
+            finally:
+                pool.checkin(client)
+        # Only a batch that came back is charged, outside the try so a QuotaExceeded isn't retried
+        if reservation is not None:
+            reservation.consume({"characters": sum(len(text) for _, text in batch)})
+        return translated
+
+    translated_texts = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch, results in zip(batches, executor.map(instrumentation.propagate(translate_batch), batches)):
+                for (normalized, text), translated in zip(batch, results):
+                    translated_texts[normalized] = translated
+    finally:
+        if reservation is not None:
+            reservation.release()
+    for segment_id, text in to_translate.items():
+        translations[segment_id] = translated_texts[translation_cache.normalize_segment(text)]
+
+    if cache is not None and unique_texts:
+        cache.put_many(
+            {text: translated_texts[normalized] for normalized, text in unique_texts.items()},
+            target_language_code,
+            ENGINE_NAME
+        )
+    print(f"translate_segments[segments: {len(segments)}, sent: {len(unique_texts)}, requests: {len(batches)}]")
+    return translations
+
+def translate_cues(cues, target_language_code: str, **kwargs):
+    """
+    Translates subtitle cues, pairing every translation with its cue by id.
+
+    Each cue's lines are translated together as one segment. The keyword arguments are passed on to
+    translate_segments.
+
+    Returns:
+        list of Cue: The translated cues, with the original ids and timings.
+    """
+    translations = translate_segments(subtitles.cue_texts(cues), target_language_code, **kwargs)
+    return subtitles.apply_translations(cues, translations)
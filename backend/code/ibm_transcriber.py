@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
+import instrumentation
+import transcript_cache
+from tqdm import tqdm
+
+IBM_MODEL = "en-US_BroadbandModel"
+IBM_PROVIDER = "ibm_speech_to_text"
+# The free plan allows a handful of concurrent sessions, keep well under it by default
+MAX_CONCURRENT_REQUESTS = 4
+
+def recognize_chunk(service, chunk_path: str, model: str = IBM_MODEL):
+    with open(chunk_path, "rb") as audio_file:
+        return service.recognize(
+            audio=audio_file,
+            content_type="audio/wav",
+            model=model,
+            timestamps=True
+        ).get_result()
+
+def offset_result(response, offset_secs: float):
+    """
+    Shifts every word timestamp in an IBM response by 'offset_secs'.
+
+    Returns:
+        list of dict: A copy of the response's results on the shifted timeline.
+    """
+    results = copy.deepcopy(response.get("results", []))
+    for result in results:
+        for alternative in result.get("alternatives", []):
+            for timestamp in alternative.get("timestamps", []):
+                timestamp[1] = round(timestamp[1] + offset_secs, 2)
+                timestamp[2] = round(timestamp[2] + offset_secs, 2)
+    return results
+
+def merge_responses(chunks, responses):
+    """
+    Merges per chunk IBM responses into one response on the original timeline, in chunk order.
+
+    Args:
+        chunks (list of AudioChunk): The chunk manifest the responses belong to.
+
+        responses (list of dict): The IBM response for each chunk, in the same order.
+
+    Returns:
+        dict: A response shaped like a single recognize() result covering all the chunks.
+    """
+    merged = {"result_index": 0, "results": []}
+    for chunk, response in zip(chunks, responses):
+        merged["results"].extend(offset_result(response, chunk.start_ms / 1000))
+    return merged
+
+def chunk_seconds(chunks):
+    return sum(chunk.end_ms - chunk.start_ms for chunk in chunks) / 1000
+
+@instrumentation.instrumented("transcribe_ibm")
+def transcribe_chunks(service, chunks, max_concurrency: int = MAX_CONCURRENT_REQUESTS, model: str = IBM_MODEL,
+                      store=None, audio_path: str = None, ledger=None):
+    """
+    Transcribes every chunk of a manifest with IBM Watson, several at a time.
+
+    Chunks are submitted concurrently up to 'max_concurrency' and the progress bar advances by the
+    seconds of audio in each completed chunk. Durations come from the manifest, nothing is decoded
+    again. The responses are merged back into timeline order with their word timestamps offset by the
+    chunk start.
+
+    Args:
+        service (SpeechToTextV1): An authenticated IBM Speech to Text client.
+
+        chunks (list of AudioChunk): The chunk manifest, e.g. from audio_chunker.chunk_for_ibm.
+
+        max_concurrency (int): Maximum number of requests in flight.
+
+        model (str): IBM recognition model.
+
+        store (TranscriptStore): Optional store to reuse and save per chunk responses in.
+
+        audio_path (str): The .wav the chunks were cut from, required with 'store'.
+
+        ledger (QuotaLedger): Optional shared quota ledger. The seconds of the uncached chunks are
+        reserved before any request goes out, and each chunk's seconds are recorded as used just before
+        it is sent, so concurrent jobs see the usage while the request is in flight.
+
+    Returns:
+        dict: The merged IBM response.
+
+    Raises:
+        QuotaExceeded: If the ledger can't cover the uncached seconds. Nothing is sent then.
+    """
+    responses = [None] * len(chunks)
+    fingerprints = [None] * len(chunks)
+    if store is not None:
+        fingerprints = transcript_cache.fingerprint_chunks(audio_path, chunks)
+        responses = [store.get(fingerprint, model, kind="json") for fingerprint in fingerprints]
+    missing = [i for i, response in enumerate(responses) if response is None]
+    print(f"ibm_transcriber.transcribe_chunks[chunks: {len(chunks)}, cached: {len(chunks) - len(missing)}]")
+    if not missing:
+        return merge_responses(chunks, responses)
+
+    reservation = None
+    if ledger is not None:
+        reservation = ledger.reserve(IBM_PROVIDER, {"seconds": chunk_seconds([chunks[i] for i in missing])})
+
+    def transcribe_one(i):
+        if reservation is not None:
+            reservation.consume({"seconds": (chunks[i].end_ms - chunks[i].start_ms) / 1000})
+        instrumentation.count("api_calls")
+        instrumentation.count("bytes_out", chunks[i].size_bytes)
+        response = recognize_chunk(service, chunks[i].path, model)
+        if store is not None:
+            store.put(fingerprints[i], model, response, kind="json")
+        return response
+
+    progress_bar = tqdm(
+        desc="Transcribing audio",
+        total=chunk_seconds([chunks[i] for i in missing]),
+        unit=" s",
+        dynamic_ncols=True
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(missing))) as executor:
+            futures = {executor.submit(instrumentation.propagate(transcribe_one), i): i for i in missing}
+            for future in as_completed(futures):
+                i = futures[future]
+                responses[i] = future.result()
+                progress_bar.update((chunks[i].end_ms - chunks[i].start_ms) / 1000)
+    finally:
+        progress_bar.close()
+        # Every chunk sent was already recorded by consume(), only the unused part is handed back
+        if reservation is not None:
+            reservation.release()
+
+    return merge_responses(chunks, responses)
@@ -0,0 +1,393 @@
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, subprocess CPU time just isn't recorded there
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    # Only needed where there's no /proc (e.g. macOS, Windows), peak memory isn't recorded there without it
+    psutil = None
+
+# Where finished spans go. Settings live in the environment so worker processes started by a
+# process pool record to the same places as the process that started them.
+METRICS_JSONL_ENV = "DUBBER_METRICS_JSONL"
+METRICS_PROMETHEUS_DIR_ENV = "DUBBER_METRICS_PROMETHEUS_DIR"
+# Comma separated span names to run under cProfile, or "all"
+PROFILE_ENV = "DUBBER_PROFILE"
+PROFILE_DIR = "./state/profiles"
+
+COUNTERS = ("bytes_in", "bytes_out", "api_calls", "retries")
+# How often the memory of the process and its subprocesses is sampled while spans are open
+RSS_SAMPLE_SECS = 0.05
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def _statm_rss_bytes(pid: str):
+    with open(f"/proc/{pid}/statm", "r") as file:
+        return int(file.read().split()[1]) * _PAGE_SIZE
+
+def _current_rss_bytes():
+    """
+    Resident memory of this process and of its running subprocesses (e.g. ffmpeg) right now, in bytes.
+
+    Returns (None, None) where it can't be read.
+    """
+    if os.path.exists("/proc/self/statm"):
+        try:
+            rss = _statm_rss_bytes("self")
+            children_rss = 0
+            for task in os.listdir("/proc/self/task"):
+                try:
+                    with open(f"/proc/self/task/{task}/children", "r") as file:
+                        child_pids = file.read().split()
+                except OSError:
+                    continue
+                for child_pid in child_pids:
+                    try:
+                        children_rss += _statm_rss_bytes(child_pid)
+                    except OSError:
+                        # Exited since it was listed
+                        pass
+            return rss, children_rss
+        except OSError:
+            pass
+    if psutil is not None:
+        process = psutil.Process()
+        children_rss = 0
+        for child in process.children():
+            try:
+                children_rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return process.memory_info().rss, children_rss
+    return None, None
+
+class _RSSSampler:
+    """
+    Samples the memory of the process every RSS_SAMPLE_SECS while any span is open, and keeps the
+    highest value seen by each open span. ru_maxrss can't be used for this, it's the high-water mark
+    of the whole life of the process, so every stage after the biggest one would report its peak.
+    """
+    def __init__(self):
+        self._spans = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, span):
+        with self._lock:
+            self._spans.add(span)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+        span.observe_rss(*_current_rss_bytes())
+
+    def remove(self, span):
+        span.observe_rss(*_current_rss_bytes())
+        with self._lock:
+            self._spans.discard(span)
+
+    def _run(self):
+        while True:
+            time.sleep(RSS_SAMPLE_SECS)
+            with self._lock:
+                spans = list(self._spans)
+                if not spans:
+                    self._thread = None
+                    return
+            rss, children_rss = _current_rss_bytes()
+            for span in spans:
+                span.observe_rss(rss, children_rss)
+
+_rss_sampler = _RSSSampler()
+
+def _children_cpu_seconds():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Span:
+    """
+    One timed piece of work, e.g. a pipeline stage, and the resources it used.
+
+    Wall time and CPU time are measured when the span closes. CPU time is that of the thread the span
+    runs on, plus the pool tasks it hands off through propagate(), plus the subprocesses waited on
+    meanwhile (so ffmpeg's work counts), so spans running side by side on threads don't count each
+    other's work. Peak RSS is the highest memory of the process, and separately of its running
+    subprocesses, sampled while the span is open. Counters are added to with count() while it's
+    open, and every count also goes to the enclosing spans so a stage's totals include its parts.
+    """
+    def __init__(self, name: str, labels: dict = None, parent=None):
+        self.name = name
+        self.labels = labels or {}
+        self.parent = parent
+        self.id = uuid.uuid4().hex[:16]
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.error = None
+        self._lock = threading.Lock()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        self._start_children_cpu = _children_cpu_seconds()
+        self._pool_cpu = 0.0
+        self.started = time.time()
+        self.wall_s = self.cpu_s = None
+        self.peak_rss_bytes = self.children_peak_rss_bytes = None
+        _rss_sampler.add(self)
+
+    def observe_rss(self, rss: int, children_rss: int):
+        if rss is None:
+            return
+        with self._lock:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, rss)
+            self.children_peak_rss_bytes = max(self.children_peak_rss_bytes or 0, children_rss)
+
+    def add_cpu(self, seconds: float):
+        """Adds CPU time spent for this span on another thread (see propagate), here and in the enclosing spans."""
+        span = self
+        while span is not None:
+            with span._lock:
+                span._pool_cpu += seconds
+            span = span.parent
+
+    def count(self, counter: str, amount: float = 1):
+        span = self
+        while span is not None:
+            with span._lock:
+                span.counters[counter] = span.counters.get(counter, 0) + amount
+            span = span.parent
+
+    def finish(self):
+        self.wall_s = time.perf_counter() - self._start_wall
+        children_cpu = _children_cpu_seconds() - self._start_children_cpu
+        self.cpu_s = time.thread_time() - self._start_cpu + self._pool_cpu + children_cpu
+        _rss_sampler.remove(self)
+
+    def as_dict(self):
+        return {
+            "span": self.name,
+            "id": self.id,
+            "parent": self.parent.id if self.parent is not None else None,
+            "labels": self.labels,
+            "started": self.started,
+            "wall_s": round(self.wall_s, 6),
+            "cpu_s": round(self.cpu_s, 6),
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "children_peak_rss_bytes": self.children_peak_rss_bytes,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "error": self.error,
+            **self.counters,
+        }
+
+class JsonLinesSink:
+    """Appends every finished span to a file as one json object per line."""
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            # One write per line in append mode, so lines from several processes don't interleave
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+class PrometheusSink:
+    """
+    Keeps running totals per span name in a Prometheus text file, in the node_exporter textfile
+    collector format.
+
+    Every process writes its own dubber_<pid>.prom in 'directory', so processes never overwrite each
+    other and the collector adds them all up.
+    """
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"dubber_{os.getpid()}.prom")
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def emit(self, record: dict):
+        with self._lock:
+            totals = self.totals.setdefault(record["span"], dict.fromkeys(("count", "wall_s", "cpu_s") + COUNTERS, 0))
+            totals["count"] += 1
+            totals["wall_s"] += record["wall_s"]
+            totals["cpu_s"] += record["cpu_s"]
+            for counter in COUNTERS:
+                totals[counter] += record[counter]
+            totals["peak_rss_bytes"] = max(totals.get("peak_rss_bytes", 0), record["peak_rss_bytes"] or 0)
+            self._write()
+
+    def _write(self):
+        metrics = [
+            ("dubber_span_total", "counter", "count", "Finished spans"),
+            ("dubber_span_wall_seconds_total", "counter", "wall_s", "Wall time spent in spans"),
+            ("dubber_span_cpu_seconds_total", "counter", "cpu_s", "CPU time spent in spans, subprocesses included"),
+            ("dubber_span_bytes_in_total", "counter", "bytes_in", "Bytes read or received"),
+            ("dubber_span_bytes_out_total", "counter", "bytes_out", "Bytes written or sent"),
+            ("dubber_span_api_calls_total", "counter", "api_calls", "Provider API calls made"),
+            ("dubber_span_retries_total", "counter", "retries", "Provider API calls retried"),
+            ("dubber_span_peak_rss_bytes", "gauge", "peak_rss_bytes", "Peak resident memory of the process during spans"),
+        ]
+        lines = []
+        for metric, kind, key, description in metrics:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for span_name, totals in sorted(self.totals.items()):
+                lines.append(f'{metric}{{span="{span_name}"}} {totals.get(key, 0)}')
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+def configure(jsonl_path: str = None, prometheus_dir: str = None, profile: str = None):
+    """
+    Sets where spans are recorded, for this process and any worker processes it starts.
+
+    Args:
+        jsonl_path (str): File to append one json line per span to.
+
+        prometheus_dir (str): Directory to keep Prometheus text files in.
+
+        profile (str): Comma separated span names to profile with cProfile, or "all".
+    """
+    global _sinks
+    for name, value in ((METRICS_JSONL_ENV, jsonl_path), (METRICS_PROMETHEUS_DIR_ENV, prometheus_dir),
+                        (PROFILE_ENV, profile)):
+        if value is not None:
+            os.environ[name] = value
+    with _sinks_lock:
+        _sinks = None
+
+def _get_sinks():
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            _sinks = []
+            if os.environ.get(METRICS_JSONL_ENV):
+                _sinks.append(JsonLinesSink(os.environ[METRICS_JSONL_ENV]))
+            if os.environ.get(METRICS_PROMETHEUS_DIR_ENV):
+                _sinks.append(PrometheusSink(os.environ[METRICS_PROMETHEUS_DIR_ENV]))
+        return _sinks
+
+def _should_profile(name: str):
+    names = {part.strip() for part in os.environ.get(PROFILE_ENV, "").split(",") if part.strip()}
+    return "all" in names or name in names
+
+# Only one profiler may be active at a time: spans nested in a profiled span are already covered by
+# it, and Python 3.12 refuses a second one anywhere in the process ("Another profiling tool is already
+# active") while 3.11 silently lets it take over the first one's hook.
+_profiling = threading.local()
+_profiler_slot = threading.Lock()
+
+class _SpanContext:
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.span = Span(self.name, self.labels, _current_span.get())
+        self._token = _current_span.set(self.span)
+        self._profiler = None
+        depth = getattr(_profiling, "depth", 0)
+        # The outermost profiled span of a thread profiles, if no other thread's span already is
+        if _should_profile(self.name):
+            if depth == 0 and _profiler_slot.acquire(blocking=False):
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+            _profiling.depth = depth + 1
+            self._profiled = True
+        else:
+            self._profiled = False
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self._profiled:
+            _profiling.depth -= 1
+        if self._profiler is not None:
+            self._profiler.disable()
+            _profiler_slot.release()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            self._profiler.dump_stats(os.path.join(PROFILE_DIR, f"{self.name}-{os.getpid()}-{self.span.id}.prof"))
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.span.error = f"{exc_type.__name__}: {exc}"
+        self.span.finish()
+        record = self.span.as_dict()
+        sinks = _get_sinks()
+        # Printed only when the span isn't recorded anywhere, a line per span would bury the logs
+        if not sinks:
+            print(f"span[name: {self.name}, wall_s: {record['wall_s']:.3f}, cpu_s: {record['cpu_s']:.3f}, "
+                  f"api_calls: {record['api_calls']}, retries: {record['retries']}]")
+        for sink in sinks:
+            sink.emit(record)
+
+def span(name: str, **labels):
+    """
+    Opens a span around a block: with instrumentation.span("translate", language="fr") as s: ...
+
+    With DUBBER_PROFILE naming the span (or "all"), the block also runs under cProfile and the
+    stats are dumped to PROFILE_DIR, ready for snakeviz or pstats.
+    """
+    return _SpanContext(name, labels)
+
+def instrumented(name: str):
+    """Decorator that runs every call of a function inside a span of that name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def current_span():
+    return _current_span.get()
+
+def count(counter: str, amount: float = 1):
+    """Adds to a counter (see COUNTERS) of the open span and the spans around it. Does nothing outside a span."""
+    active = _current_span.get()
+    if active is not None and amount:
+        active.count(counter, amount)
+
+def propagate(func):
+    """
+    Binds a function to the span open right now, for handing to a thread pool.
+
+    Pool threads don't inherit the caller's context, so without this their counts, and the CPU
+    time they spend, would be lost.
+    """
+    active = _current_span.get()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(active)
+        started_cpu = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+            if active is not None:
+                active.add_cpu(time.thread_time() - started_cpu)
+    return wrapper
+
+def file_size(path: str):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import dubbing_stages
+import functools
+import instrumentation
+import json
+import local_whisper
+import os
+import quota_ledger
+import uuid
+
+JOBS_DIR = "./jobs"
+CPU = "cpu"
+NETWORK = "network"
+
+# 'provider' names the API a network stage calls, so the scheduler can throttle it
+Stage = namedtuple("Stage", ["name", "func", "kind", "provider"])
+
+DEFAULT_STAGES = [
+    Stage("extract_audio", dubbing_stages.extract_audio, CPU, None),
+    Stage("detect_speech", dubbing_stages.detect_speech, CPU, None),
+    Stage("chunk_audio", dubbing_stages.chunk_audio, CPU, None),
+    Stage("transcribe", dubbing_stages.transcribe, NETWORK, "openai_whisper"),
+    Stage("translate", dubbing_stages.translate, NETWORK, "google_translate"),
+    Stage("synthesize", dubbing_stages.synthesize, NETWORK, "elevenlabs"),
+    Stage("render", dubbing_stages.render, CPU, None),
+]
+
+# How many jobs may be inside a provider's stage at once. Request rates within a stage (e.g.
+# Whisper's 3 RPM from notes/Whisper-API.md) are paced by the shared quota ledger.
+PROVIDER_CONCURRENCY = {
+    "openai_whisper": 3,
+    "google_translate": 4,
+    "elevenlabs": 2,
+}
+# Longest a job will wait for a quota to free up before giving up on it
+MAX_QUOTA_WAIT_SECS = 15 * 60
+
+def run_stage(stage_name: str, func, job: dict):
+    """Runs one stage of a job inside a span, in whatever thread or process the scheduler picked."""
+    with instrumentation.span(f"stage.{stage_name}", job=job["job_id"]):
+        return func(job)
+
+class Job:
+    """
+    One video going through the pipeline, with its own working directory and saved stage state.
+
+    Everything a job produces is written under jobs/<job_id>/, and each finished stage's outputs are
+    recorded in jobs/<job_id>/state.json, so a job that is submitted again with the same id picks up
+    at the first stage that hasn't finished.
+
+    Args:
+        video_file (str): The path to the video to dub.
+
+        target_language (str or list of str): Language code to translate into, e.g. "es-419", or a
+        list of them. The video is transcribed once and every language is fanned out from it.
+
+        job_id (str): Reuse an id to resume that job. A new id is generated when none is given.
+
+        options (dict): Per job options passed through to the stages (see dubbing_stages).
+
+        jobs_dir (str): Directory the job directories are created in.
+    """
+    def __init__(self, video_file: str, target_language: str = "es-419", job_id: str = None, options: dict = None,
+                 jobs_dir: str = JOBS_DIR):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.video_file = video_file
+        self.target_languages = [target_language] if isinstance(target_language, str) else list(target_language)
+        self.options = options or {}
+        self.work_dir = os.path.join(jobs_dir, self.job_id)
+        self.state_path = os.path.join(self.work_dir, "state.json")
+        self.stages = {}
+        self.status = "queued"
+        self.error = None
+        os.makedirs(self.work_dir, exist_ok=True)
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as file:
+                self.stages = json.load(file).get("stages", {})
+
+    @property
+    def artifacts(self):
+        artifacts = {}
+        # Copied first, a service may read a job while the scheduler records one of its stages
+        for stage in list(self.stages.values()):
+            if stage["status"] == "done":
+                artifacts.update(stage["outputs"])
+        return artifacts
+
+    def is_done(self, stage_name: str):
+        return self.stages.get(stage_name, {}).get("status") == "done"
+
+    def as_dict(self):
+        return {
+            "job_id": self.job_id,
+            "video_file": self.video_file,
+            "work_dir": self.work_dir,
+            "target_languages": self.target_languages,
+            "options": self.options,
+            "artifacts": self.artifacts,
+        }
+
+    def record(self, stage_name: str, status: str, outputs: dict = None, error: str = None):
+        self.stages[stage_name] = {"status": status, "outputs": outputs or {}, "error": error}
+        state = {
+            "job_id": self.job_id,
+            "video_file": self.video_file,
+            "target_languages": self.target_languages,
+            "stages": self.stages,
+        }
+        # Written to a temp file first so a crash never leaves a half written state behind
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file, indent=2)
+        os.replace(temp_path, self.state_path)
+
+class JobScheduler:
+    """
+    Runs many dubbing jobs concurrently on one asyncio loop.
+
+    Each job runs its stages in order, but different jobs overlap: CPU bound stages (ffmpeg,
+    chunking) go to a process pool, and network bound stages run as async tasks on threads, limited
+    per provider by PROVIDER_CONCURRENCY. A stage that hits QuotaExceeded is retried once the quota
+    has freed up, instead of failing the job.
+
+    Args:
+        stages (list of Stage): The pipeline to run. Defaults to DEFAULT_STAGES.
+
+        max_jobs (int): Maximum number of jobs in progress at once.
+
+        process_workers (int): Size of the process pool. Defaults to the number of cores.
+
+        on_event (callable): Optional callback, called with (job, stage_name, status) whenever a stage
+        starts, finishes, fails or waits on a quota.
+    """
+    def __init__(self, stages=None, max_jobs: int = 4, process_workers: int = None, on_event=None):
+        self.stages = stages or DEFAULT_STAGES
+        self.max_jobs = max_jobs
+        self.process_workers = process_workers
+        self.on_event = on_event
+        self._process_pool = None
+        self._job_slots = None
+        self._provider_slots = {}
+
+    def _emit(self, job: Job, stage_name: str, status: str):
+        print(f"JobScheduler[job: {job.job_id}, stage: {stage_name}, status: {status}]")
+        if self.on_event is not None:
+            self.on_event(job, stage_name, status)
+
+    async def _run_stage(self, job: Job, stage: Stage):
+        loop = asyncio.get_running_loop()
+        while True:
+            func = functools.partial(run_stage, stage.name, stage.func)
+            try:
+                if stage.kind == CPU:
+                    return await loop.run_in_executor(self._process_pool, func, job.as_dict())
+                slots = self._provider_slots.setdefault(
+                    stage.provider, asyncio.Semaphore(PROVIDER_CONCURRENCY.get(stage.provider, 1))
+                )
+                async with slots:
+                    return await loop.run_in_executor(None, func, job.as_dict())
+            except quota_ledger.QuotaExceeded as e:
+                if e.retry_after is None or e.retry_after > MAX_QUOTA_WAIT_SECS:
+                    raise
+                self._emit(job, stage.name, "waiting_for_quota")
+                await asyncio.sleep(e.retry_after)
+
+    async def run_job(self, job: Job):
+        async with self._job_slots:
+            job.status = "running"
+            for stage in self.stages:
+                if job.is_done(stage.name):
+                    continue
+                self._emit(job, stage.name, "started")
+                try:
+                    outputs = await self._run_stage(job, stage)
+                except Exception as e:
+                    job.record(stage.name, "failed", error=str(e))
+                    job.status = "failed"
+                    job.error = f"{stage.name}: {e}"
+                    self._emit(job, stage.name, "failed")
+                    return job
+                job.record(stage.name, "done", outputs)
+                self._emit(job, stage.name, "done")
+            job.status = "done"
+            return job
+
+    def open(self):
+        """
+        Sets the scheduler up to take jobs as they come, through run_job, rather than as one batch
+        through run (e.g. from dubbing_service). Call it from the thread the event loop runs on.
+        """
+        self._job_slots = asyncio.Semaphore(self.max_jobs)
+        self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+
+    def close(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    async def run(self, jobs):
+        """Runs all the jobs to completion (or failure) and returns them."""
+        self._job_slots = asyncio.Semaphore(self.max_jobs)
+        with ProcessPoolExecutor(max_workers=self.process_workers) as process_pool:
+            self._process_pool = process_pool
+            try:
+                return await asyncio.gather(*(self.run_job(job) for job in jobs))
+            finally:
+                self._process_pool = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Dub a batch of videos in parallel.")
+    parser.add_argument("videos", nargs="+", help="Video files to dub")
+    parser.add_argument("--language", nargs="+", default=["es-419"], help="Target language codes")
+    parser.add_argument("--max-jobs", type=int, default=4, help="Jobs in progress at once")
+    parser.add_argument("--dub", action="store_true", help="Also synthesize a dubbed audio track")
+    parser.add_argument("--speech-only", action="store_true", help="Skip non-speech audio when transcribing")
+    parser.add_argument("--whisper", choices=["api", "local"], default="api",
+                        help="Transcribe through the OpenAI API or with Whisper on this machine's CPUs")
+    parser.add_argument("--whisper-model", default=local_whisper.DEFAULT_MODEL, help="Model size for --whisper local")
+    parser.add_argument("--whisper-workers", type=int, help="Worker processes for --whisper local, defaults to the cores")
+    parser.add_argument("--metrics-jsonl", help="Append a json line per stage span to this file")
+    parser.add_argument("--metrics-prometheus-dir", help="Keep Prometheus text files of the spans in this directory")
+    parser.add_argument("--profile", help="Comma separated span names to run under cProfile, or 'all'")
+    args = parser.parse_args()
+    # Set before the process pool starts so the workers record to the same places
+    instrumentation.configure(args.metrics_jsonl, args.metrics_prometheus_dir, args.profile)
+
+    options = {"dub": args.dub, "speech_only": args.speech_only, "whisper_backend": args.whisper}
+    if args.whisper == "local":
+        options.update({"whisper_model": args.whisper_model, "whisper_workers": args.whisper_workers})
+    jobs = [Job(video, args.language, options=options) for video in args.videos]
+    jobs = asyncio.run(JobScheduler(max_jobs=args.max_jobs).run(jobs))
+    for job in jobs:
+        print(f"{job.job_id}: {job.status} {job.error or job.artifacts.get('output_paths', '')}")
+
+if __name__ == "__main__":
+    main()
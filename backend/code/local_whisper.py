@@ -0,0 +1,169 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import importlib.util
+import multiprocessing
+import os
+import pcm_buffer
+import subtitles
+import threading
+
+# faster-whisper runs CTranslate2's int8 quantized build of the same models, several times quicker on CPU
+FASTER_WHISPER = "faster-whisper"
+OPENAI_WHISPER = "openai-whisper"
+# Engine name: the module it's imported as
+ENGINES = {FASTER_WHISPER: "faster_whisper", OPENAI_WHISPER: "whisper"}
+DEFAULT_MODEL = "base"
+# Local chunks only need to be short enough to keep every worker busy, there's no upload cap to fit under
+MAX_CHUNK_SECS = 120
+# Chunks stay lossless .wav, they never leave the machine
+EXPORT_CODEC = None
+
+# The model loaded in this worker process, set once by _load_model
+_model = None
+_engine = None
+_language = None
+
+class LocalWhisperUnavailable(Exception):
+    def __init__(self, message="No local Whisper engine is installed. Run 'pip install faster-whisper' or 'pip install -U openai-whisper'."):
+        self.message = message
+        super().__init__(self.message)
+
+def installed_engine():
+    """Returns the quickest local engine that is installed, or None."""
+    for engine, module in ENGINES.items():
+        if importlib.util.find_spec(module) is not None:
+            return engine
+    return None
+
+def _load_model(engine: str, model_name: str, threads: int, language: str):
+    # Runs once in every worker process as it starts, so each chunk after that reuses the loaded model
+    global _model, _engine, _language
+    if engine == FASTER_WHISPER:
+        from faster_whisper import WhisperModel
+        _model = WhisperModel(model_name, device="cpu", compute_type="int8", cpu_threads=threads, num_workers=1)
+    else:
+        import torch
+        import whisper
+        torch.set_num_threads(threads)
+        _model = whisper.load_model(model_name, device="cpu")
+    _engine = engine
+    _language = language
+    print(f"_load_model[engine: {engine}, model: {model_name}, pid: {os.getpid()}]")
+
+def _worker_ready(_):
+    return os.getpid()
+
+def _transcribe_in_worker(audio_path: str):
+    # The chunks are already 16 kHz mono .wav files, so this maps them rather than letting Whisper run FFmpeg again
+    samples = pcm_buffer.derive(audio_path).read_mono()
+    if _engine == FASTER_WHISPER:
+        segments, _ = _model.transcribe(samples, language=_language)
+        cues = [(int(segment.start * 1000), int(segment.end * 1000), segment.text.strip()) for segment in segments]
+    else:
+        result = _model.transcribe(samples, language=_language, fp16=False)
+        cues = [
+            (int(segment["start"] * 1000), int(segment["end"] * 1000), segment["text"].strip())
+            for segment in result["segments"]
+        ]
+    return subtitles.format_cues([cue for cue in cues if cue[2]])
+
+class LocalWhisperPool:
+    """
+    Runs Whisper on this machine's CPUs, in a pool of worker processes that each load the model once.
+
+    A drop-in backend for whisper_transcriber: transcribe(audio_path) returns the same SRT the API
+    does, so chunking, caching and stitching are unchanged, but nothing counts against the OpenAI
+    quota and chunks are transcribed on as many cores as there are workers. The workers are started
+    and the model loaded into each of them up front (see start), so the first chunk doesn't pay for it.
+
+    Args:
+        model (str): Whisper model size, e.g. "base", "small" or "medium".
+
+        engine (str): FASTER_WHISPER or OPENAI_WHISPER. Defaults to whichever is installed, preferring
+        the quantized faster-whisper.
+
+        workers (int): Number of worker processes. Defaults to the cores divided by 'threads_per_worker'.
+
+        threads_per_worker (int): CPU threads each worker's model uses.
+
+        language (str): Spoken language code, e.g. "en". Detected per chunk when not given.
+
+    Raises:
+        LocalWhisperUnavailable: If neither engine is installed.
+    """
+    # Tells whisper_transcriber that chunks don't go through an API, so no rate limit or quota applies
+    provider = None
+    max_chunk_secs = MAX_CHUNK_SECS
+    export_codec = EXPORT_CODEC
+
+    def __init__(self, model: str = DEFAULT_MODEL, engine: str = None, workers: int = None, threads_per_worker: int = 1,
+                 language: str = None):
+        self.engine = engine or installed_engine()
+        if self.engine is None:
+            raise LocalWhisperUnavailable()
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown local Whisper engine: {self.engine}")
+        self.model_name = model
+        # Names the transcript cache entries, so local results are never mixed up with the API's
+        self.model = f"{self.engine}:{model}"
+        self.threads_per_worker = threads_per_worker
+        self.workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.language = language
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the workers and waits until every one of them has loaded the model."""
+        with self._lock:
+            if self._executor is not None:
+                return
+            # Spawned rather than forked, PyTorch and CTranslate2 threads don't survive a fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_model,
+                initargs=(self.engine, self.model_name, self.threads_per_worker, self.language)
+            )
+            pids = set(self._executor.map(_worker_ready, range(self.workers)))
+        print(f"LocalWhisperPool.start[model: {self.model}, workers: {len(pids)}]")
+
+    def transcribe(self, audio_path: str):
+        self.start()
+        try:
+            return self._executor.submit(_transcribe_in_worker, audio_path).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory), the next attempt starts a fresh pool
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+_default_pools = {}
+_default_pools_lock = threading.Lock()
+
+def get_default_pool(model: str = DEFAULT_MODEL, engine: str = None, workers: int = None, threads_per_worker: int = 1,
+                     language: str = None):
+    """
+    Returns the process-wide pool for a model, so every job on this machine shares the same warm workers.
+
+    Jobs asking for a different language or thread count get a pool of their own, as the workers load
+    the model with them. See LocalWhisperPool for the arguments.
+    """
+    key = (model, engine or installed_engine(), workers, threads_per_worker, language)
+    with _default_pools_lock:
+        if key not in _default_pools:
+            _default_pools[key] = LocalWhisperPool(
+                model, engine=key[1], workers=workers, threads_per_worker=threads_per_worker, language=language
+            )
+        return _default_pools[key]
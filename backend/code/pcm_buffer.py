@@ -0,0 +1,214 @@
+from collections import namedtuple
+import functools
+import numpy as np
+import os
+import struct
+import subprocess
+import uuid
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# Sample layouts a buffer can be mapped as, by (format tag, bits per sample)
+SAMPLE_DTYPES = {
+    (WAVE_FORMAT_PCM, 8): np.dtype("u1"),
+    (WAVE_FORMAT_PCM, 16): np.dtype("<i2"),
+    (WAVE_FORMAT_PCM, 32): np.dtype("<i4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype("<f4"),
+}
+# FFmpeg codec a derived buffer is written with, by the dtype asked for
+DERIVED_CODECS = {"int16": "pcm_s16le", "float32": "pcm_f32le"}
+# Buffers kept mapped at once by open_buffer
+OPEN_BUFFERS = 16
+
+WavHeader = namedtuple("WavHeader", ["sample_rate", "channels", "dtype", "data_offset", "num_frames"])
+
+class ResampleFailed(Exception):
+    def __init__(self, message="FFmpeg failed to resample the audio."):
+        self.message = message
+        super().__init__(self.message)
+
+def read_header(audio_path: str):
+    """
+    Reads where the samples of a .wav file start and how they're laid out.
+
+    Only the RIFF chunk headers are read. Integer PCM and 32-bit float files are understood, plain or
+    WAVE_FORMAT_EXTENSIBLE, and a data size left unset by a writer that couldn't seek back (e.g.
+    FFmpeg writing to a pipe) is taken from the file size.
+
+    Raises:
+        ValueError: If the file isn't a .wav file, or its sample format can't be mapped.
+    """
+    file_size = os.path.getsize(audio_path)
+    with open(audio_path, "rb") as file:
+        riff = file.read(12)
+        if riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            raise ValueError(f"{audio_path} is not a .wav file")
+        fmt = None
+        while True:
+            chunk = file.read(8)
+            if len(chunk) < 8:
+                raise ValueError(f"{audio_path} has no data chunk")
+            chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+            if chunk_id == b"data":
+                data_offset = file.tell()
+                break
+            if chunk_id == b"fmt ":
+                fmt = file.read(size)
+                file.seek(size % 2, os.SEEK_CUR)
+            else:
+                # Chunks are padded to an even size
+                file.seek(size + size % 2, os.SEEK_CUR)
+    if fmt is None:
+        raise ValueError(f"{audio_path} has no fmt chunk")
+
+    format_tag, channels, sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE:
+        # The real format is the first two bytes of the sub format GUID
+        format_tag = struct.unpack("<H", fmt[24:26])[0]
+    dtype = SAMPLE_DTYPES.get((format_tag, bits))
+    if dtype is None:
+        raise ValueError(f"Unsupported .wav sample format in {audio_path}: tag {format_tag}, {bits} bits")
+    available = file_size - data_offset
+    data_size = available if size in (0, 0xFFFFFFFF) else min(size, available)
+    return WavHeader(sample_rate, channels, dtype, data_offset, data_size // block_align)
+
+class PCMBuffer:
+    """
+    Decoded audio, memory mapped straight from a .wav file.
+
+    The file is the decoded artifact every stage shares: the header gives the sample rate and channel
+    count, and the samples are mapped rather than read, so any range of a file of any length is a
+    zero-copy NumPy view and the operating system keeps the pages in its cache for every process that
+    maps the same file (e.g. the chunk exporters). Nothing is decoded twice: derive() makes the
+    mono 16 kHz version Whisper, IBM and YAMNet want in one streaming pass, once, next to the source.
+
+    Args:
+        audio_path (str): The path to the .wav file. This path can be either absolute or relative.
+    """
+    def __init__(self, audio_path: str):
+        self.audio_path = audio_path
+        header = read_header(audio_path)
+        self.sample_rate = header.sample_rate
+        self.channels = header.channels
+        self.dtype = header.dtype
+        self.num_frames = header.num_frames
+        self.sample_width = self.dtype.itemsize
+        self.frame_size = self.channels * self.sample_width
+        if self.num_frames:
+            self.samples = np.memmap(
+                audio_path, dtype=self.dtype, mode="r", offset=header.data_offset, shape=(self.num_frames, self.channels)
+            )
+        else:
+            self.samples = np.zeros((0, self.channels), dtype=self.dtype)
+
+    @property
+    def duration_ms(self):
+        return self.frame_to_ms(self.num_frames)
+
+    def ms_to_frame(self, ms):
+        return int(round(ms * self.sample_rate / 1000))
+
+    def frame_to_ms(self, frame):
+        return int(round(frame * 1000 / self.sample_rate))
+
+    def view(self, start_frame: int = 0, num_frames: int = None):
+        """Returns frames [start_frame, start_frame + num_frames) as a zero-copy (frames, channels) array."""
+        end_frame = self.num_frames if num_frames is None else min(self.num_frames, start_frame + num_frames)
+        return self.samples[start_frame:end_frame]
+
+    def view_ms(self, start_ms: int = 0, end_ms: int = None):
+        end_frame = self.num_frames if end_ms is None else self.ms_to_frame(end_ms)
+        start_frame = self.ms_to_frame(start_ms)
+        return self.view(start_frame, max(0, end_frame - start_frame))
+
+    def read(self, start_frame: int, num_frames: int):
+        """Returns the raw interleaved PCM bytes of a range, as a bytes-like view of the mapping."""
+        return memoryview(np.ascontiguousarray(self.view(start_frame, num_frames))).cast("B")
+
+    def read_mono(self, start_frame: int = 0, num_frames: int = None):
+        """Returns a range as a mono float32 array scaled to [-1, 1]."""
+        frames = self.view(start_frame, num_frames)
+        if self.dtype.kind == "f":
+            samples = frames.astype(np.float32)
+        elif self.dtype.kind == "u":
+            samples = (frames.astype(np.float32) - 128) / 128
+        else:
+            samples = frames.astype(np.float32) / float(2 ** (8 * self.sample_width - 1))
+        return samples[:, 0] if self.channels == 1 else samples.mean(axis=1)
+
+@functools.lru_cache(maxsize=OPEN_BUFFERS)
+def _open_buffer(audio_path: str, size: int, mtime_ns: int):
+    return PCMBuffer(audio_path)
+
+def open_buffer(audio_path: str):
+    """
+    Returns the PCMBuffer of a .wav file, shared by every caller in the process.
+
+    The mapping is reused for as long as the file is unchanged, so the stages of a job all read one
+    mapping instead of opening the file again.
+    """
+    stat = os.stat(audio_path)
+    return _open_buffer(os.path.abspath(audio_path), stat.st_size, stat.st_mtime_ns)
+
+def derived_path(audio_path: str, sample_rate: int, channels: int = 1):
+    layout = "mono" if channels == 1 else f"{channels}ch"
+    return f"{os.path.splitext(audio_path)[0]}_{sample_rate // 1000}k_{layout}.wav"
+
+def derive(audio_path: str, sample_rate: int = 16000, channels: int = 1, dtype: str = "int16"):
+    """
+    Returns the audio at another sample rate and channel count, e.g. the mono 16 kHz that every
+    speech model uses.
+
+    The derived buffer is made with one streaming FFmpeg pass (downmix and resample together) and kept
+    next to the source, so every later consumer maps it instead of resampling again. A source that
+    already has the rate and channels is returned as it is. A source that isn't a .wav file (e.g. an
+    mp3) is decoded by the same pass.
+
+    Args:
+        audio_path (str): The source audio.
+
+        sample_rate (int): Sample rate of the derived buffer, in Hz.
+
+        channels (int): Channel count of the derived buffer.
+
+        dtype (str): "int16" or "float32".
+
+    Returns:
+        PCMBuffer: The derived buffer, '<name>_<rate>k_mono.wav' next to the source.
+
+    Raises:
+        ResampleFailed: If FFmpeg exits with a non-zero status.
+    """
+    try:
+        source = open_buffer(audio_path)
+        if source.sample_rate == sample_rate and source.channels == channels and source.dtype == np.dtype(dtype):
+            return source
+    except ValueError:
+        pass
+
+    output_path = derived_path(audio_path, sample_rate, channels)
+    if os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(audio_path):
+        derived = open_buffer(output_path)
+        if derived.sample_rate == sample_rate and derived.channels == channels and derived.dtype == np.dtype(dtype):
+            return derived
+
+    # Written under a temporary name so a concurrent reader never maps a half written file. The name is
+    # unique per call, two threads deriving the same file never write to one temp file.
+    temp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    command = [
+        "ffmpeg", "-nostdin", "-v", "error", "-y", "-i", audio_path,
+        "-ac", str(channels), "-ar", str(sample_rate), "-acodec", DERIVED_CODECS[dtype], "-f", "wav", temp_path
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            error = result.stderr.decode("utf-8", errors="replace").strip()
+            raise ResampleFailed(f"Could not resample {audio_path}: {error[-500:]}")
+        os.replace(temp_path, output_path)
+    finally:
+        # FFmpeg leaves a partial file behind when it fails or is interrupted
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    print(f"derive[output_path: {output_path}]")
+    return open_buffer(output_path)
@@ -0,0 +1,359 @@
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+QUOTA_LEDGER_PATH = "./state/quota_ledger.sqlite3"
+
+MINUTE = 60
+DAY = 24 * 60 * 60
+MONTH = 30 * DAY
+
+# RATE limits pace the calls themselves and only count usage that has actually happened. QUOTA
+# limits are budgets that work is reserved against up front, so reserved but unused amounts count
+# too and a job is refused before it starts instead of halfway through.
+RATE = "rate"
+QUOTA = "quota"
+
+Limit = namedtuple("Limit", ["name", "unit", "max_amount", "window_secs", "kind"])
+
+# Free tier limits, see notes/Whisper-API.md for OpenAI. The IBM budget is kept at 7h55m of the
+# plan's 500 minutes, the same margin the old MAX_TIME check kept.
+PROVIDER_LIMITS = {
+    "openai_whisper": [
+        Limit("rpm", "requests", 3, MINUTE, RATE),
+        Limit("rpd", "requests", 200, DAY, QUOTA),
+    ],
+    "google_translate": [
+        Limit("characters_per_minute", "characters", 6000000, MINUTE, RATE),
+        Limit("characters_per_month", "characters", 500000, MONTH, QUOTA),
+    ],
+    "ibm_speech_to_text": [
+        Limit("seconds_per_month", "seconds", 7 * 3600 + 55 * 60, MONTH, QUOTA),
+    ],
+    "elevenlabs": [
+        Limit("characters_per_month", "characters", 10000, MONTH, QUOTA),
+    ],
+}
+
+def _duration_seconds(text: str):
+    hours, minutes, seconds = text.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+# The counter files the ledger replaced, as (path, provider, unit, parse). Any that are still around
+# are carried over into the default ledger once and then deleted (see import_counter_files).
+LEGACY_COUNTER_FILES = [
+    ("./code/rate_limits_openai.txt", "openai_whisper", "requests", int),
+    ("./token_tracker/google_translation_api.txt", "google_translate", "characters", int),
+    ("./total_duration_ibm.txt", "ibm_speech_to_text", "seconds", _duration_seconds),
+    ("../total_duration_ibm.txt", "ibm_speech_to_text", "seconds", _duration_seconds),
+    ("./code/total_duration.txt", "ibm_speech_to_text", "seconds", _duration_seconds),
+]
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a provider's quota can't cover the requested work.
+
+    'retry_after' is how many seconds until it could, or None if it never can (the amount is larger
+    than the limit itself), so callers can reschedule the work instead of giving up on it.
+    """
+    def __init__(self, message="Provider quota exhausted. Please try again later.", retry_after: float = None):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+class QuotaLedger:
+    """
+    A single, concurrency safe record of API usage for every provider.
+
+    Usage lives in an SQLite file, and every check-and-record happens inside one immediate
+    transaction, so any number of threads and processes can share the ledger without losing
+    increments. Limits are rolling windows, so daily and monthly budgets free themselves up as
+    old usage ages out instead of needing to be reset.
+
+    Args:
+        path (str): The SQLite file. Its directory will be created if it does not exist.
+
+        limits (dict): {provider: [Limit, ...]}. Defaults to PROVIDER_LIMITS.
+
+        reservation_ttl (float): Seconds after which an unfinished reservation stops counting, so a
+        crashed job can't hold a budget forever.
+    """
+    def __init__(self, path: str = QUOTA_LEDGER_PATH, limits: dict = None, reservation_ttl: float = 6 * 3600):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.limits = limits or PROVIDER_LIMITS
+        self.reservation_ttl = reservation_ttl
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "id INTEGER PRIMARY KEY, reservation TEXT, provider TEXT, unit TEXT, amount REAL, "
+                "state TEXT, created REAL, expires REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS usage_lookup ON usage (provider, unit, created)")
+
+    def import_counter_files(self, counter_files=LEGACY_COUNTER_FILES):
+        """
+        Carries the usage in old counter files over into the ledger, then deletes the files.
+
+        Each count is recorded as used when its file was last written, so it only counts against the
+        windows it actually fell in: a daily count from last week no longer counts at all. A file that
+        can't be read is left where it is.
+
+        Args:
+            counter_files (list of (str, str, str, callable)): (path, provider, unit, parse) per file,
+            where parse turns the file's text into an amount.
+
+        Returns:
+            dict: {provider: {unit: amount}} carried over.
+        """
+        imported = {}
+        for path, provider, unit, parse in counter_files:
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "r") as file:
+                    amount = parse(file.read().strip())
+                # Never inside a per minute rate window, the count is only meant for the quotas
+                created = min(os.path.getmtime(path), time.time() - MINUTE)
+            except (OSError, ValueError) as e:
+                print(f"QuotaLedger.import_counter_files[path: {path}, error: {e}]")
+                continue
+            with self._transaction() as connection:
+                connection.execute(
+                    "INSERT INTO usage (reservation, provider, unit, amount, state, created, expires) "
+                    "VALUES (?, ?, ?, ?, 'used', ?, NULL)",
+                    (uuid.uuid4().hex, provider, unit, amount, created)
+                )
+            os.remove(path)
+            imported.setdefault(provider, {}).setdefault(unit, 0)
+            imported[provider][unit] += amount
+            print(f"QuotaLedger.import_counter_files[path: {path}, {provider}: {amount} {unit}]")
+        return imported
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads, so each thread gets its own
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return self._local.connection
+
+    def _transaction(self):
+        ledger = self
+
+        class Transaction:
+            def __enter__(self):
+                self.connection = ledger._connection()
+                self.connection.execute("BEGIN IMMEDIATE")
+                return self.connection
+
+            def __exit__(self, exc_type, exc, traceback):
+                self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+        return Transaction()
+
+    def _provider_limits(self, provider: str):
+        if provider not in self.limits:
+            raise KeyError(f"No limits configured for provider '{provider}'")
+        return self.limits[provider]
+
+    def _wait_time(self, connection, provider: str, amounts: dict, kind: str, now: float):
+        """Seconds until 'amounts' fits every 'kind' limit of the provider, or None if it never will."""
+        wait = 0.0
+        for limit in self._provider_limits(provider):
+            amount = amounts.get(limit.unit, 0)
+            if limit.kind != kind or amount <= 0:
+                continue
+            if amount > limit.max_amount:
+                return None
+            states = ("used", "reserved") if kind == QUOTA else ("used",)
+            rows = connection.execute(
+                "SELECT created, amount FROM usage WHERE provider = ? AND unit = ? AND created > ? "
+                f"AND state IN ({','.join('?' * len(states))}) AND (expires IS NULL OR expires > ?) "
+                "ORDER BY created",
+                (provider, limit.unit, now - limit.window_secs, *states, now)
+            ).fetchall()
+            excess = sum(row_amount for _, row_amount in rows) + amount - limit.max_amount
+            # Walks the window from the oldest usage until enough of it has aged out
+            for created, row_amount in rows:
+                if excess <= 0:
+                    break
+                excess -= row_amount
+                wait = max(wait, created + limit.window_secs - now)
+        return wait
+
+    def available_in(self, provider: str, amounts: dict):
+        """Seconds until 'amounts' could be reserved, 0 if it can be now, None if it never can."""
+        with self._transaction() as connection:
+            return self._wait_time(connection, provider, amounts, QUOTA, time.time())
+
+    def reserve(self, provider: str, amounts: dict, timeout: float = 0):
+        """
+        Atomically reserves 'amounts' against the provider's quota limits.
+
+        Args:
+            provider (str): e.g. "openai_whisper".
+
+            amounts (dict): {unit: amount}, e.g. {"requests": 4} or {"seconds": 312.5}.
+
+            timeout (float): How long to wait for the quota to free up. 0 fails straight away,
+            None waits as long as it takes.
+
+        Returns:
+            Reservation: Use it to consume, commit or release the reserved amounts.
+
+        Raises:
+            QuotaExceeded: If the amounts don't fit within the timeout. Nothing is reserved then.
+        """
+        reservation_id = uuid.uuid4().hex
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            with self._transaction() as connection:
+                wait = self._wait_time(connection, provider, amounts, QUOTA, now)
+                if wait == 0:
+                    connection.executemany(
+                        "INSERT INTO usage (reservation, provider, unit, amount, state, created, expires) "
+                        "VALUES (?, ?, ?, ?, 'reserved', ?, ?)",
+                        [(reservation_id, provider, unit, amount, now, now + self.reservation_ttl)
+                         for unit, amount in amounts.items() if amount > 0]
+                    )
+                    return Reservation(self, reservation_id, provider, amounts)
+            if wait is None or (deadline is not None and now + wait > deadline):
+                raise QuotaExceeded(f"{provider} quota can't cover {amounts}", retry_after=wait)
+            time.sleep(min(wait, MINUTE))
+
+    def _consume(self, reservation_id: str, provider: str, amounts: dict, timeout: float = None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            with self._transaction() as connection:
+                # Whatever the reservation (if any) no longer covers, e.g. a retry, has to fit the quotas itself
+                unreserved = {}
+                for unit, amount in amounts.items():
+                    reserved = connection.execute(
+                        "SELECT COALESCE(SUM(amount), 0) FROM usage "
+                        "WHERE reservation = ? AND unit = ? AND state = 'reserved' AND (expires IS NULL OR expires > ?)",
+                        (reservation_id, unit, now)
+                    ).fetchone()[0]
+                    if amount > reserved:
+                        unreserved[unit] = amount - reserved
+                quota_wait = self._wait_time(connection, provider, unreserved, QUOTA, now) if unreserved else 0
+                if quota_wait != 0:
+                    # Quotas free up over days, not seconds, so this doesn't wait like the rate limits below
+                    raise QuotaExceeded(f"{provider} quota can't cover {unreserved} beyond what was reserved",
+                                        retry_after=quota_wait)
+                wait = self._wait_time(connection, provider, amounts, RATE, now)
+                if wait == 0:
+                    for unit, amount in amounts.items():
+                        # Moves the amount out of the reservation (if any is left) and into used
+                        connection.execute(
+                            "UPDATE usage SET amount = MAX(amount - ?, 0) "
+                            "WHERE reservation = ? AND unit = ? AND state = 'reserved'",
+                            (amount, reservation_id, unit)
+                        )
+                        connection.execute(
+                            "INSERT INTO usage (reservation, provider, unit, amount, state, created, expires) "
+                            "VALUES (?, ?, ?, ?, 'used', ?, NULL)",
+                            (reservation_id, provider, unit, amount, now)
+                        )
+                    return
+            if wait is None or (deadline is not None and now + wait > deadline):
+                raise QuotaExceeded(f"{provider} rate limit can't fit {amounts}", retry_after=wait)
+            time.sleep(wait)
+
+    def consume(self, provider: str, amounts: dict, timeout: float = None):
+        """
+        Records unreserved usage, waiting for the provider's rate limits first.
+
+        Raises:
+            QuotaExceeded: If the amounts don't fit the provider's quotas. Nothing is recorded then.
+        """
+        self._consume(uuid.uuid4().hex, provider, amounts, timeout)
+
+    def _finish(self, reservation_id: str, commit: bool):
+        now = time.time()
+        with self._transaction() as connection:
+            if commit:
+                connection.execute(
+                    "UPDATE usage SET state = 'used', created = ?, expires = NULL "
+                    "WHERE reservation = ? AND state = 'reserved' AND amount > 0",
+                    (now, reservation_id)
+                )
+            connection.execute("DELETE FROM usage WHERE reservation = ? AND state = 'reserved'", (reservation_id,))
+
+    def usage(self, provider: str):
+        """Returns {limit name: amount counted in its window right now} for a provider."""
+        now = time.time()
+        totals = {}
+        with self._transaction() as connection:
+            for limit in self._provider_limits(provider):
+                states = ("used", "reserved") if limit.kind == QUOTA else ("used",)
+                totals[limit.name] = connection.execute(
+                    "SELECT COALESCE(SUM(amount), 0) FROM usage WHERE provider = ? AND unit = ? AND created > ? "
+                    f"AND state IN ({','.join('?' * len(states))}) AND (expires IS NULL OR expires > ?)",
+                    (provider, limit.unit, now - limit.window_secs, *states, now)
+                ).fetchone()[0]
+        return totals
+
+    def prune(self):
+        """Deletes usage that has aged out of every window and reservations that expired."""
+        now = time.time()
+        longest_window = max(limit.window_secs for limits in self.limits.values() for limit in limits)
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM usage WHERE created < ? OR (state = 'reserved' AND expires < ?)",
+                (now - longest_window, now)
+            )
+
+class Reservation:
+    """
+    Amounts held against a provider's quotas for one piece of work.
+
+    Use consume() right before each API call to pace it against the rate limits and record it, or
+    commit() once the work is done to record everything reserved as used. release() hands back
+    whatever is left. As a context manager, what's left is committed on success and released if the
+    block raises.
+    """
+    def __init__(self, ledger, reservation_id: str, provider: str, amounts: dict):
+        self.ledger = ledger
+        self.id = reservation_id
+        self.provider = provider
+        self.amounts = amounts
+
+    def consume(self, amounts: dict, timeout: float = None):
+        self.ledger._consume(self.id, self.provider, amounts, timeout)
+
+    def commit(self):
+        self.ledger._finish(self.id, commit=True)
+
+    def release(self):
+        self.ledger._finish(self.id, commit=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.release()
+
+_default_ledger = None
+_default_ledger_lock = threading.Lock()
+
+def get_default_ledger():
+    global _default_ledger
+    with _default_ledger_lock:
+        if _default_ledger is None:
+            _default_ledger = QuotaLedger()
+            _default_ledger.import_counter_files()
+        return _default_ledger
+
+def set_default_ledger(ledger: QuotaLedger):
+    """Replaces the ledger get_default_ledger() hands out, e.g. with unlimited limits for a benchmark."""
+    global _default_ledger
+    with _default_ledger_lock:
+        _default_ledger = ledger
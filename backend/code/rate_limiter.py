@@ -0,0 +1,53 @@
+from collections import deque
+import threading
+import time
+
+class RateLimiter:
+    """
+    Thread-safe sliding window limiter, e.g. Whisper's 3 requests per minute on the free tier.
+
+    Every call to acquire() takes one slot. Once 'max_calls' slots have been taken inside the
+    last 'period' seconds, acquire() blocks until the oldest one falls out of the window.
+
+    Args:
+        max_calls (int): Number of calls allowed per window.
+
+        period (float): Length of the window in seconds. Defaults to one minute.
+    """
+    def __init__(self, max_calls: int, period: float = 60.0):
+        if max_calls <= 0:
+            raise ValueError("max_calls must be positive")
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def _wait_time(self, now):
+        while self._calls and now - self._calls[0] >= self.period:
+            self._calls.popleft()
+        if len(self._calls) < self.max_calls:
+            return 0
+        return self.period - (now - self._calls[0])
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    self._calls.append(now)
+                    return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Takes a slot if one is free without waiting. Returns 0 if it did, else the seconds until one frees up."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._wait_time(now)
+            if wait <= 0:
+                self._calls.append(now)
+                return 0
+            return wait
+
+def per_minute(requests_per_minute: int):
+    return RateLimiter(requests_per_minute, 60.0)
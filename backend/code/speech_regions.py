@@ -0,0 +1,207 @@
+import classify_audio_test
+import json
+import numpy as np
+import os
+import pcm_buffer
+import subtitles
+import wave
+
+# YAMNet classes that count as someone talking. Shouting and yelling are left out on purpose, in
+# sports footage they are almost always the crowd.
+SPEECH_CLASS_NAMES = (
+    "Speech",
+    "Child speech, kid speaking",
+    "Conversation",
+    "Narration, monologue",
+    "Speech synthesizer",
+    "Whispering",
+)
+# A frame is speech when its best speech class scores at least this
+SPEECH_THRESHOLD = 0.2
+# Padding kept around every region so word onsets and tails aren't clipped
+PAD_MS = 250
+# Regions closer than this are merged, pauses between sentences aren't worth a cut
+MERGE_GAP_MS = 1500
+# Regions shorter than this (after merging) are dropped as false positives
+MIN_SPEECH_MS = 500
+# Silence put between regions in the speech-only audio, so words from two regions never run together
+SEAM_MS = 500
+# List prices in USD per audio minute, only used to report what skipping non-speech saved
+PRICE_PER_MINUTE = {
+    "openai_whisper": 0.006,
+    "ibm_speech_to_text": 0.02,
+}
+
+class SpeechTimeline:
+    """
+    The speech regions of an audio file, and the mapping between it and its speech-only version.
+
+    The speech-only audio is the regions laid end to end with SEAM_MS of silence between them.
+    Anything transcribed from it is on that condensed timeline, and to_original() maps it back.
+
+    Args:
+        regions (list of (int, int)): (start_ms, end_ms) of every speech region, in order and not overlapping.
+
+        total_ms (int): Length of the original audio.
+
+        seam_ms (int): Silence between regions in the speech-only audio.
+    """
+    def __init__(self, regions, total_ms: int, seam_ms: int = SEAM_MS):
+        self.regions = [(int(start_ms), int(end_ms)) for start_ms, end_ms in regions]
+        self.total_ms = int(total_ms)
+        self.seam_ms = seam_ms
+        lengths = np.array([end_ms - start_ms for start_ms, end_ms in self.regions], dtype=np.int64)
+        # Where each region starts on the condensed timeline
+        self._condensed_starts = np.concatenate([[0], np.cumsum(lengths + seam_ms)[:-1]]).astype(np.int64)
+
+    @property
+    def speech_ms(self):
+        return sum(end_ms - start_ms for start_ms, end_ms in self.regions)
+
+    @property
+    def condensed_ms(self):
+        return self.speech_ms + self.seam_ms * max(0, len(self.regions) - 1)
+
+    def to_original(self, ms: int):
+        """Maps a time on the condensed timeline back to the original one. Times in a seam map to the end of the region before it."""
+        if not self.regions:
+            return 0
+        i = max(0, int(np.searchsorted(self._condensed_starts, ms, side="right")) - 1)
+        start_ms, end_ms = self.regions[i]
+        return start_ms + min(max(0, int(ms) - int(self._condensed_starts[i])), end_ms - start_ms)
+
+    def map_cues(self, cues):
+        """Maps cues transcribed from the speech-only audio onto the original timeline, keeping their ids."""
+        mapped = []
+        for cue in cues:
+            start_ms, end_ms, text = cue
+            mapped.append(
+                subtitles.Cue(self.to_original(start_ms), self.to_original(end_ms), text, getattr(cue, "id", None))
+            )
+        return mapped
+
+    def map_ibm_response(self, response):
+        """Maps the word timestamps of an IBM response for the speech-only audio onto the original timeline, in place."""
+        for result in response.get("results", []):
+            for alternative in result.get("alternatives", []):
+                for timestamp in alternative.get("timestamps", []):
+                    timestamp[1] = round(self.to_original(timestamp[1] * 1000) / 1000, 2)
+                    timestamp[2] = round(self.to_original(timestamp[2] * 1000) / 1000, 2)
+        return response
+
+    def savings(self, provider: str = "openai_whisper"):
+        """Returns how much audio, and roughly how much money, sending only the speech saves on a provider."""
+        skipped_secs = max(0, self.total_ms - self.condensed_ms) / 1000
+        return {
+            "total_secs": self.total_ms / 1000,
+            "sent_secs": self.condensed_ms / 1000,
+            "skipped_secs": skipped_secs,
+            "skipped_percent": round(100 * skipped_secs * 1000 / self.total_ms, 1) if self.total_ms else 0.0,
+            "saved_usd": round(skipped_secs / 60 * PRICE_PER_MINUTE.get(provider, 0), 4),
+        }
+
+    def condense(self, audio_path: str, output_path: str = None):
+        """
+        Writes the speech-only version of an audio file.
+
+        Only the regions are read from the source, block by block, and the seams are written as silence.
+
+        Returns:
+            str: The path of the speech-only .wav, '<name>_speech.wav' next to the source by default.
+        """
+        output_path = output_path or f"{os.path.splitext(audio_path)[0]}_speech.wav"
+        source = pcm_buffer.open_buffer(audio_path)
+        block = source.sample_rate * 10
+        seam = b"\0" * (source.ms_to_frame(self.seam_ms) * source.frame_size)
+        with wave.open(output_path, "wb") as output_file:
+            output_file.setnchannels(source.channels)
+            output_file.setsampwidth(source.sample_width)
+            output_file.setframerate(source.sample_rate)
+            for i, (start_ms, end_ms) in enumerate(self.regions):
+                if i > 0:
+                    output_file.writeframes(seam)
+                start_frame = source.ms_to_frame(start_ms)
+                # Every region is cut to exactly its length in ms, so the condensed offsets stay exact
+                end_frame = start_frame + source.ms_to_frame(end_ms - start_ms)
+                for position in range(start_frame, end_frame, block):
+                    output_file.writeframes(source.read(position, min(block, end_frame - position)))
+        print(f"SpeechTimeline.condense[output_path: {output_path}, regions: {len(self.regions)}]")
+        return output_path
+
+    def as_dict(self):
+        return {"regions": self.regions, "total_ms": self.total_ms, "seam_ms": self.seam_ms}
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.as_dict(), file, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        return cls(data["regions"], data["total_ms"], data.get("seam_ms", SEAM_MS))
+
+def speech_probability(scores):
+    """Returns each frame's best score over the SPEECH_CLASS_NAMES classes."""
+    class_names = classify_audio_test.load_class_names()
+    speech_ids = [class_names.index(name) for name in SPEECH_CLASS_NAMES]
+    return scores[:, speech_ids].max(axis=1)
+
+def frames_to_regions(is_speech, total_ms: int, pad_ms: int = PAD_MS, merge_gap_ms: int = MERGE_GAP_MS,
+                      min_speech_ms: int = MIN_SPEECH_MS):
+    """
+    Turns per frame speech flags into padded, merged (start_ms, end_ms) regions.
+
+    Args:
+        is_speech (numpy.ndarray): One bool per YAMNet frame.
+
+        total_ms (int): Length of the audio, regions are clipped to it.
+
+    Returns:
+        list of (int, int): The speech regions, in order.
+    """
+    hop_ms = int(classify_audio_test.FRAME_HOP_SECS * 1000)
+    frame_ms = int(classify_audio_test.FRAME_LENGTH_SECS * 1000)
+    # Runs of speech frames, found from where the flags change
+    edges = np.diff(np.concatenate([[0], np.asarray(is_speech, dtype=np.int8), [0]]))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+
+    regions = []
+    for first, last in zip(run_starts, run_ends):
+        start_ms = max(0, int(first) * hop_ms - pad_ms)
+        end_ms = min(total_ms, (int(last) - 1) * hop_ms + frame_ms + pad_ms)
+        if regions and start_ms - regions[-1][1] < merge_gap_ms:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], end_ms))
+        else:
+            regions.append((start_ms, end_ms))
+    return [(start_ms, end_ms) for start_ms, end_ms in regions if end_ms - start_ms >= min_speech_ms]
+
+def detect_speech_files(audio_files, threshold: float = SPEECH_THRESHOLD, **kwargs):
+    """
+    Finds the speech regions of many audio files, running YAMNet over them in batches.
+
+    Args:
+        audio_files (list of str): The audio files to scan.
+
+        threshold (float): Minimum speech score for a frame to count as speech.
+
+        **kwargs: Passed on to frames_to_regions.
+
+    Returns:
+        dict: {audio_file: SpeechTimeline}.
+    """
+    waveforms = [classify_audio_test.load_and_convert2mono(audio_file)[0] for audio_file in audio_files]
+    timelines = {}
+    for audio_file, waveform, scores in zip(audio_files, waveforms, classify_audio_test.score_waveforms(waveforms)):
+        total_ms = int(len(waveform) * 1000 / classify_audio_test.YAMNET_SAMPLE_RATE)
+        regions = frames_to_regions(speech_probability(scores) >= threshold, total_ms, **kwargs)
+        timelines[audio_file] = SpeechTimeline(regions, total_ms)
+        print(f"detect_speech[audio_file: {audio_file}, regions: {len(regions)}, "
+              f"savings: {timelines[audio_file].savings()}]")
+    return timelines
+
+def detect_speech(audio_path: str, **kwargs):
+    """Finds the speech regions of one audio file. See detect_speech_files."""
+    return detect_speech_files([audio_path], **kwargs)[audio_path]
@@ -0,0 +1,125 @@
+import hashlib
+import instrumentation
+import json
+import os
+import threading
+import time
+
+MANIFEST_DIR = "./state/manifests"
+HASH_BLOCK_BYTES = 1024 * 1024
+
+def hash_file(path: str):
+    """Hashes a file's content, reading it in blocks so any size of file hashes in flat memory."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class StageManifest:
+    """
+    Content-hashed checkpoints for the stages of one job, kept in a json manifest.
+
+    Every stage is recorded with a key made from the content hashes of its input files and its
+    parameters, along with the paths and hashes of the files it wrote. Running a stage whose key
+    matches the manifest, and whose outputs are still on disk unchanged, skips it and returns the
+    recorded outputs, so a re-run picks up at the first stage whose inputs actually changed. File
+    hashes are remembered by size and modification time, so unchanged files (e.g. the source video)
+    aren't read again on every run.
+
+    Args:
+        job_name (str): Names the manifest file, e.g. the video name.
+
+        manifest_dir (str): Directory the manifests are kept in. It will be created if needed.
+
+        rerun (list of str): Stages to run again even if their inputs are unchanged. A name also covers
+        its per item stages, e.g. "translate" covers "translate.es-419" and "translate.fr".
+
+    Stages of the same manifest may run concurrently from several threads.
+    """
+    def __init__(self, job_name: str, manifest_dir: str = MANIFEST_DIR, rerun=None):
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.path = os.path.join(manifest_dir, f"{job_name}.json")
+        self.rerun = set(rerun or ())
+        self.data = {"job": job_name, "stages": {}, "files": {}}
+        self._lock = threading.RLock()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.data = json.load(file)
+
+    def file_hash(self, path: str):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            entry = self.data["files"].get(os.path.abspath(path))
+        if entry is not None and entry["signature"] == signature:
+            return entry["hash"]
+        digest = hash_file(path)
+        with self._lock:
+            self.data["files"][os.path.abspath(path)] = {"signature": signature, "hash": digest}
+        return digest
+
+    def stage_key(self, stage_name: str, inputs: dict, params: dict):
+        payload = {
+            "stage": stage_name,
+            "inputs": {name: self.file_hash(path) for name, path in sorted(inputs.items())},
+            "params": params,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _outputs_intact(self, outputs: dict):
+        for output in outputs.values():
+            if not os.path.exists(output["path"]) or self.file_hash(output["path"]) != output["hash"]:
+                return False
+        return True
+
+    def run(self, stage_name: str, func, inputs: dict = None, params: dict = None):
+        """
+        Runs a stage unless its last run had the same inputs and parameters.
+
+        Args:
+            stage_name (str): Name the stage is recorded under.
+
+            func (callable): Runs the stage and returns {output name: path of a file it wrote}.
+
+            inputs (dict): {input name: file path}. Their content is hashed into the stage key.
+
+            params (dict): Any json serializable settings that change the stage's output.
+
+        Returns:
+            dict: {output name: path}, from this run or the recorded one.
+        """
+        inputs = inputs or {}
+        params = params or {}
+        key = self.stage_key(stage_name, inputs, params)
+        with self._lock:
+            entry = self.data["stages"].get(stage_name)
+        fresh = entry is not None and entry["key"] == key and self._outputs_intact(entry["outputs"])
+        if fresh and stage_name not in self.rerun and stage_name.split(".")[0] not in self.rerun:
+            print(f"StageManifest.run[stage: {stage_name}]: Inputs unchanged, skipped")
+            return {name: output["path"] for name, output in entry["outputs"].items()}
+
+        print(f"StageManifest.run[stage: {stage_name}]: Running")
+        started = time.time()
+        with instrumentation.span(f"stage.{stage_name}", job=self.data["job"]):
+            outputs = func()
+        recorded = {name: {"path": path, "hash": self.file_hash(path)} for name, path in outputs.items()}
+        with self._lock:
+            self.data["stages"][stage_name] = {
+                "key": key,
+                "inputs": inputs,
+                "params": params,
+                "outputs": recorded,
+                "seconds": round(time.time() - started, 3),
+                "finished": time.time(),
+            }
+            self.save()
+        return outputs
+
+    def save(self):
+        # Written to a temp file first so a crash never leaves a half written manifest behind
+        with self._lock:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self.data, file, indent=2)
+            os.replace(temp_path, self.path)
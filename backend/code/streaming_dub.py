@@ -0,0 +1,413 @@
+import argparse
+import audio_video_script as avs
+import bisect
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+import dubbing_tts
+import google_translator
+from ibm_cloud_sdk_core.authenticators import IAMAuthenticator, NoAuthAuthenticator
+import ibm_transcriber
+from ibm_watson import SpeechToTextV1
+from ibm_watson.websocket import RecognizeCallback, AudioSource
+import json
+import os
+import queue
+import quota_ledger
+import subtitles
+import threading
+import time
+import translation_cache
+
+STREAMS_DIR = "./streams"
+STREAM_SAMPLE_RATE = 16000
+# 100 ms of audio per websocket message
+FRAMES_PER_MESSAGE = 1600
+# Pause that ends a phrase. Shorter than IBM's 0.8 s default, so results (and subtitles) come out sooner
+END_OF_PHRASE_SILENCE_SECS = 0.4
+# Most cues translated in one request when results arrive faster than translations come back
+MAX_TRANSLATION_BATCH = 64
+# Streamed seconds are reserved against IBM's monthly budget this many at a time, before they're sent
+LEDGER_BLOCK_SECS = 60
+
+class StreamingFailed(Exception):
+    def __init__(self, message="IBM's websocket recognizer failed while streaming the audio."):
+        self.message = message
+        super().__init__(self.message)
+
+def ibm_service(service_url: str = None, credentials_path: str = "./credentials/ibm_credentials.txt"):
+    """
+    Builds an IBM Speech to Text client, from the credentials file like auto-dubber-ibm.py does.
+
+    A ws:// 'service_url' (a local stand-in, see fake_providers) gets a client without authentication.
+    """
+    if service_url and service_url.startswith("ws://"):
+        service = SpeechToTextV1(authenticator=NoAuthAuthenticator())
+    else:
+        config = configparser.ConfigParser()
+        config.read(credentials_path)
+        service = SpeechToTextV1(authenticator=IAMAuthenticator(config["Credentials"]["API_KEY"]))
+        service_url = service_url or config["Credentials"]["API_URL"]
+    service.set_service_url(service_url)
+    return service
+
+def result_to_cues(alternative: dict, max_cue_ms: int = subtitles.MAX_CUE_MS,
+                   max_cue_chars: int = subtitles.MAX_CUE_CHARS):
+    """Cuts one final IBM result into cues by its word timestamps, see subtitles.words_to_cues."""
+    return subtitles.words_to_cues(alternative.get("timestamps") or [], max_cue_ms, max_cue_chars)
+
+def latency_summary(latencies):
+    """Returns the median, 95th percentile and worst of a list of latencies, in seconds."""
+    if not latencies:
+        return {"cues": 0, "p50_s": None, "p95_s": None, "max_s": None}
+    ordered = sorted(latencies)
+    return {
+        "cues": len(ordered),
+        "p50_s": round(ordered[len(ordered) // 2], 3),
+        "p95_s": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "max_s": round(ordered[-1], 3),
+    }
+
+class StreamCallback(RecognizeCallback):
+    """Hands every final result of the websocket recognizer on as soon as it arrives."""
+    def __init__(self, on_result):
+        super().__init__()
+        self.on_result = on_result
+        self.error = None
+
+    def on_data(self, data):
+        for result in data.get("results", []):
+            if result.get("final"):
+                self.on_result(result)
+
+    def on_error(self, error):
+        print(f"StreamCallback.on_error[error: {error}]")
+        self.error = error
+
+class StreamingDubber:
+    """
+    Subtitles (and optionally dubs) a video while its audio is still being decoded.
+
+    The audio track is decoded to 16 kHz mono PCM by avs.stream_audio and fed to IBM's websocket
+    recognizer 100 ms at a time, so recognition starts with the first second of audio instead of after
+    the last. Every final result is cut into cues and written to the transcription straight away. Its
+    cues are then translated on a separate thread, which takes every cue waiting at once: when results
+    come in faster than a translation request returns they share the next request, so the delay stays
+    at about one request instead of growing with the backlog. Subtitle files are flushed cue by cue so
+    they can be tailed while the stream runs. Dubbed clips, when a TTS backend is given, are
+    synthesized on a third thread so they never hold the subtitles up.
+
+    Every cue's latency is measured from when the audio it ends on was fed to the recognizer to when
+    the cue was written.
+
+    Args:
+        service (SpeechToTextV1): IBM client, see ibm_service().
+
+        target_languages (list of str): Languages to translate into, e.g. ["es-419"].
+
+        out_dir (str): Where 'transcription.<format>', 'translation.<language>.<format>' and the clips go.
+
+        subtitle_format (str): subtitles.SRT or subtitles.VTT.
+
+        translate_pool (TranslateClientPool): Clients to translate with. Defaults to the shared pool.
+
+        tts_backend: Optional, anything with a synthesize(text, voice) -> bytes method. Clips are
+        written to out_dir/clips/<language>/ with a clips.json manifest of their timings.
+
+        voice (str): Voice to synthesize with.
+
+        model (str): IBM recognition model.
+
+        cache (TranslationCache): Optional translation memory.
+
+        ledger (QuotaLedger): Optional shared quota ledger. Streamed seconds are reserved against IBM's
+        budget a block at a time before they're sent, the translated characters against Google's, and
+        each clip that isn't cached yet against the TTS provider's characters before it's synthesized.
+
+        on_cue (callable): Optional, called with (language, Cue, latency_secs) for every cue written.
+        'language' is None for the transcription.
+    """
+    def __init__(self, service, target_languages, out_dir: str, subtitle_format: str = subtitles.VTT,
+                 translate_pool=None, tts_backend=None, voice: str = "Ryan", model: str = ibm_transcriber.IBM_MODEL,
+                 cache=None, ledger=None, on_cue=None):
+        self.service = service
+        self.target_languages = [target_languages] if isinstance(target_languages, str) else list(target_languages)
+        self.out_dir = out_dir
+        self.subtitle_format = subtitle_format
+        self.translate_pool = translate_pool or google_translator.get_client_pool()
+        self.tts_backend = tts_backend
+        self.voice = voice
+        self.model = model
+        self.cache = cache
+        self.ledger = ledger
+        self.on_cue = on_cue
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._clips = queue.Queue()
+        self._fed_ms = []
+        self._fed_at = []
+        self._next_id = 1
+        self._latencies = {}
+        self._clip_manifests = {}
+        self._errors = []
+        self._writers = {}
+        self._first_cue_at = None
+
+    def _subtitle_path(self, name: str):
+        return os.path.join(self.out_dir, f"{name}.{self.subtitle_format}")
+
+    def _latency(self, end_ms: int):
+        # Time since the audio the cue ends on was fed in
+        with self._lock:
+            if not self._fed_at:
+                return 0.0
+            i = min(bisect.bisect_left(self._fed_ms, end_ms), len(self._fed_at) - 1)
+            fed_at = self._fed_at[i]
+        return time.monotonic() - fed_at
+
+    def _write(self, language, cue):
+        latency = self._latency(cue.end_ms)
+        with self._lock:
+            self._writers[language].write(cue)
+            self._latencies.setdefault(language, []).append(latency)
+            if self._first_cue_at is None:
+                self._first_cue_at = time.monotonic()
+        print(f"StreamingDubber[{language or 'transcription'}: {cue.id}, latency_s: {latency:.2f}]")
+        if self.on_cue is not None:
+            self.on_cue(language, cue, latency)
+
+    def _on_result(self, result):
+        # Runs on the websocket thread, so it only cuts the cues and hands them on
+        for start_ms, end_ms, text in result_to_cues(result["alternatives"][0]):
+            with self._lock:
+                cue = subtitles.Cue(start_ms, end_ms, text, str(self._next_id))
+                self._next_id += 1
+            self._write(None, cue)
+            self._pending.put(cue)
+
+    def _translate_batch(self, cues, language: str):
+        try:
+            translated_cues = google_translator.translate_cues(
+                cues, language, pool=self.translate_pool, cache=self.cache, ledger=self.ledger
+            )
+        except Exception as e:
+            # A live stream carries on past a failed batch, the failure is raised once it's over
+            print(f"StreamingDubber._translate_batch[language: {language}, cues: {len(cues)}, error: {e}]")
+            self._errors.append(e)
+            return
+        for cue in translated_cues:
+            self._write(language, cue)
+            if self.tts_backend is not None:
+                self._clips.put((language, cue))
+
+    def _translate_loop(self):
+        done = False
+        # Every language is translated at the same time, so adding one doesn't delay the others
+        with ThreadPoolExecutor(max_workers=len(self.target_languages)) as executor:
+            while not done:
+                cues = [self._pending.get()]
+                while len(cues) < MAX_TRANSLATION_BATCH:
+                    try:
+                        cues.append(self._pending.get_nowait())
+                    except queue.Empty:
+                        break
+                done = None in cues
+                cues = [cue for cue in cues if cue is not None]
+                if cues:
+                    list(executor.map(lambda language: self._translate_batch(cues, language), self.target_languages))
+        self._clips.put(None)
+
+    def _dub_loop(self):
+        while True:
+            item = self._clips.get()
+            if item is None:
+                return
+            language, cue = item
+            clips_dir = os.path.join(self.out_dir, "clips", language)
+            reservation = None
+            try:
+                model = getattr(self.tts_backend, "model", dubbing_tts.TTS_MODEL)
+                cache_path = dubbing_tts._clip_path(cue.text, self.voice, model, dubbing_tts.TTS_CACHE_DIR)
+                if self.ledger is not None and not os.path.exists(cache_path):
+                    reservation = self.ledger.reserve(dubbing_tts.TTS_PROVIDER, {"characters": len(cue.text)})
+                audio, cached = dubbing_tts.synthesize_clip(self.tts_backend, cue.text, self.voice)
+                if not cached and reservation is not None:
+                    reservation.consume({"characters": len(cue.text)})
+            except Exception as e:
+                print(f"StreamingDubber._dub_loop[language: {language}, cue: {cue.id}, error: {e}]")
+                self._errors.append(e)
+                continue
+            finally:
+                if reservation is not None:
+                    reservation.release()
+            os.makedirs(clips_dir, exist_ok=True)
+            clip_path = os.path.join(clips_dir, f"{cue.id}.mp3")
+            with open(clip_path, "wb") as file:
+                file.write(audio)
+            self._clip_manifests.setdefault(language, []).append(
+                {"id": cue.id, "start_ms": cue.start_ms, "end_ms": cue.end_ms, "path": clip_path}
+            )
+            print(f"StreamingDubber[clip: {clip_path}, latency_s: {self._latency(cue.end_ms):.2f}]")
+
+    def _reserve_block(self):
+        if self.ledger is None:
+            return None
+        return self.ledger.reserve(ibm_transcriber.IBM_PROVIDER, {"seconds": LEDGER_BLOCK_SECS})
+
+    def run(self, video_file: str, realtime: bool = False):
+        """
+        Streams a video's audio through the recognizer, writing cues as they come.
+
+        Args:
+            video_file (str): The path to the video file.
+
+            realtime (bool): Feed the audio no faster than it plays, the way it would arrive from a live
+            source. Otherwise it's fed as fast as it decodes.
+
+        Returns:
+            dict: The output paths ("transcription", "translations", "clips") and per language cue
+            latencies ("latency"), plus how long the first cue took ("time_to_first_cue_s").
+
+        Raises:
+            StreamingFailed: If the recognizer reported an error, or a translation or clip failed. A clip
+            the TTS budget can't cover fails like any other.
+
+            QuotaExceeded: If IBM's budget can't cover the next block of audio. The stream stops there.
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        paths = {None: self._subtitle_path("transcription")}
+        paths.update({language: self._subtitle_path(f"translation.{language}") for language in self.target_languages})
+        files = {language: open(path, "w", encoding="utf-8") for language, path in paths.items()}
+        self._writers = {
+            language: subtitles.CueWriter(file, self.subtitle_format, flush=True) for language, file in files.items()
+        }
+        self._first_cue_at = None
+
+        audio_source = AudioSource(queue.Queue(), is_recording=True, is_buffer=True)
+        callback = StreamCallback(self._on_result)
+        recognizer = threading.Thread(
+            target=self.service.recognize_using_websocket,
+            kwargs={
+                "audio": audio_source,
+                "content_type": f"audio/l16; rate={STREAM_SAMPLE_RATE}; channels=1",
+                "recognize_callback": callback,
+                "model": self.model,
+                "interim_results": False,
+                "timestamps": True,
+                "split_transcript_at_phrase_end": True,
+                "end_of_phrase_silence_time": END_OF_PHRASE_SILENCE_SECS,
+                "inactivity_timeout": -1,
+            },
+            daemon=True
+        )
+        translator = threading.Thread(target=self._translate_loop, daemon=True)
+        dubber = threading.Thread(target=self._dub_loop, daemon=True)
+
+        threads = (recognizer, translator, dubber)
+        bytes_per_ms = STREAM_SAMPLE_RATE * 2 / 1000
+        fed_ms = 0.0
+        block_ms = 0.0
+        reservation = None
+        try:
+            # Reserved before anything starts, so a job without IBM budget stops without sending any audio
+            reservation = self._reserve_block()
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for data in avs.stream_audio(video_file, sample_rate=STREAM_SAMPLE_RATE, channels=1,
+                                         frames_per_chunk=FRAMES_PER_MESSAGE):
+                if callback.error is not None or not recognizer.is_alive():
+                    break
+                if realtime:
+                    time.sleep(max(0.0, started + fed_ms / 1000 - time.monotonic()))
+                if block_ms >= LEDGER_BLOCK_SECS * 1000:
+                    if reservation is not None:
+                        reservation.consume({"seconds": block_ms / 1000})
+                        reservation.release()
+                        # Already recorded, the finally below mustn't consume it again if the next block is refused
+                        reservation = None
+                    block_ms = 0.0
+                    reservation = self._reserve_block()
+                audio_source.input.put(data)
+                fed_ms += len(data) / bytes_per_ms
+                block_ms += len(data) / bytes_per_ms
+                with self._lock:
+                    self._fed_ms.append(fed_ms)
+                    self._fed_at.append(time.monotonic())
+        finally:
+            audio_source.completed_recording()
+            if reservation is not None:
+                reservation.consume({"seconds": block_ms / 1000})
+                reservation.release()
+            # Threads that never started (the first reservation was refused) have nothing to wait for
+            if recognizer.ident is not None:
+                recognizer.join()
+            self._pending.put(None)
+            for thread in (translator, dubber):
+                if thread.ident is not None:
+                    thread.join()
+            for file in files.values():
+                file.close()
+
+        for language, clips in self._clip_manifests.items():
+            with open(os.path.join(self.out_dir, "clips", language, "clips.json"), "w", encoding="utf-8") as file:
+                json.dump(clips, file, indent=2)
+        if callback.error is not None:
+            raise StreamingFailed(f"Recognition of {video_file} failed: {callback.error}")
+        if self._errors:
+            raise StreamingFailed(f"{len(self._errors)} translations or clips failed, the first: {self._errors[0]}")
+
+        summary = {
+            "transcription": paths[None],
+            "translations": {language: paths[language] for language in self.target_languages},
+            "clips": {
+                language: os.path.join(self.out_dir, "clips", language, "clips.json") for language in self._clip_manifests
+            },
+            "audio_secs": round(fed_ms / 1000, 3),
+            "time_to_first_cue_s": round(self._first_cue_at - started, 3) if self._first_cue_at else None,
+            "latency": {
+                language or "transcription": latency_summary(latencies) for language, latencies in self._latencies.items()
+            },
+        }
+        print(f"StreamingDubber.run[audio_secs: {summary['audio_secs']}, "
+              f"time_to_first_cue_s: {summary['time_to_first_cue_s']}, latency: {summary['latency']}]")
+        return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Subtitle and dub a video while its audio is streamed to IBM.")
+    parser.add_argument("video", help="Video file to stream")
+    parser.add_argument("--language", nargs="+", default=["es-419"], help="Target language codes")
+    parser.add_argument("--format", choices=subtitles.SUBTITLE_FORMATS, default=subtitles.VTT, help="Subtitle format")
+    parser.add_argument("--out-dir", help="Output directory, ./streams/<video name> by default")
+    parser.add_argument("--realtime", action="store_true", help="Feed the audio no faster than it plays")
+    parser.add_argument("--dub", action="store_true", help="Also synthesize a dubbed clip for every cue")
+    parser.add_argument("--voice", default="Ryan", help="Voice to dub with")
+    parser.add_argument("--ibm-url", help="IBM service url, e.g. ws://127.0.0.1:8000 for a local stand-in")
+    parser.add_argument("--translate-endpoint", help="Google Translate endpoint override")
+    parser.add_argument("--elevenlabs-url", help="ElevenLabs base url override")
+    args = parser.parse_args()
+
+    video_name = os.path.splitext(os.path.basename(args.video))[0]
+    translate_pool = None
+    if args.translate_endpoint:
+        translate_pool = google_translator.TranslateClientPool(api_endpoint=args.translate_endpoint)
+    tts_backend = None
+    if args.dub:
+        if args.elevenlabs_url:
+            tts_backend = dubbing_tts.HTTPTTSBackend(args.elevenlabs_url)
+        else:
+            tts_backend = dubbing_tts.ElevenLabsBackend(avs.get_api_credentials("./credentials/elevenlabs_creds.txt"))
+    dubber = StreamingDubber(
+        ibm_service(args.ibm_url),
+        args.language,
+        args.out_dir or os.path.join(STREAMS_DIR, video_name),
+        subtitle_format=args.format,
+        translate_pool=translate_pool,
+        tts_backend=tts_backend,
+        voice=args.voice,
+        cache=translation_cache.get_default_cache(),
+        ledger=quota_ledger.get_default_ledger()
+    )
+    dubber.run(args.video, realtime=args.realtime)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import io
+import os
+import re
+
+SRT = "srt"
+VTT = "vtt"
+SUBTITLE_FORMATS = (SRT, VTT)
+
+# SRT writes 00:01:02,500, WebVTT writes 00:01:02.500 and may leave the hours out
+TIMESTAMP_PATTERN = re.compile(r"(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+TIMING_SEPARATOR = "-->"
+# Word timed transcripts (e.g. IBM's) are cut into cues no longer than these
+MAX_CUE_MS = 5000
+MAX_CUE_CHARS = 84
+
+class Cue:
+    """
+    One subtitle cue. Times are in milliseconds and 'text' keeps the cue's line breaks.
+
+    'id' is the cue's number in an SRT file or its identifier in a VTT file, and is what translations
+    are keyed by. A cue unpacks as (start_ms, end_ms, text), so it can be used anywhere a plain tuple
+    cue is expected.
+    """
+    __slots__ = ("id", "start_ms", "end_ms", "text")
+
+    def __init__(self, start_ms: int, end_ms: int, text: str, cue_id: str = None):
+        self.id = cue_id
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.text = text
+
+    def __iter__(self):
+        yield self.start_ms
+        yield self.end_ms
+        yield self.text
+
+    def __repr__(self):
+        return f"Cue(id={self.id!r}, start_ms={self.start_ms}, end_ms={self.end_ms}, text={self.text!r})"
+
+def parse_timestamp(timestamp: str):
+    match = TIMESTAMP_PATTERN.match(timestamp.strip())
+    if match is None:
+        raise ValueError(f"Invalid subtitle timestamp: {timestamp!r}")
+    hours, minutes, seconds, millis = match.groups()
+    return ((int(hours or 0) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(millis.ljust(3, "0"))
+
+def format_timestamp(ms: int, subtitle_format: str = SRT):
+    ms = max(0, int(ms))
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    separator = "," if subtitle_format == SRT else "."
+    return f"{hours:02}:{minutes:02}:{seconds:02}{separator}{ms:03}"
+
+def _block_to_cue(block, number: int):
+    for i, line in enumerate(block):
+        if TIMING_SEPARATOR in line:
+            start, _, end = line.partition(TIMING_SEPARATOR)
+            # VTT cue settings (position, align, ...) follow the end time
+            end = end.strip().split(" ", 1)[0]
+            cue_id = block[i - 1].strip() if i > 0 else str(number)
+            return Cue(parse_timestamp(start), parse_timestamp(end), "\n".join(block[i + 1:]).strip(), cue_id)
+    # WEBVTT headers, NOTE and STYLE blocks have no timing line
+    return None
+
+def iter_cues(lines):
+    """
+    Parses SRT or VTT cues one at a time from any iterable of lines, e.g. an open file.
+
+    Only the cue being read is held in memory, so a transcript of any length parses in flat memory.
+    Lines are classified by their place in the block rather than by what they look like, so a spoken
+    line that is only digits stays text, and multi-line cues keep all of their lines.
+
+    Yields:
+        Cue: Every cue, in file order. Cues without an id get their 1-based position as one.
+    """
+    block = []
+    number = 0
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.strip():
+            block.append(line.lstrip("\ufeff") if not block else line)
+            continue
+        if block:
+            cue = _block_to_cue(block, number + 1)
+            if cue is not None:
+                number += 1
+                yield cue
+            block = []
+    if block:
+        cue = _block_to_cue(block, number + 1)
+        if cue is not None:
+            yield cue
+
+def parse_cues(subtitle_text: str):
+    """Parses SRT or VTT text into a list of Cues."""
+    return list(iter_cues(io.StringIO(subtitle_text)))
+
+def read_cues(subtitle_path: str):
+    with open(subtitle_path, "r", encoding="utf-8-sig") as file:
+        return list(iter_cues(file))
+
+class CueWriter:
+    """
+    Writes cues to a stream one at a time, e.g. as they come out of a live transcription.
+
+    SRT cues are numbered 1, 2, 3... as the format expects, VTT cues keep their ids. Plain
+    (start_ms, end_ms, text) tuples are accepted as well as Cues. With 'flush', the stream is flushed
+    after every cue, so anything tailing the file sees each cue as soon as it's written.
+    """
+    def __init__(self, stream, subtitle_format: str = SRT, flush: bool = False):
+        if subtitle_format not in SUBTITLE_FORMATS:
+            raise ValueError(f"subtitle_format must be one of {SUBTITLE_FORMATS}")
+        self.stream = stream
+        self.subtitle_format = subtitle_format
+        self.flush = flush
+        self.count = 0
+        if subtitle_format == VTT:
+            stream.write("WEBVTT\n\n")
+
+    def write(self, cue):
+        start_ms, end_ms, text = cue
+        if self.count:
+            self.stream.write("\n")
+        self.count += 1
+        if self.subtitle_format == SRT:
+            self.stream.write(f"{self.count}\n")
+        elif getattr(cue, "id", None):
+            self.stream.write(f"{cue.id}\n")
+        self.stream.write(
+            f"{format_timestamp(start_ms, self.subtitle_format)} {TIMING_SEPARATOR} "
+            f"{format_timestamp(end_ms, self.subtitle_format)}\n{text}\n"
+        )
+        if self.flush:
+            self.stream.flush()
+
+def write_cues(stream, cues, subtitle_format: str = SRT):
+    """
+    Writes cues to a stream as they come, so a generator of cues is never held in memory as a whole.
+
+    See CueWriter for how cues are numbered.
+
+    Returns:
+        int: The number of cues written.
+    """
+    writer = CueWriter(stream, subtitle_format)
+    for cue in cues:
+        writer.write(cue)
+    return writer.count
+
+def format_cues(cues, subtitle_format: str = SRT):
+    stream = io.StringIO()
+    write_cues(stream, cues, subtitle_format)
+    return stream.getvalue()
+
+def save_cues(subtitle_path: str, cues, subtitle_format: str = None):
+    """Writes cues to a file, in the format its extension names unless one is given."""
+    subtitle_format = subtitle_format or (VTT if subtitle_path.lower().endswith(".vtt") else SRT)
+    os.makedirs(os.path.dirname(subtitle_path) or ".", exist_ok=True)
+    with open(subtitle_path, "w", encoding="utf-8") as file:
+        write_cues(file, cues, subtitle_format)
+    return subtitle_path
+
+def cue_texts(cues):
+    """Returns {cue id: text} with each cue's lines joined into one, ready to be translated."""
+    return {cue.id: " ".join(cue.text.split("\n")) for cue in cues}
+
+def apply_translations(cues, translations):
+    """
+    Pairs every cue with its translation by cue id, keeping the original timings and ids.
+
+    A cue without a translation keeps its original text.
+
+    Returns:
+        list of Cue: The translated cues.
+    """
+    translated = []
+    for cue in cues:
+        text = translations.get(cue.id)
+        if text is None:
+            print(f"apply_translations[cue: {cue.id}]: No translation found, keeping the original text")
+            text = cue.text
+        translated.append(Cue(cue.start_ms, cue.end_ms, text, cue.id))
+    return translated
+
+def words_to_cues(words, max_cue_ms: int = MAX_CUE_MS, max_cue_chars: int = MAX_CUE_CHARS):
+    """
+    Cuts word timestamps into cues, none longer than 'max_cue_ms' or 'max_cue_chars'.
+
+    Words starting with "%" are markers rather than speech (e.g. IBM's "%HESITATION") and are left out.
+
+    Args:
+        words (iterable of (str, float, float)): (word, start_secs, end_secs) in order, the way IBM's
+        word timestamps come.
+
+    Returns:
+        list of (int, int, str): (start_ms, end_ms, text) cues, in order.
+    """
+    cues = []
+    cue_words = []
+    for word, start, end in words:
+        if word.startswith("%"):
+            continue
+        start_ms, end_ms = int(round(start * 1000)), int(round(end * 1000))
+        text_length = sum(len(text) + 1 for text, _, _ in cue_words) + len(word)
+        if cue_words and (end_ms - cue_words[0][1] > max_cue_ms or text_length > max_cue_chars):
+            cues.append((cue_words[0][1], cue_words[-1][2], " ".join(text for text, _, _ in cue_words)))
+            cue_words = []
+        cue_words.append((word, start_ms, end_ms))
+    if cue_words:
+        cues.append((cue_words[0][1], cue_words[-1][2], " ".join(text for text, _, _ in cue_words)))
+    return cues
+
+def cues_to_paragraph(cues, separator: str = " | "):
+    return separator.join(" ".join(cue.text.split("\n")) for cue in cues)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import numpy as np
+import os
+import pcm_buffer
+import uuid
+
+TRANSCRIPT_CACHE_DIR = "./cache/transcripts"
+# Audio is reduced to this rate and 8 bits before hashing, which is plenty to tell recordings
+# apart and keeps the fingerprint fast even on hour long files
+FINGERPRINT_SAMPLE_RATE = 4000
+FINGERPRINT_BLOCK_SECS = 30
+
+def fingerprint_audio(audio_path: str, start_ms: int = 0, end_ms: int = None):
+    """
+    Fingerprints the decoded audio of a .wav file, or a range of it.
+
+    The audio is read block by block, downmixed to mono, averaged down to FINGERPRINT_SAMPLE_RATE,
+    quantized to 8 bits and hashed, so the fingerprint follows what the audio sounds like rather
+    than how the file happens to be laid out.
+
+    Args:
+        audio_path (str): The path to the .wav file.
+
+        start_ms (int): Start of the range to fingerprint, in milliseconds.
+
+        end_ms (int): End of the range to fingerprint. Defaults to the end of the file.
+
+    Returns:
+        str: A hex digest identifying the audio.
+    """
+    source = pcm_buffer.open_buffer(audio_path)
+    start_frame = source.ms_to_frame(start_ms)
+    end_frame = source.num_frames if end_ms is None else min(source.num_frames, source.ms_to_frame(end_ms))
+    step = max(1, source.sample_rate // FINGERPRINT_SAMPLE_RATE)
+    # Blocks are a whole number of steps so every block is averaged the same way
+    block = (source.sample_rate * FINGERPRINT_BLOCK_SECS // step) * step
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{FINGERPRINT_SAMPLE_RATE}:{end_frame - start_frame}:".encode())
+    for position in range(start_frame, end_frame, block):
+        samples = source.read_mono(position, min(block, end_frame - position))
+        usable = len(samples) - len(samples) % step
+        if usable:
+            downsampled = samples[:usable].reshape(-1, step).mean(axis=1)
+            digest.update(np.clip(np.round(downsampled * 127), -127, 127).astype(np.int8).tobytes())
+    return digest.hexdigest()
+
+def fingerprint_chunks(audio_path: str, chunks):
+    """Fingerprints each chunk of a manifest by its range of the audio it was cut from."""
+    return [fingerprint_audio(audio_path, chunk.start_ms, chunk.end_ms) for chunk in chunks]
+
+class TranscriptStore:
+    """
+    On-disk store of transcription results keyed by audio fingerprint and model name.
+
+    Whisper SRT output is stored as .srt and IBM responses as .json, one file per
+    (model, fingerprint), so a re-run on the same audio never has to call the API again.
+
+    Args:
+        root (str): Directory the results are kept in. It will be created if it does not exist.
+    """
+    def __init__(self, root: str = TRANSCRIPT_CACHE_DIR):
+        self.root = root
+
+    def _path(self, fingerprint: str, model: str, kind: str):
+        return os.path.join(self.root, model.replace("/", "_"), f"{fingerprint}.{kind}")
+
+    def get(self, fingerprint: str, model: str, kind: str = "srt"):
+        """Returns the cached SRT text or IBM result dict, or None if there is none."""
+        path = self._path(fingerprint, model, kind)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file) if kind == "json" else file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, fingerprint: str, model: str, result, kind: str = "srt"):
+        path = self._path(fingerprint, model, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temp file first so a crash never leaves a half written transcript behind. The
+        # name is unique per call, since the pool's threads can store the same chunk at once
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            if kind == "json":
+                json.dump(result, file)
+            else:
+                file.write(result)
+        os.replace(temp_path, path)
+        return path
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+TRANSLATION_CACHE_PATH = "./cache/translation_memory.sqlite3"
+MAX_MEMORY_ENTRIES = 10000
+MAX_DISK_BYTES = 64 * 1024 * 1024
+
+def normalize_segment(text: str):
+    """Normalizes a source segment so "Yeah. " and "Yeah." hit the same entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(text: str, target_language_code: str, engine: str):
+    key_source = "\0".join([normalize_segment(text), target_language_code, engine])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+class TranslationCache:
+    """
+    Persistent translation memory keyed by (normalized source segment, target language, engine).
+
+    Entries live in an SQLite file on disk, with the most recently used ones also kept in an in-process
+    LRU. Once the stored translations pass 'max_disk_bytes', the least recently used rows are evicted.
+
+    Args:
+        path (str): The SQLite file. Its directory will be created if it does not exist.
+
+        max_memory_entries (int): Size of the in-process LRU.
+
+        max_disk_bytes (int): Cap on the total size of the source and translated text kept on disk.
+    """
+    def __init__(self, path: str = TRANSLATION_CACHE_PATH, max_memory_entries: int = MAX_MEMORY_ENTRIES,
+                 max_disk_bytes: int = MAX_DISK_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "key TEXT PRIMARY KEY, source TEXT, target_language TEXT, engine TEXT, "
+            "translation TEXT, size_bytes INTEGER, last_used REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+        self._connection.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, translation):
+        self._memory[key] = translation
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, segments: dict, target_language_code: str, engine: str):
+        """
+        Looks up many segments at once.
+
+        Returns:
+            (dict, dict): The cached {segment_id: translation} and the uncached {segment_id: text}.
+        """
+        hits = {}
+        misses = {}
+        keys = {segment_id: cache_key(text, target_language_code, engine) for segment_id, text in segments.items()}
+        with self._lock:
+            on_disk = []
+            in_memory = set()
+            for segment_id, key in keys.items():
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    hits[segment_id] = self._memory[key]
+                    in_memory.add(key)
+                    self.memory_hits += 1
+                else:
+                    on_disk.append(segment_id)
+
+            found = {}
+            unique_keys = list({keys[segment_id] for segment_id in on_disk})
+            # Stays well under SQLite's limit on query parameters
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, translation FROM translations WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+
+            for segment_id in on_disk:
+                key = keys[segment_id]
+                if key in found:
+                    hits[segment_id] = found[key]
+                    self._remember(key, found[key])
+                    self.disk_hits += 1
+                else:
+                    misses[segment_id] = segments[segment_id]
+                    self.misses += 1
+
+            # Memory hits are uses too, or the disk cap would evict the segments read most often
+            used = in_memory | set(found)
+            if used:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE translations SET last_used = ? WHERE key = ?", [(now, key) for key in used]
+                )
+                self._connection.commit()
+        return hits, misses
+
+    def get(self, text: str, target_language_code: str, engine: str):
+        hits, _ = self.get_many({0: text}, target_language_code, engine)
+        return hits.get(0)
+
+    def put_many(self, entries: dict, target_language_code: str, engine: str):
+        """
+        Stores translations.
+
+        Args:
+            entries (dict): {source text: translated text}.
+        """
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, translation in entries.items():
+                key = cache_key(text, target_language_code, engine)
+                self._remember(key, translation)
+                size = len(text.encode("utf-8")) + len(translation.encode("utf-8"))
+                rows.append((key, normalize_segment(text), target_language_code, engine, translation, size, now))
+            self._connection.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+            self._evict()
+
+    def put(self, text: str, target_language_code: str, engine: str, translation: str):
+        self.put_many({text: translation}, target_language_code, engine)
+
+    def _evict(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM translations").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        # Drops least recently used rows until the cache is back under 90% of the cap
+        excess = total - int(self.max_disk_bytes * 0.9)
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size_bytes FROM translations ORDER BY last_used"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._connection.executemany("DELETE FROM translations WHERE key = ?", evicted)
+        self._connection.commit()
+        for (key,) in evicted:
+            self._memory.pop(key, None)
+        print(f"TranslationCache._evict[evicted: {len(evicted)}]")
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        with self._lock:
+            entries, disk_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM translations"
+            ).fetchone()
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": entries,
+            "disk_bytes": disk_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TranslationCache()
+        return _default_cache
@@ -0,0 +1,277 @@
+from collections import namedtuple
+import instrumentation
+import os
+import re
+import subprocess
+import tempfile
+
+# x264 presets and quality levels. They trade speed for size the same way on any machine, unlike
+# hardware encoders, so a job renders the same everywhere.
+SPEED_PRESETS = {
+    "draft": {"preset": "ultrafast", "crf": 28},
+    "fast": {"preset": "veryfast", "crf": 23},
+    "balanced": {"preset": "medium", "crf": 21},
+    "quality": {"preset": "slow", "crf": 18},
+}
+SUBTITLE_MODES = ("burn", "soft", None)
+AUDIO_MODES = ("replace", "duck", "keep")
+# Soft subtitle codec for each container
+SOFT_SUBTITLE_CODECS = {".mp4": "mov_text", ".m4v": "mov_text", ".mov": "mov_text", ".mkv": "srt", ".webm": "webvtt"}
+
+# One version of a video to render: where it goes, and the subtitles and dub that go on it
+RenderTarget = namedtuple("RenderTarget", ["output_path", "subtitles_path", "dub_path"])
+RenderProgress = namedtuple("RenderProgress", ["out_time_s", "duration_s", "percent", "speed", "fps", "done"])
+
+class RenderFailed(Exception):
+    def __init__(self, message="FFmpeg failed to render the video."):
+        self.message = message
+        super().__init__(self.message)
+
+def probe_duration(media_file: str):
+    """Returns the duration of a media file in seconds, or None if ffprobe can't tell."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", media_file],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        return float(result.stdout.decode().strip())
+    except ValueError:
+        return None
+
+def _escape_filter_path(path: str):
+    """
+    Escapes a path for use as the subtitles filter's file name inside -filter_complex.
+
+    It's escaped twice, the way FFmpeg parses it: once as a filter option value (':' and quotes) and
+    then as part of the filtergraph (',', ';', '[', ']', quotes and the backslashes from the first
+    pass), so a path like 'translation.es,419.srt' can't split the graph. Forward slashes are used on
+    Windows too.
+    """
+    value = re.sub(r"([\\':])", r"\\\1", path.replace("\\", "/"))
+    return re.sub(r"([\\'\[\],;])", r"\\\1", value)
+
+def build_command(video_file: str, output_path: str, subtitles_path: str = None, subtitle_mode: str = "burn",
+                  dub_path: str = None, audio_mode: str = "replace", speed: str = "fast", threads: int = None,
+                  duck_level: float = 0.15):
+    """
+    Builds the single ffmpeg command that renders a dubbed, subtitled video.
+
+    See render_video for the arguments.
+
+    Returns:
+        list of str: The ffmpeg command line.
+    """
+    return build_multi_command(
+        video_file, [RenderTarget(output_path, subtitles_path, dub_path)], subtitle_mode=subtitle_mode,
+        audio_mode=audio_mode, speed=speed, threads=threads, duck_level=duck_level
+    )
+
+def build_multi_command(video_file: str, targets, subtitle_mode: str = "burn", audio_mode: str = "replace",
+                        speed: str = "fast", threads: int = None, duck_level: float = 0.15):
+    """
+    Builds one ffmpeg command that renders several versions of a video from a single decode.
+
+    The source video and audio are decoded once and split between the targets, each target getting
+    its own subtitles, dub and output file.
+
+    Args:
+        video_file (str): The original video.
+
+        targets (list of RenderTarget): One (output_path, subtitles_path, dub_path) per version.
+
+    See render_video for the other arguments.
+
+    Returns:
+        list of str: The ffmpeg command line.
+    """
+    if subtitle_mode not in SUBTITLE_MODES:
+        raise ValueError(f"subtitle_mode must be one of {SUBTITLE_MODES}")
+    if audio_mode not in AUDIO_MODES:
+        raise ValueError(f"audio_mode must be one of {AUDIO_MODES}")
+    if speed not in SPEED_PRESETS:
+        raise ValueError(f"speed must be one of {list(SPEED_PRESETS)}")
+
+    command = ["ffmpeg", "-nostdin", "-v", "error", "-y", "-progress", "pipe:1", "-nostats", "-i", video_file]
+    inputs = 1
+    plans = []
+    for target in targets:
+        plan = {
+            "target": target,
+            "subtitle_mode": subtitle_mode if target.subtitles_path is not None else None,
+            "audio_mode": audio_mode if target.dub_path is not None else "keep",
+            "dub_input": None,
+            "subtitle_input": None,
+        }
+        if target.dub_path is not None:
+            plan["dub_input"] = inputs
+            command += ["-i", target.dub_path]
+            inputs += 1
+        if plan["subtitle_mode"] == "soft":
+            plan["subtitle_input"] = inputs
+            command += ["-i", target.subtitles_path]
+            inputs += 1
+        plans.append(plan)
+
+    filters = []
+    # A filtered stream can only be used once, so the decoded video and audio are split between the targets
+    burning = [plan for plan in plans if plan["subtitle_mode"] == "burn"]
+    ducking = [plan for plan in plans if plan["audio_mode"] == "duck"]
+    if len(burning) > 1:
+        filters.append(f"[0:v]split={len(burning)}" + "".join(f"[v{i}]" for i in range(len(burning))))
+    if len(ducking) > 1:
+        filters.append(f"[0:a]asplit={len(ducking)}" + "".join(f"[a{i}]" for i in range(len(ducking))))
+
+    outputs = []
+    for i, plan in enumerate(plans):
+        target = plan["target"]
+        if plan["subtitle_mode"] == "burn":
+            source = f"[v{burning.index(plan)}]" if len(burning) > 1 else "[0:v]"
+            filters.append(f"{source}subtitles={_escape_filter_path(target.subtitles_path)}[vout{i}]")
+            video_map = f"[vout{i}]"
+        else:
+            video_map = "0:v:0"
+
+        if plan["audio_mode"] == "replace":
+            audio_map = f"{plan['dub_input']}:a:0"
+        elif plan["audio_mode"] == "duck":
+            # The original track is pushed down under the dub whenever the dub is speaking, then both are mixed
+            source = f"[a{ducking.index(plan)}]" if len(ducking) > 1 else "[0:a]"
+            filters.append(f"[{plan['dub_input']}:a]asplit=2[sidechain{i}][dub{i}]")
+            filters.append(
+                f"{source}[sidechain{i}]sidechaincompress=threshold={duck_level}:ratio=8:attack=20:release=300[bed{i}]"
+            )
+            filters.append(f"[bed{i}][dub{i}]amix=inputs=2:duration=first:normalize=0[aout{i}]")
+            audio_map = f"[aout{i}]"
+        else:
+            audio_map = "0:a:0?"
+
+        output = ["-map", video_map, "-map", audio_map]
+        if plan["subtitle_input"] is not None:
+            output += ["-map", f"{plan['subtitle_input']}:s:0"]
+        if plan["subtitle_mode"] == "burn":
+            preset = SPEED_PRESETS[speed]
+            output += ["-c:v", "libx264", "-preset", preset["preset"], "-crf", str(preset["crf"])]
+        else:
+            # Nothing is drawn onto the frames, so the video stream is copied as-is without re-encoding
+            output += ["-c:v", "copy"]
+        output += ["-c:a", "copy"] if plan["audio_mode"] == "keep" else ["-c:a", "aac", "-b:a", "192k"]
+        if plan["subtitle_input"] is not None:
+            extension = os.path.splitext(target.output_path)[1].lower()
+            output += ["-c:s", SOFT_SUBTITLE_CODECS.get(extension, "mov_text")]
+        if threads:
+            output += ["-threads", str(threads)]
+        output.append(target.output_path)
+        outputs += output
+
+    if filters:
+        command += ["-filter_complex", ";".join(filters)]
+    return command + outputs
+
+def _iter_progress(command, duration, label: str):
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        values = {}
+        try:
+            for line in process.stdout:
+                key, _, value = line.decode("utf-8", errors="replace").strip().partition("=")
+                if key != "progress":
+                    values[key] = value
+                    continue
+                # ffmpeg ends every progress block with progress=continue, and the last one with progress=end
+                try:
+                    out_time = int(values.get("out_time_us", values.get("out_time_ms", "0"))) / 1000000
+                except ValueError:
+                    out_time = 0.0
+                try:
+                    fps = float(values.get("fps", "0"))
+                except ValueError:
+                    fps = 0.0
+                percent = min(100.0, 100.0 * out_time / duration) if duration else None
+                done = value == "end"
+                yield RenderProgress(out_time, duration, 100.0 if done else percent, values.get("speed"), fps, done)
+                values = {}
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+
+        if return_code != 0:
+            stderr_file.seek(0)
+            error = stderr_file.read().decode("utf-8", errors="replace").strip()
+            raise RenderFailed(f"FFmpeg exited with {return_code} rendering {label}: {error[-500:]}")
+
+def iter_render(video_file: str, output_path: str, **kwargs):
+    """
+    Renders a video like render_video, yielding RenderProgress events as ffmpeg reports them.
+
+    Raises:
+        RenderFailed: If ffmpeg exits with a non-zero status.
+    """
+    command = build_command(video_file, output_path, **kwargs)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    yield from _iter_progress(command, probe_duration(video_file), output_path)
+
+@instrumentation.instrumented("render")
+def render_video(video_file: str, output_path: str, subtitles_path: str = None, subtitle_mode: str = "burn",
+                 dub_path: str = None, audio_mode: str = "replace", speed: str = "fast", threads: int = None,
+                 on_progress=None):
+    """
+    Puts the subtitles and the dub onto a video in a single ffmpeg pass.
+
+    Args:
+        video_file (str): The original video.
+
+        output_path (str): Where to write the rendered video.
+
+        subtitles_path (str): The translated .srt file, if subtitles are wanted.
+
+        subtitle_mode (str): "burn" draws the subtitles onto the frames (a full video re-encode),
+        "soft" attaches them as a subtitle track and copies the video stream without re-encoding.
+
+        dub_path (str): The dub track from dubbing_tts, if any.
+
+        audio_mode (str): "replace" swaps the original audio for the dub, "duck" keeps the original
+        audio under the dub and turns it down whenever the dub speaks, "keep" ignores the dub.
+
+        speed (str): One of SPEED_PRESETS, only used when the video is re-encoded.
+
+        threads (int): Encoder thread count. Defaults to ffmpeg's choice.
+
+        on_progress (callable): Called with a RenderProgress for every progress report.
+
+    Returns:
+        str: The path of the rendered video.
+    """
+    for progress in iter_render(
+        video_file, output_path, subtitles_path=subtitles_path, subtitle_mode=subtitle_mode, dub_path=dub_path,
+        audio_mode=audio_mode, speed=speed, threads=threads
+    ):
+        if on_progress is not None:
+            on_progress(progress)
+    instrumentation.count("bytes_in", instrumentation.file_size(video_file))
+    instrumentation.count("bytes_out", instrumentation.file_size(output_path))
+    return output_path
+
+@instrumentation.instrumented("render")
+def render_videos(video_file: str, targets, subtitle_mode: str = "burn", audio_mode: str = "replace",
+                  speed: str = "fast", threads: int = None, on_progress=None):
+    """
+    Renders several versions of a video (e.g. one per language) in a single ffmpeg pass.
+
+    The source is decoded once for all of them. See build_multi_command and render_video.
+
+    Returns:
+        list of str: The paths of the rendered videos, in the order of 'targets'.
+    """
+    targets = [RenderTarget(*target) for target in targets]
+    command = build_multi_command(
+        video_file, targets, subtitle_mode=subtitle_mode, audio_mode=audio_mode, speed=speed, threads=threads
+    )
+    for target in targets:
+        os.makedirs(os.path.dirname(target.output_path) or ".", exist_ok=True)
+    label = ", ".join(target.output_path for target in targets)
+    for progress in _iter_progress(command, probe_duration(video_file), label):
+        if on_progress is not None:
+            on_progress(progress)
+    instrumentation.count("bytes_in", instrumentation.file_size(video_file))
+    instrumentation.count("bytes_out", sum(instrumentation.file_size(target.output_path) for target in targets))
+    return [target.output_path for target in targets]
@@ -0,0 +1,327 @@
+import audio_chunker
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
+import json
+import os
+import pcm_buffer
+import rate_limiter
+import re
+import subtitles
+import threading
+import time
+import transcript_cache
+import urllib.request
+import uuid
+
+# Free tier Whisper limits, see notes/Whisper-API.md
+WHISPER_RPM = 3
+WHISPER_PROVIDER = "openai_whisper"
+# Whisper works on 16 kHz mono internally, so anything above that is wasted upload
+WHISPER_SAMPLE_RATE = 16000
+# Keeps chunks short enough that long files are actually split and transcribed concurrently
+MAX_CHUNK_SECS = 600
+OVERLAP_MS = 2000
+# How far a cue may start before the previous one ends and still count as new at a seam
+SEAM_SLACK_MS = 250
+
+class TranscriptionFailed(Exception):
+    def __init__(self, message="Whisper failed to transcribe the audio after retrying."):
+        self.message = message
+        super().__init__(self.message)
+
+class OpenAIWhisperBackend:
+    """Sends chunks through the openai package, the way transcribe_audio_whisperai always has."""
+    # The quota every chunk is counted against. Local backends (see local_whisper) have none.
+    provider = WHISPER_PROVIDER
+
+    def __init__(self, model: str = "whisper-1"):
+        self.model = model
+
+    def transcribe(self, audio_path: str):
+        import openai
+        with open(audio_path, "rb") as audio_file:
+            return openai.Audio.transcribe(model=self.model, file=audio_file, response_format="srt")
+
+class HTTPWhisperBackend:
+    """
+    Posts chunks to an OpenAI compatible /audio/transcriptions endpoint.
+
+    Pointing 'base_url' at a local fake Whisper server makes the whole driver testable offline.
+
+    Args:
+        base_url (str): Base of the API, e.g. "https://api.openai.com/v1" or "http://127.0.0.1:8001/v1".
+
+        api_key (str): Bearer token sent with every request.
+
+        model (str): Whisper model name.
+
+        timeout (float): Per request timeout in seconds.
+    """
+    provider = WHISPER_PROVIDER
+
+    def __init__(self, base_url: str, api_key: str = "", model: str = "whisper-1", timeout: float = 600):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+
+    def transcribe(self, audio_path: str):
+        boundary = uuid.uuid4().hex
+        fields = {"model": self.model, "response_format": "srt"}
+        body = []
+        for name, value in fields.items():
+            body.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        with open(audio_path, "rb") as audio_file:
+            audio = audio_file.read()
+        file_name = os.path.basename(audio_path)
+        body.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+        )
+        body.append(audio)
+        body.append(f"\r\n--{boundary}--\r\n".encode())
+
+        request = urllib.request.Request(
+            f"{self.base_url}/audio/transcriptions",
+            data=b"".join(body),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+            },
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            text = response.read().decode("utf-8")
+        if text.lstrip().startswith("{"):
+            # Some servers wrap the result as {"text": ...} even when asked for srt
+            text = json.loads(text).get("text", "")
+        return text
+
+def _normalize(text: str):
+    return re.sub(r"[^\w]+", " ", text.lower()).strip()
+
+def stitch_srt(chunks, srt_results):
+    """
+    Stitches per chunk SRT output back into one SRT on the original timeline.
+
+    Every cue is shifted by its chunk's start time. Where two chunks overlap, the earlier chunk keeps
+    the cues that end before the middle of the overlap and the later chunk picks up from where those
+    end. Any cue that repeats the text of the previously kept cue near the seam is dropped.
+
+    Args:
+        chunks (list of AudioChunk): The chunk manifest, in timeline order.
+
+        srt_results (list of str): The SRT text returned for each chunk, in the same order.
+
+    Returns:
+        str: The merged SRT.
+    """
+    merged = []
+    for i, (chunk, srt_text) in enumerate(zip(chunks, srt_results)):
+        overlaps_previous = i > 0 and chunk.start_ms < chunks[i - 1].end_ms
+        keep_until = None
+        if i + 1 < len(chunks) and chunks[i + 1].start_ms < chunk.end_ms:
+            keep_until = (chunks[i + 1].start_ms + chunk.end_ms) // 2
+
+        for start_ms, end_ms, text in subtitles.parse_cues(srt_text):
+            start_ms += chunk.start_ms
+            end_ms += chunk.start_ms
+            # Cues running past the middle of the next overlap may be cut off, the next chunk has them whole
+            if keep_until is not None and end_ms > keep_until:
+                continue
+            if overlaps_previous and start_ms < chunks[i - 1].end_ms and merged and start_ms < merged[-1][1] - SEAM_SLACK_MS:
+                continue
+            if merged and start_ms - merged[-1][0] < 2 * OVERLAP_MS and _normalize(text) == _normalize(merged[-1][2]):
+                continue
+            if merged and start_ms < merged[-1][1]:
+                # Keeps cues from running over each other at the seam
+                merged[-1] = (merged[-1][0], start_ms, merged[-1][2])
+            merged.append((start_ms, end_ms, text))
+    return subtitles.format_cues(merged)
+
+@instrumentation.instrumented("compress_audio")
+def compress_audio(audio_path: str, sample_rate: int = WHISPER_SAMPLE_RATE):
+    """
+    Downmixes and resamples an audio file to 16-bit mono at 'sample_rate', which is all Whisper uses.
+
+    This is the shared derived buffer (see pcm_buffer.derive), so when speech detection already made
+    it for the same audio it's reused rather than resampled again.
+
+    Returns:
+        str: The path of the compressed .wav file, next to the original.
+    """
+    try:
+        compressed_path = pcm_buffer.derive(audio_path, sample_rate, 1).audio_path
+    except pcm_buffer.ResampleFailed as e:
+        raise TranscriptionFailed(f"Could not compress {audio_path}: {e}") from e
+    instrumentation.count("bytes_in", instrumentation.file_size(audio_path))
+    instrumentation.count("bytes_out", instrumentation.file_size(compressed_path))
+    return compressed_path
+
+def prepare_whisper_chunks(audio_path: str, max_chunk_secs: int = MAX_CHUNK_SECS, overlap_ms: int = OVERLAP_MS,
+                           export_codec: str = "libmp3lame", out_dir: str = "./audio"):
+    """
+    Compresses an audio file and splits it into overlapping chunks that each fit under Whisper's 25 MB cap.
+
+    Returns:
+        list of AudioChunk: The chunk manifest, in timeline order.
+    """
+    compressed_path = compress_audio(audio_path)
+    return audio_chunker.chunk_audio(
+        compressed_path,
+        "whisper",
+        max_secs=max_chunk_secs,
+        max_bytes=audio_chunker.WHISPER_MAX_BYTES,
+        overlap_ms=overlap_ms,
+        export_codec=export_codec,
+        out_dir=out_dir
+    )
+
+@instrumentation.instrumented("transcribe")
+def transcribe_chunks(chunks, backend=None, requests_per_minute: int = WHISPER_RPM, max_workers: int = None,
+                      max_retries: int = 3, store=None, audio_path: str = None, ledger=None):
+    """
+    Transcribes a chunk manifest concurrently and stitches the results into one SRT.
+
+    Requests are spread over a thread pool but never sent faster than 'requests_per_minute'. A chunk
+    that fails is retried with exponential backoff, each retry also counting against the budget.
+
+    With a transcript store, every chunk is fingerprinted by its range of 'audio_path' and only chunks
+    without a cached result are sent, so a file with an edited tail only re-transcribes the tail.
+
+    Args:
+        chunks (list of AudioChunk): The chunk manifest from prepare_whisper_chunks.
+
+        backend: Anything with a transcribe(audio_path) -> str method returning SRT. Defaults to
+        OpenAIWhisperBackend. A backend whose 'provider' is None runs locally (e.g.
+        local_whisper.LocalWhisperPool): no rate limit or ledger applies and all its workers are used.
+
+        requests_per_minute (int): The request budget shared by all workers.
+
+        max_workers (int): Number of concurrent requests. Defaults to the RPM budget, or to the local
+        backend's worker count.
+
+        max_retries (int): Attempts per chunk after the first failure.
+
+        store (TranscriptStore): Optional store to reuse and save per chunk results in.
+
+        audio_path (str): The .wav the chunks were cut from, required with 'store'. Any audio on the
+        same timeline works, e.g. the extracted audio before compression.
+
+        ledger (QuotaLedger): Optional shared quota ledger. The requests for the uncached chunks are
+        reserved against the daily budget before anything is sent, and each request is paced against
+        the per minute limit through it instead of the in-process limiter.
+
+    Returns:
+        str: The SRT transcription of the whole audio.
+
+    Raises:
+        TranscriptionFailed: If a chunk still fails after all retries.
+
+        QuotaExceeded: If the ledger can't cover the uncached chunks. Nothing is sent then.
+    """
+    backend = backend or OpenAIWhisperBackend()
+    model = getattr(backend, "model", "whisper-1")
+    provider = getattr(backend, "provider", WHISPER_PROVIDER)
+    limiter = rate_limiter.per_minute(requests_per_minute) if provider is not None else None
+
+    srt_results = [None] * len(chunks)
+    fingerprints = [None] * len(chunks)
+    if store is not None:
+        fingerprints = transcript_cache.fingerprint_chunks(audio_path, chunks)
+        srt_results = [store.get(fingerprint, model) for fingerprint in fingerprints]
+    missing = [i for i, result in enumerate(srt_results) if result is None]
+    print(f"transcribe_chunks[chunks: {len(chunks)}, cached: {len(chunks) - len(missing)}]")
+    if not missing:
+        return stitch_srt(chunks, srt_results)
+
+    reservation = None
+    if ledger is not None and provider is not None:
+        reservation = ledger.reserve(provider, {"requests": len(missing)})
+
+    # Set once a chunk fails for good, so the chunks still queued aren't sent for nothing
+    failed = threading.Event()
+
+    def transcribe_one(i):
+        chunk = chunks[i]
+        for attempt in range(max_retries + 1):
+            if failed.is_set():
+                return None
+            if reservation is not None:
+                reservation.consume({"requests": 1})
+            elif limiter is not None:
+                limiter.acquire()
+            if provider is not None:
+                instrumentation.count("api_calls")
+                instrumentation.count("bytes_out", chunk.size_bytes)
+            try:
+                srt_text = backend.transcribe(chunk.path)
+                instrumentation.count("bytes_in", len(srt_text.encode("utf-8")))
+                if store is not None:
+                    store.put(fingerprints[i], model, srt_text)
+                return srt_text
+            except Exception as e:
+                print(f"transcribe_chunks[chunk: {chunk.path}, attempt: {attempt + 1}, error: {e}]")
+                if attempt == max_retries:
+                    failed.set()
+                    raise TranscriptionFailed(f"Whisper failed on {chunk.path}: {e}") from e
+                instrumentation.count("retries")
+                time.sleep(2 ** attempt)
+
+    if max_workers is None:
+        max_workers = getattr(backend, "workers", None) if provider is None else requests_per_minute
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(missing), max_workers or 1)) as executor:
+            for i, srt_text in zip(missing, executor.map(instrumentation.propagate(transcribe_one), missing)):
+                srt_results[i] = srt_text
+    finally:
+        # Every request sent was already recorded by consume(), only the unused part is handed back
+        if reservation is not None:
+            reservation.release()
+    return stitch_srt(chunks, srt_results)
+
+def transcribe_long_audio(audio_path: str, backend=None, requests_per_minute: int = WHISPER_RPM, store=None,
+                          ledger=None, speech_timeline=None, **kwargs):
+    """
+    Compresses, chunks and transcribes an audio file of any length, returning one SRT.
+
+    With a transcript store, a file whose fingerprint is already stored is returned straight away
+    without compressing or chunking, and otherwise only the chunks not stored yet are sent.
+
+    With a speech timeline (see speech_regions), only the speech-only version of the audio is sent
+    and the cues are mapped back onto the original timeline.
+
+    A local backend picks its own chunk length and export codec, unless they're passed in.
+    """
+    if speech_timeline is not None:
+        if not speech_timeline.regions:
+            print(f"transcribe_long_audio[audio_path: {audio_path}]: No speech detected")
+            return ""
+        audio_path = speech_timeline.condense(audio_path)
+
+    model = getattr(backend, "model", "whisper-1")
+    fingerprint = None
+    srt_text = None
+    if store is not None:
+        fingerprint = transcript_cache.fingerprint_audio(audio_path)
+        srt_text = store.get(fingerprint, model)
+        if srt_text is not None:
+            print(f"transcribe_long_audio[cached: {fingerprint}]")
+
+    if srt_text is None:
+        kwargs.setdefault("max_chunk_secs", getattr(backend, "max_chunk_secs", MAX_CHUNK_SECS))
+        kwargs.setdefault("export_codec", getattr(backend, "export_codec", "libmp3lame"))
+        chunks = prepare_whisper_chunks(audio_path, **kwargs)
+        srt_text = transcribe_chunks(
+            chunks,
+            backend=backend,
+            requests_per_minute=requests_per_minute,
+            store=store,
+            audio_path=audio_path,
+            ledger=ledger
+        )
+        if store is not None:
+            store.put(fingerprint, model, srt_text)
+    if speech_timeline is not None:
+        srt_text = subtitles.format_cues(speech_timeline.map_cues(subtitles.parse_cues(srt_text)))
+    return srt_text
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# The modules are flat in backend/code and import each other by name, the way the scripts run them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+
+import fake_providers
+import quota_ledger
+
+# No latency and no rate limits, so a test only waits on the code under test
+INSTANT = fake_providers.ProviderProfile(0, 0, None)
+
+@pytest.fixture
+def providers():
+    """FakeProviders answering instantly, stopped after the test."""
+    with fake_providers.FakeProviders({provider: INSTANT for provider in fake_providers.DEFAULT_PROFILES}) as providers:
+        yield providers
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Runs the test from an empty directory, so ./cache, ./state and ./jobs never touch the real ones."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def unlimited_ledger(workdir):
+    """Makes get_default_ledger() hand out a ledger with no limits for the length of the test."""
+    ledger = quota_ledger.QuotaLedger(
+        str(workdir / "ledger.sqlite3"),
+        limits={provider: [] for provider in quota_ledger.PROVIDER_LIMITS}
+    )
+    previous = quota_ledger._default_ledger
+    quota_ledger.set_default_ledger(ledger)
+    yield ledger
+    quota_ledger.set_default_ledger(previous)
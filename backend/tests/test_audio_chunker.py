@@ -0,0 +1,54 @@
+import wave
+
+import numpy as np
+import pytest
+
+import audio_chunker
+import pcm_buffer
+
+SAMPLE_RATE = 1000
+# Gaps of silence in an otherwise loud 10 s tone, in frames
+GAPS = [(2500, 2600), (5200, 5300), (7900, 8000)]
+
+def write_wav(path, samples):
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(samples.astype("<i2").tobytes())
+    return pcm_buffer.open_buffer(str(path))
+
+def tone(secs):
+    frames = np.arange(int(secs * SAMPLE_RATE))
+    return (np.sin(frames * 2 * np.pi * 50 / SAMPLE_RATE) * 10000).astype(np.int16)
+
+@pytest.fixture
+def speech(tmp_path):
+    samples = tone(10)
+    for start, end in GAPS:
+        samples[start:end] = 0
+    return write_wav(tmp_path / "speech.wav", samples)
+
+def test_plan_chunks_cuts_in_the_silence(speech):
+    boundaries = audio_chunker.plan_chunks(speech, max_frames=3000, tolerance_frames=1000)
+
+    assert boundaries[0][0] == 0 and boundaries[-1][1] == speech.num_frames
+    assert all(end == next_start for (_, end), (next_start, _) in zip(boundaries, boundaries[1:]))
+    assert all(end - start <= 3000 for start, end in boundaries)
+    cuts = [end for _, end in boundaries[:-1]]
+    assert len(cuts) == len(GAPS)
+    assert all(start <= cut < end for cut, (start, end) in zip(cuts, GAPS))
+
+def test_plan_chunks_without_silence_cuts_as_late_as_it_can(tmp_path):
+    source = write_wav(tmp_path / "tone.wav", np.full(7000, 10000, dtype=np.int16))
+    boundaries = audio_chunker.plan_chunks(source, max_frames=3000, tolerance_frames=1000)
+
+    # Every window is as loud as the next, so the last one before the limit wins
+    assert boundaries == [(0, 2990), (2990, 5980), (5980, 7000)]
+
+def test_plan_chunks_of_a_short_or_empty_source(tmp_path):
+    short = write_wav(tmp_path / "short.wav", tone(2))
+    assert audio_chunker.plan_chunks(short, max_frames=3000, tolerance_frames=1000) == [(0, 2000)]
+
+    empty = write_wav(tmp_path / "empty.wav", np.zeros(0, dtype=np.int16))
+    assert audio_chunker.plan_chunks(empty, max_frames=3000, tolerance_frames=1000) == []
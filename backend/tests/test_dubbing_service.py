@@ -0,0 +1,250 @@
+import http.client
+import io
+import json
+import os
+import shutil
+import subprocess
+import urllib.request
+import wave
+
+import pytest
+
+import dubbing_service
+import dubbing_stages
+import fake_providers
+import job_scheduler
+import subtitles
+import whisper_transcriber
+
+SAMPLE_RATE = 16000
+
+def multipart_body(boundary, parts):
+    body = b""
+    for headers, content in parts:
+        body += f"--{boundary}\r\n{headers}\r\n\r\n".encode() + content + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode()
+
+def in_blocks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def read_parts(stream):
+    parts = []
+    while True:
+        headers = stream.next_part()
+        if headers is None:
+            return parts
+        parts.append((headers, b"".join(stream.read_part())))
+
+@pytest.mark.parametrize("block_size", [1, 3, 7, 16, 1024])
+def test_multipart_boundary_split_across_blocks(block_size):
+    video = b"0123456789\r\n--BOUNDAR not the boundary\r\n" * 20
+    body = multipart_body("BOUNDARY", [
+        ('Content-Disposition: form-data; name="video"; filename="a.mp4"', video),
+        ('Content-Disposition: form-data; name="language"', b"es-419"),
+    ])
+    parts = read_parts(dubbing_service.MultipartStream(in_blocks(body, block_size), b"BOUNDARY"))
+
+    assert [part[1] for part in parts] == [video, b"es-419"]
+    assert parts[0][0]["content-disposition"] == 'form-data; name="video"; filename="a.mp4"'
+
+def test_multipart_without_closing_boundary():
+    body = multipart_body("B", [('Content-Disposition: form-data; name="language"', b"fr")])[:-len("--B--\r\n")]
+    with pytest.raises(dubbing_service.BadUpload):
+        read_parts(dubbing_service.MultipartStream(in_blocks(body, 4), b"B"))
+
+def test_read_body_decodes_chunks():
+    body = io.BytesIO(b"5\r\nhello\r\n6;name=value\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\nnext request")
+    blocks = list(dubbing_service.read_body(body, {"Transfer-Encoding": "chunked"}, block_bytes=4))
+
+    assert b"".join(blocks) == b"hello world"
+    assert max(len(block) for block in blocks) <= 4
+    # The trailers are consumed, nothing after the body is
+    assert body.read() == b"next request"
+
+@pytest.mark.parametrize("body, headers", [
+    (b"zz\r\nhello\r\n", {"Transfer-Encoding": "chunked"}),
+    (b"a\r\nhello", {"Transfer-Encoding": "chunked"}),
+    (b"hello", {"Content-Length": "10"}),
+    (b"hello", {"Content-Length": "five"}),
+    (b"hello", {}),
+])
+def test_read_body_rejects_malformed_bodies(body, headers):
+    with pytest.raises(dubbing_service.BadUpload):
+        list(dubbing_service.read_body(io.BytesIO(body), headers))
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=10-", (10, 99)),
+    ("bytes=-5", (95, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=90-500", (90, 99)),
+    ("bytes=100-", None),
+    ("bytes=9-3", None),
+    ("bytes=-0", None),
+    ("bytes=0-1,5-9", (0, 99)),
+    ("items=0-9", (0, 99)),
+])
+def test_parse_range(header, expected):
+    assert dubbing_service.parse_range(header, 100) == expected
+
+@pytest.fixture
+def service(workdir):
+    frontend_dir = workdir / "frontend"
+    (frontend_dir / "stylesheets").mkdir(parents=True)
+    (frontend_dir / "dubber.html").write_text("<html></html>")
+    (frontend_dir / "stylesheets" / "main.css").write_text("body {}")
+    (workdir / "secret.txt").write_text("secret")
+    service = dubbing_service.DubbingService(jobs_dir=str(workdir / "jobs"), frontend_dir=str(frontend_dir), port=0)
+    yield service
+    service._server.server_close()
+
+def test_frontend_file_serves_the_frontend(service):
+    assert os.path.basename(service.frontend_file("/")) == "dubber.html"
+    assert os.path.basename(service.frontend_file("/stylesheets/main.css")) == "main.css"
+
+@pytest.mark.parametrize("url_path", [
+    "/../secret.txt",
+    "/%2e%2e/secret.txt",
+    "/stylesheets/../../secret.txt",
+    "/%2e%2e%2fsecret.txt",
+    "/stylesheets",
+    "/missing.html",
+])
+def test_frontend_file_stays_inside_the_frontend(service, url_path):
+    assert service.frontend_file(url_path) is None
+
+def write_speech(path, secs):
+    # Already the 16 kHz mono .wav Whisper is sent, so no stage needs FFmpeg
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(b"\0\0" * int(secs * SAMPLE_RATE))
+    with open(path, "rb") as file:
+        return file.read()
+
+def uploaded_audio(job):
+    return {"audio_path": job["video_file"]}
+
+def chunk_for_whisper(job):
+    chunks = whisper_transcriber.prepare_whisper_chunks(
+        job["video_file"], max_chunk_secs=10, export_codec=None, out_dir=os.path.join(job["work_dir"], "chunks")
+    )
+    return {"chunks": [list(chunk) for chunk in chunks]}
+
+def transcript_as_subtitles(job):
+    return {"translated_srt_paths": {language: job["artifacts"]["srt_path"] for language in job["target_languages"]}}
+
+def post(base_url, path, body, headers):
+    host, port = base_url.replace("http://", "").split(":")
+    connection = http.client.HTTPConnection(host, int(port))
+    connection.request("POST", path, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+def follow_events(base_url, job_id):
+    with urllib.request.urlopen(f"{base_url}/jobs/{job_id}/events", timeout=60) as stream:
+        text = stream.read().decode("utf-8")
+    return [json.loads(line[len("data: "):]) for line in text.splitlines() if line.startswith("data: {\"")]
+
+def test_service_job_end_to_end(workdir, providers, unlimited_ledger):
+    # The real transcribe stage against the fake Whisper. Extraction, translation and rendering need
+    # FFmpeg and the Google client, which test_full_pipeline_job covers where they're installed.
+    stages = [
+        job_scheduler.Stage("extract_audio", uploaded_audio, job_scheduler.NETWORK, None),
+        job_scheduler.Stage("chunk_audio", chunk_for_whisper, job_scheduler.NETWORK, None),
+        job_scheduler.Stage("transcribe", dubbing_stages.transcribe, job_scheduler.NETWORK, "openai_whisper"),
+        job_scheduler.Stage("translate", transcript_as_subtitles, job_scheduler.NETWORK, None),
+    ]
+    scheduler = job_scheduler.JobScheduler(stages=stages, process_workers=1)
+    audio = write_speech(workdir / "speech.wav", 25)
+    body = multipart_body("B0UNDARY", [
+        ('Content-Disposition: form-data; name="video"; filename="../Talk Show.wav"', audio),
+        ('Content-Disposition: form-data; name="language"', b"es-419"),
+    ])
+    with dubbing_service.DubbingService(scheduler, providers.job_options(), str(workdir / "jobs"), port=0) as service:
+        status, response = post(service.base_url, "/jobs", body, {
+            "Content-Type": "multipart/form-data; boundary=B0UNDARY",
+            "Content-Length": str(len(body)),
+        })
+        assert status == 201
+        job_id = response["jobs"][0]["job_id"]
+        assert response["jobs"][0]["video"] == "Talk_Show.wav"
+
+        events = follow_events(service.base_url, job_id)
+        assert [(event["stage"], event["status"]) for event in events if event["stage"]] == [
+            (stage.name, status) for stage in stages for status in ("started", "done")
+        ]
+        assert events[-1]["job_status"] == "done"
+
+        with urllib.request.urlopen(f"{service.base_url}/jobs/{job_id}") as response:
+            summary = json.loads(response.read())
+        download = summary["downloads"]["subtitles"]["es-419"]
+        request = urllib.request.Request(f"{service.base_url}{download}", headers={"Range": "bytes=0-1"})
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 206
+            assert response.read() == b"1\n"
+        with urllib.request.urlopen(f"{service.base_url}{download}") as response:
+            cues = subtitles.parse_cues(response.read().decode("utf-8"))
+
+    assert cues and cues[-1].end_ms <= 25000
+    assert all(cue.end_ms <= next_cue.start_ms for cue, next_cue in zip(cues, cues[1:]))
+    chunks = len(os.listdir(workdir / "jobs" / job_id / "chunks"))
+    assert providers.stats()[fake_providers.WHISPER]["requests"] == chunks
+
+def test_upload_that_fails_to_submit_is_a_json_error(workdir, monkeypatch):
+    def submit(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    with dubbing_service.DubbingService(jobs_dir=str(workdir / "jobs"), port=0) as service:
+        monkeypatch.setattr(service, "submit", submit)
+        status, response = post(service.base_url, "/jobs?filename=a.wav", b"RIFF", {"Content-Length": "4"})
+
+    assert status == 500
+    assert "No space left on device" in response["error"]
+
+def test_finished_jobs_are_read_back_from_disk_once_forgotten(workdir):
+    stages = [job_scheduler.Stage("extract_audio", uploaded_audio, job_scheduler.NETWORK, None)]
+    scheduler = job_scheduler.JobScheduler(stages=stages, process_workers=1)
+    video_file = str(workdir / "talk.wav")
+    write_speech(video_file, 1)
+    with dubbing_service.DubbingService(scheduler, jobs_dir=str(workdir / "jobs"), port=0, job_retention_secs=0) as service:
+        first = service.submit(video_file, ["fr"])
+        assert follow_events(service.base_url, first.job_id)[-1]["job_status"] == "done"
+        second = service.submit(video_file, ["fr"])
+        follow_events(service.base_url, second.job_id)
+
+        # The first job went when the second was submitted, only the second's events are in memory
+        assert list(service._events) == [second.job_id]
+        with urllib.request.urlopen(f"{service.base_url}/jobs/{first.job_id}") as response:
+            summary = json.loads(response.read())
+        assert (summary["status"], summary["stages"]) == ("done", {"extract_audio": "done"})
+        assert follow_events(service.base_url, first.job_id) == []
+        assert service.get_job("..") is None
+
+def google_translate_installed():
+    try:
+        from google.cloud import translate_v2
+    except ImportError:
+        return False
+    return True
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None or not google_translate_installed(),
+                    reason="the full pipeline needs FFmpeg and google-cloud-translate")
+def test_full_pipeline_job(workdir, providers, unlimited_ledger):
+    video_file = str(workdir / "clip.mp4")
+    subprocess.run([
+        "ffmpeg", "-nostdin", "-v", "error", "-y",
+        "-f", "lavfi", "-i", "testsrc=duration=8:size=320x240:rate=10",
+        "-f", "lavfi", "-i", "sine=frequency=440:duration=8",
+        "-shortest", video_file
+    ], check=True)
+    with dubbing_service.DubbingService(job_options=providers.job_options(), jobs_dir=str(workdir / "jobs"), port=0) as service:
+        job = service.submit(video_file, ["es-419", "fr"])
+        events = follow_events(service.base_url, job.job_id)
+
+    assert events[-1]["job_status"] == "done", events[-1]["error"]
+    for language in ("es-419", "fr"):
+        assert os.path.exists(job.artifacts["output_paths"][language])
+        cues = subtitles.read_cues(job.artifacts["translated_srt_paths"][language])
+        assert cues and all(cue.text.startswith(f"[{language}]") for cue in cues)
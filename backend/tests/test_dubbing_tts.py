@@ -0,0 +1,93 @@
+import io
+import urllib.error
+import wave
+
+import numpy as np
+import pytest
+
+import dubbing_tts
+import fake_providers
+import quota_ledger
+
+SAMPLE_RATE = 8000
+
+def decode_wav(audio, sample_rate=dubbing_tts.DUB_SAMPLE_RATE, tempo=1.0):
+    # Stands in for FFmpeg: the fake ElevenLabs answers with silent .wavs, played back as a constant tone
+    with wave.open(io.BytesIO(audio), "rb") as wav_file:
+        secs = wav_file.getnframes() / wav_file.getframerate()
+    return np.full(int(secs / tempo * sample_rate), 0.25, dtype=np.float32)
+
+class FlakyBackend:
+    """Fails the first 'failures' calls with 'error', then passes them on."""
+    def __init__(self, backend, failures, error):
+        self.backend = backend
+        self.model = backend.model
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def synthesize(self, text, voice):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return self.backend.synthesize(text, voice)
+
+@pytest.fixture
+def no_ffmpeg(monkeypatch):
+    monkeypatch.setattr(dubbing_tts, "decode_clip", decode_wav)
+    monkeypatch.setattr(dubbing_tts.time, "sleep", lambda secs: None)
+
+def read_track(path):
+    with wave.open(str(path), "rb") as wav_file:
+        return wav_file.getframerate(), np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype="<i2")
+
+def test_mix_clips_only_loads_clips_as_their_window_opens():
+    loaded = []
+
+    def loader(name, secs):
+        def load():
+            loaded.append(name)
+            return np.full(int(secs * SAMPLE_RATE), 0.5, dtype=np.float32)
+        return load
+
+    clips = [(0, 1000, loader("a", 2)), (1000, None, loader("b", 1)), (25000, None, loader("c", 1))]
+    windows = []
+    for window in dubbing_tts.mix_clips(clips, 0, SAMPLE_RATE, window_secs=10):
+        windows.append((len(loaded), window))
+
+    # "c" starts in the third window and isn't decoded before it
+    assert [count for count, _ in windows] == [2, 2, 3]
+    track = np.concatenate([window for _, window in windows])
+    assert len(track) == 26 * SAMPLE_RATE
+    # "a" is cut off at "b" with a fade, and the gap before "c" is silent
+    assert track[SAMPLE_RATE // 2] == int(0.5 * 32767)
+    assert track[SAMPLE_RATE - 1] < track[SAMPLE_RATE // 2]
+    assert not track[3 * SAMPLE_RATE:25 * SAMPLE_RATE].any()
+
+def test_dub_cues_synthesizes_each_line_once(workdir, providers, no_ffmpeg):
+    ledger = quota_ledger.QuotaLedger(str(workdir / "ledger.sqlite3"))
+    backend = dubbing_tts.HTTPTTSBackend(providers.base_url)
+    cues = [(0, 1000, "Yeah."), (2000, 3000, "What?"), (4000, 5000, " Yeah. "), (6000, 7000, "Yeah.")]
+    path = dubbing_tts.dub_cues(cues, str(workdir / "dub.wav"), backend, total_ms=8000, ledger=ledger,
+                                cache_dir=str(workdir / "tts"))
+
+    assert providers.stats()[fake_providers.TTS]["requests"] == 2
+    assert ledger.usage(dubbing_tts.TTS_PROVIDER)["characters_per_month"] == len("Yeah.") + len("What?")
+    sample_rate, track = read_track(path)
+    assert len(track) == 8 * sample_rate
+    assert track[int(4.1 * sample_rate)] > 0
+
+def test_synthesize_clip_retries_transient_errors(workdir, providers, no_ffmpeg):
+    error = urllib.error.HTTPError(providers.base_url, 503, "Service Unavailable", None, None)
+    backend = FlakyBackend(dubbing_tts.HTTPTTSBackend(providers.base_url), 2, error)
+    audio, cached = dubbing_tts.synthesize_clip(backend, "Hello there.", "Ryan", str(workdir / "tts"))
+
+    assert backend.calls == 3 and not cached
+    assert audio[:4] == b"RIFF"
+
+def test_synthesize_clip_gives_up_on_a_bad_request(workdir, providers, no_ffmpeg):
+    error = urllib.error.HTTPError(providers.base_url, 400, "Bad Request", None, None)
+    backend = FlakyBackend(dubbing_tts.HTTPTTSBackend(providers.base_url), 1, error)
+    with pytest.raises(dubbing_tts.SynthesisFailed):
+        dubbing_tts.synthesize_clip(backend, "Hello there.", "Ryan", str(workdir / "tts"))
+    assert backend.calls == 1
@@ -0,0 +1,123 @@
+import os
+import time
+
+import pytest
+
+import quota_ledger
+
+DAY = quota_ledger.DAY
+MONTH = quota_ledger.MONTH
+
+class FakeClock:
+    """Stands in for the time module, sleeping only moves the clock forward."""
+    def __init__(self, now=1_000_000_000.0):
+        self.now = now
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+        self.slept += secs
+
+@pytest.fixture
+def ledger(workdir):
+    return quota_ledger.QuotaLedger(str(workdir / "ledger.sqlite3"))
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(quota_ledger, "time", clock)
+    return clock
+
+def test_reserve_consume_and_release(ledger, clock):
+    reservation = ledger.reserve("openai_whisper", {"requests": 5})
+    # Reserved requests count against the daily quota straight away, but not against the rate limit
+    assert ledger.usage("openai_whisper") == {"rpm": 0, "rpd": 5}
+
+    reservation.consume({"requests": 2})
+    assert ledger.usage("openai_whisper") == {"rpm": 2, "rpd": 5}
+
+    reservation.release()
+    assert ledger.usage("openai_whisper") == {"rpm": 2, "rpd": 2}
+
+def test_reservation_as_a_context_manager(ledger, clock):
+    with ledger.reserve("elevenlabs", {"characters": 100}) as reservation:
+        reservation.consume({"characters": 30})
+    assert ledger.usage("elevenlabs") == {"characters_per_month": 100}
+
+    with pytest.raises(RuntimeError):
+        with ledger.reserve("elevenlabs", {"characters": 100}) as reservation:
+            reservation.consume({"characters": 30})
+            raise RuntimeError("synthesis failed")
+    assert ledger.usage("elevenlabs") == {"characters_per_month": 130}
+
+def test_consume_waits_for_the_rate_limit(ledger, clock):
+    for _ in range(4):
+        ledger.consume("openai_whisper", {"requests": 1})
+
+    # Three requests a minute, so the fourth waits for the first to age out
+    assert clock.slept == pytest.approx(60)
+    assert ledger.usage("openai_whisper") == {"rpm": 1, "rpd": 4}
+
+def test_quota_frees_up_as_the_window_rolls_over(ledger, clock):
+    ledger.consume("google_translate", {"characters": 400000})
+    clock.sleep(DAY)
+    with pytest.raises(quota_ledger.QuotaExceeded) as exceeded:
+        ledger.reserve("google_translate", {"characters": 200000})
+    assert exceeded.value.retry_after == pytest.approx(MONTH - DAY)
+    with pytest.raises(quota_ledger.QuotaExceeded) as exceeded:
+        ledger.reserve("google_translate", {"characters": 600000})
+    assert exceeded.value.retry_after is None
+
+    clock.sleep(MONTH - DAY)
+    ledger.reserve("google_translate", {"characters": 200000})
+    assert ledger.usage("google_translate") == {"characters_per_minute": 0, "characters_per_month": 200000}
+
+def test_consuming_past_a_reservation_has_to_fit_the_quota(ledger, clock):
+    ledger.consume("elevenlabs", {"characters": 9990})
+    reservation = ledger.reserve("elevenlabs", {"characters": 10})
+    with pytest.raises(quota_ledger.QuotaExceeded):
+        reservation.consume({"characters": 11})
+    reservation.consume({"characters": 10})
+    assert ledger.usage("elevenlabs") == {"characters_per_month": 10000}
+
+def write_counter(path, text, age_secs):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    written = time.time() - age_secs
+    os.utime(path, (written, written))
+    return str(path)
+
+def test_imports_counter_files_once_and_deletes_them(workdir, ledger):
+    counter_files = [
+        (write_counter(workdir / "code" / "rate_limits_openai.txt", "67", 3600), "openai_whisper", "requests", int),
+        (write_counter(workdir / "google.txt", "14202\n", 3 * DAY), "google_translate", "characters", int),
+        (write_counter(workdir / "ibm.txt", "00:03:20", DAY), "ibm_speech_to_text", "seconds",
+         quota_ledger._duration_seconds),
+    ]
+    imported = ledger.import_counter_files(counter_files)
+
+    assert imported == {
+        "openai_whisper": {"requests": 67},
+        "google_translate": {"characters": 14202},
+        "ibm_speech_to_text": {"seconds": 200},
+    }
+    assert not any(os.path.exists(path) for path, _, _, _ in counter_files)
+    assert ledger.import_counter_files(counter_files) == {}
+    # Counted when the files were written: an hour ago is today but not this minute
+    assert ledger.usage("openai_whisper") == {"rpm": 0, "rpd": 67}
+    assert ledger.usage("google_translate") == {"characters_per_minute": 0, "characters_per_month": 14202}
+
+def test_counts_from_before_the_window_no_longer_count(workdir, ledger):
+    path = write_counter(workdir / "rate_limits_openai.txt", "150", 2 * DAY)
+    ledger.import_counter_files([(path, "openai_whisper", "requests", int)])
+
+    assert ledger.usage("openai_whisper")["rpd"] == 0
+    assert not os.path.exists(path)
+
+def test_leaves_an_unreadable_counter_file(workdir, ledger):
+    path = write_counter(workdir / "total_duration.txt", "not a duration", 0)
+    assert ledger.import_counter_files([(path, "ibm_speech_to_text", "seconds", quota_ledger._duration_seconds)]) == {}
+    assert os.path.exists(path)
@@ -0,0 +1,59 @@
+import pytest
+
+import subtitles
+
+def cue_tuples(cues):
+    return [(cue.id, cue.start_ms, cue.end_ms, cue.text) for cue in cues]
+
+def test_iter_cues_reads_vtt():
+    vtt_text = (
+        "\ufeffWEBVTT\n\nNOTE a comment\n\nSTYLE\n::cue { color: yellow }\n\n"
+        "intro\n00:01.000 --> 00:02.500 align:start position:10%\nHello\n\n"
+        "00:00:03.000 --> 00:00:04.000\nSecond\nline\n"
+    )
+    assert cue_tuples(subtitles.parse_cues(vtt_text)) == [
+        ("intro", 1000, 2500, "Hello"),
+        ("2", 3000, 4000, "Second\nline"),
+    ]
+
+def test_iter_cues_reads_untidy_srt():
+    # CRLF line ends, extra blank lines, a line of only digits and no blank line at the end
+    srt_text = "1\r\n00:00:01,000 --> 00:00:02,000\r\n42\r\n\r\n\r\n\r\n2\r\n00:00:03,5 --> 00:00:04,000\r\nfour\r\nlines"
+    assert cue_tuples(subtitles.parse_cues(srt_text)) == [
+        ("1", 1000, 2000, "42"),
+        ("2", 3500, 4000, "four\nlines"),
+    ]
+
+def test_iter_cues_skips_blocks_without_timings():
+    srt_text = "stray text\n\n1\n00:00:01,000 --> 00:00:02,000\nHello\n\nmore stray text\n"
+    assert cue_tuples(subtitles.parse_cues(srt_text)) == [("1", 1000, 2000, "Hello")]
+
+def test_iter_cues_rejects_a_bad_timestamp():
+    with pytest.raises(ValueError):
+        subtitles.parse_cues("1\n00:00:01,000 --> soon\nHello\n")
+
+@pytest.mark.parametrize("subtitle_format", subtitles.SUBTITLE_FORMATS)
+def test_formatted_cues_parse_back(subtitle_format):
+    cues = [subtitles.Cue(0, 1500, "One", "a"), subtitles.Cue(3600000, 3601000, "Two\nlines", "b")]
+    parsed = subtitles.parse_cues(subtitles.format_cues(cues, subtitle_format))
+
+    assert [tuple(cue) for cue in parsed] == [tuple(cue) for cue in cues]
+    # SRT numbers its cues, VTT keeps their ids
+    assert [cue.id for cue in parsed] == (["1", "2"] if subtitle_format == subtitles.SRT else ["a", "b"])
+
+def test_words_to_cues_drops_hesitations_and_joins_words():
+    words = [["hello", 0.1, 0.5], ["%HESITATION", 0.5, 0.9], ["world", 1.0, 1.4]]
+    assert subtitles.words_to_cues(words) == [(100, 1400, "hello world")]
+
+def test_words_to_cues_splits_cues_longer_than_max_cue_ms():
+    words = [["hello", 0.1, 0.5], ["world", 1.0, 1.4], ["again", 6.0, 6.5]]
+    assert subtitles.words_to_cues(words, max_cue_ms=5000) == [(100, 1400, "hello world"), (6000, 6500, "again")]
+
+def test_words_to_cues_splits_cues_longer_than_max_cue_chars():
+    words = [["one", 0.0, 0.2], ["two", 0.2, 0.4], ["three", 0.4, 0.6]]
+    # "one two" is 7 characters, adding " three" would make 13
+    assert subtitles.words_to_cues(words, max_cue_chars=10) == [(0, 400, "one two"), (400, 600, "three")]
+
+def test_words_to_cues_without_words():
+    assert subtitles.words_to_cues([]) == []
+    assert subtitles.words_to_cues([["%HESITATION", 0.0, 0.4]]) == []
@@ -0,0 +1,59 @@
+import pytest
+
+import translation_cache
+
+class FakeClock:
+    """Stands in for the time module, every reading is a second after the last."""
+    def __init__(self):
+        self.now = 1_000_000_000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(translation_cache, "time", FakeClock())
+
+def segment(i):
+    # 10 bytes of source and 10 of translation
+    return f"segment {i:02}", f"segmento{i:02}"
+
+def test_segments_are_normalized_and_kept_per_language_and_engine(workdir):
+    cache = translation_cache.TranslationCache(str(workdir / "cache.sqlite3"))
+    cache.put("Yeah.", "es-419", "google_v2", "Sí.")
+
+    assert cache.get("  Yeah. ", "es-419", "google_v2") == "Sí."
+    assert cache.get("Yeah.", "fr", "google_v2") is None
+    assert cache.get("Yeah.", "es-419", "other_engine") is None
+
+def test_memory_lru_falls_back_to_disk(workdir):
+    path = str(workdir / "cache.sqlite3")
+    cache = translation_cache.TranslationCache(path, max_memory_entries=2)
+    cache.put_many({"one": "uno", "two": "dos"}, "es-419", "google_v2")
+    cache.get("one", "es-419", "google_v2")
+    # "two" is now the least recently used, and makes room for "three"
+    cache.put("three", "es-419", "google_v2", "tres")
+
+    hits, misses = cache.get_many({1: "one", 2: "two", 3: "three"}, "es-419", "google_v2")
+    assert hits == {1: "uno", 2: "dos", 3: "tres"} and not misses
+    assert (cache.memory_hits, cache.disk_hits) == (3, 1)
+
+    cache.close()
+    reopened = translation_cache.TranslationCache(path)
+    assert reopened.get("two", "es-419", "google_v2") == "dos"
+    assert reopened.stats()["disk_hits"] == 1
+
+def test_disk_cap_evicts_least_recently_used_down_to_90_percent(workdir, clock):
+    cache = translation_cache.TranslationCache(str(workdir / "cache.sqlite3"), max_disk_bytes=100)
+    for i in range(5):
+        cache.put(segment(i)[0], "es-419", "google_v2", segment(i)[1])
+    assert cache.stats()["disk_bytes"] == 100
+    # Reading the first segment makes it recently used again
+    assert cache.get(segment(0)[0], "es-419", "google_v2") == segment(0)[1]
+
+    # 120 bytes is over the cap, the two least recently used go to bring it down to 90 or under
+    cache.put(segment(5)[0], "es-419", "google_v2", segment(5)[1])
+    assert {key: cache.stats()[key] for key in ("entries", "disk_bytes")} == {"entries": 4, "disk_bytes": 80}
+    hits, misses = cache.get_many({i: segment(i)[0] for i in range(6)}, "es-419", "google_v2")
+    assert sorted(hits) == [0, 3, 4, 5] and sorted(misses) == [1, 2]
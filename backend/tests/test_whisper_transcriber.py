@@ -0,0 +1,74 @@
+import wave
+
+import pytest
+
+import audio_chunker
+import fake_providers
+import subtitles
+import whisper_transcriber
+
+SAMPLE_RATE = 16000
+
+def write_silence(path, secs):
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(b"\0\0" * int(secs * SAMPLE_RATE))
+    return str(path)
+
+def overlapping_chunks(tmp_path):
+    # Two 10 s chunks of an 18 s file, overlapping by 2 s
+    return [
+        audio_chunker.AudioChunk(write_silence(tmp_path / "chunk_0.wav", 10), 0, 10000, 0),
+        audio_chunker.AudioChunk(write_silence(tmp_path / "chunk_1.wav", 10), 8000, 18000, 0),
+    ]
+
+class FlakyBackend:
+    """Fails the first 'failures' calls with a ConnectionError, then passes them on."""
+    def __init__(self, backend, failures):
+        self.backend = backend
+        self.failures = failures
+        self.calls = 0
+        self.model = backend.model
+        self.provider = backend.provider
+
+    def transcribe(self, audio_path):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("connection reset")
+        return self.backend.transcribe(audio_path)
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(whisper_transcriber.time, "sleep", lambda secs: None)
+
+def test_stitches_overlapping_chunks_onto_the_timeline(tmp_path, providers):
+    backend = whisper_transcriber.HTTPWhisperBackend(providers.job_options()["whisper_base_url"])
+    srt_text = whisper_transcriber.transcribe_chunks(overlapping_chunks(tmp_path), backend, requests_per_minute=600)
+    cues = subtitles.parse_cues(srt_text)
+
+    # The first chunk keeps what ends before the middle of the overlap (9 s), the second picks up after
+    # it, and the cue cut off at the seam is only kept once
+    assert [start_ms for start_ms, _, _ in cues] == [0, 3000, 6000, 11000, 14000, 17000]
+    assert all(end_ms <= next_start for (_, end_ms, _), (next_start, _, _) in zip(cues, cues[1:]))
+    assert providers.stats()[fake_providers.WHISPER]["requests"] == 2
+
+def test_retries_a_failed_chunk(tmp_path, providers, no_backoff):
+    backend = FlakyBackend(whisper_transcriber.HTTPWhisperBackend(providers.job_options()["whisper_base_url"]), 1)
+    srt_text = whisper_transcriber.transcribe_chunks(
+        overlapping_chunks(tmp_path), backend, requests_per_minute=600, max_workers=1
+    )
+
+    assert backend.calls == 3
+    assert len(subtitles.parse_cues(srt_text)) == 6
+    assert providers.stats()[fake_providers.WHISPER]["requests"] == 2
+
+def test_gives_up_after_max_retries(tmp_path, providers, no_backoff):
+    backend = FlakyBackend(whisper_transcriber.HTTPWhisperBackend(providers.job_options()["whisper_base_url"]), 100)
+    with pytest.raises(whisper_transcriber.TranscriptionFailed):
+        whisper_transcriber.transcribe_chunks(
+            overlapping_chunks(tmp_path), backend, requests_per_minute=600, max_workers=1, max_retries=2
+        )
+    # The first chunk's three attempts, nothing is sent after it fails for good
+    assert backend.calls == 3